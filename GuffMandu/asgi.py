@@ -1,27 +1,32 @@
 import os
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
 from django.core.asgi import get_asgi_application
-from realtime.routers import websocket_urlpatterns
 
 settings_module = 'GuffMandu.deployment_settings' if 'RENDER_EXTERNAL_HOSTNAME' in os.environ else 'GuffMandu.settings'
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", settings_module)
 django_asgi_app = get_asgi_application()
 
+# Imported after the django setup, the middleware needs the installed apps to be loaded
+from realtime.exposition import MetricsEndpoint
+from realtime.middleware import JWTAuthMiddleware
+from realtime.routers import websocket_urlpatterns
+
 application = ProtocolTypeRouter({
-    "http": django_asgi_app,
+    # /metrics is answered before Django (see realtime.exposition)
+    "http": MetricsEndpoint(django_asgi_app),
 
     # WebSocket chat handler
+    # Users are authenticated with the same JWT access tokens as the REST API
     "websocket": 
-        AuthMiddlewareStack(
+        JWTAuthMiddleware(
             URLRouter(websocket_urlpatterns)
         ),
 
     # This is commented out because we wanna allow anyone for now in development process
     # "websocket": AllowedHostsOriginValidator(
-    #     AuthMiddlewareStack(
+    #     JWTAuthMiddleware(
     #         URLRouter(websocket_urlpatterns)
     #     )
     # ),
@@ -10,6 +10,8 @@ DEBUG=False
 SECRET_KEY=os.environ.get('SECRET_KEY')
 
 MIDDLEWARE = [
+    # First, so its total covers the other middlewares too (does nothing unless SERVER_TIMING is on)
+    'utilities.server_timing.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -21,6 +23,9 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Behind the reverse proxy of the host, the rate limits read the client IP it appends to X-Forwarded-For
+RATE_LIMIT = {**RATE_LIMIT, "TRUSTED_PROXY_HEADER": "HTTP_X_FORWARDED_FOR", "TRUSTED_PROXY_COUNT": 1}
+
 # CORS_ALLOWED_ORIGINS = [
 #     "http://localhost:5173",
 #     "http://127.0.0.1:5173",
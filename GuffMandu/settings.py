@@ -42,6 +42,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its total covers the other middlewares too (does nothing unless SERVER_TIMING is on)
+    'utilities.server_timing.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     "corsheaders.middleware.CorsMiddleware",
@@ -80,15 +82,117 @@ AUTH_USER_MODEL = "accounts.User"
 ASGI_APPLICATION = "GuffMandu.asgi.application"  # asgi is for the websocket requests
 WSGI_APPLICATION = 'GuffMandu.wsgi.application'  # wsgi is for the http/https requests
 
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
-        "CONFIG": {
-            "hosts": [("127.0.0.1", 6379)],
+# Redis used by the realtime app (waiting lobby for matchmaking)
+REDIS_URL = os.environ.get("REDIS_URL", "redis://127.0.0.1:6379/0")
+REDIS_MAX_CONNECTIONS = 100  # Connections shared by all the websocket consumers of one process
+
+# Waiting lobby and channel layer of the realtime app
+# REALTIME_BACKEND=memory keeps both in the process: a single Daphne process, no Redis needed
+# REDIS_SHARD_URLS (comma separated) spreads the lobby and the channel layer over many Redis hosts
+REALTIME_BACKEND = os.environ.get("REALTIME_BACKEND", "redis")
+REDIS_SHARD_URLS = [url for url in os.environ.get("REDIS_SHARD_URLS", "").split(",") if url]
+if REALTIME_BACKEND == "memory":
+    REALTIME_LOBBY = {
+        "BACKEND": "realtime.memory_lobby.InMemoryLobby",
+    }
+elif REDIS_SHARD_URLS:
+    REALTIME_LOBBY = {
+        "BACKEND": "realtime.sharded_lobby.ShardedLobby",
+        "OPTIONS": {
+            "urls": REDIS_SHARD_URLS,
+            "max_connections": REDIS_MAX_CONNECTIONS,
         },
-    },
+    }
+else:
+    REALTIME_LOBBY = {
+        "BACKEND": "realtime.lobby.RedisLobby",
+        "OPTIONS": {
+            "url": REDIS_URL,
+            "max_connections": REDIS_MAX_CONNECTIONS,
+        },
+    }
+
+# Matchmaking of the waiting lobby
+# "inline": users are matched in connect(), "tick": `python manage.py run_matcher` pairs them in bulk
+REALTIME_MATCHER = {
+    "MODE": "inline",
+    "TICK_MS": 100,
+    "BATCH_SIZE": 500,
+    "REPORT_INTERVAL": 60,
+    "STEAL_TICK_MS": 1000,
+}
+
+# Trickle ICE candidates following the first one of a burst are sent to the peer
+# as one batch after this many milliseconds, 0 turns the batching off
+REALTIME_ICE_BATCH_MS = 0
+
+# Signals a websocket client can send: signal_type -> (signals per second, burst)
+# Unlisted signal types use the defaults of realtime.throttling
+REALTIME_SIGNAL_RATES = {
+    "offer": (1, 5),
+    "answer": (1, 5),
+    "ice_candidate_user1": (20, 60),
+    "ice_candidate_user2": (20, 60),
+}
+# Connections are closed after this many dropped (unknown / rate limited) signals
+# within REALTIME_DROPPED_SIGNALS_WINDOW seconds, so only sustained flooding closes them
+REALTIME_MAX_DROPPED_SIGNALS = 50
+REALTIME_DROPPED_SIGNALS_WINDOW = 60
+
+# Admission control of the websockets and queue position updates (realtime.admission)
+REALTIME_ADMISSION = {
+    "MAX_CONNECTIONS": 5000,
+    "MAX_LOBBY_SIZE": 50000,
+    "RETRY_AFTER": 10,
+    "STATUS_INTERVAL": 2,
+}
+
+# Users who met are not matched again within WINDOW seconds, blocked users within BLOCK_TTL
+REALTIME_RECENT_PARTNERS = {
+    "WINDOW": 60 * 60,
+    "MAX_PARTNERS": 100,
+    "BLOCK_TTL": 30 * 24 * 60 * 60,
+}
+
+# Websockets of a worker stopped with SIGTERM are told to reconnect within RECONNECT_SPREAD seconds,
+# the worker waits at most TIMEOUT seconds for them to be gone (realtime.drain)
+REALTIME_DRAIN = {
+    "TIMEOUT": 20,
+    "RECONNECT_SPREAD": 10,
+    "RESUME_MAX_AGE": 120,
+}
+
+# In-call chat, messages are saved in bulk every BATCH_SIZE messages or FLUSH_MS (realtime.chat)
+REALTIME_CHAT = {
+    "MAX_LENGTH": 1000,
+    "BATCH_SIZE": 100,
+    "FLUSH_MS": 500,
+    "HISTORY_SIZE": 50,
+}
+
+# Prometheus metrics of every Daphne process, served on PATH to the ALLOWED_IPS (realtime.exposition)
+REALTIME_METRICS = {
+    "PATH": "/metrics",
+    "ALLOWED_IPS": ["127.0.0.1", "::1"],
 }
 
+if REALTIME_BACKEND == "memory":
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                # channels_redis spreads the channels over the hosts by the hash of their name
+                "hosts": REDIS_SHARD_URLS or [REDIS_URL],
+            },
+        },
+    }
+
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
@@ -120,10 +224,73 @@ AUTH_PASSWORD_VALIDATORS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # simplejwt's JWTAuthentication, timed for the Server-Timing header
+        'utilities.server_timing.TimedJWTAuthentication',
     )
 }
 
+# Thread pool hashing the passwords of the async account views (accounts.hashing)
+# and the hasher of the passwords (accounts.hashers), pick its cost with
+# python manage.py benchmark_password_hasher
+PASSWORD_HASHING = {
+    "WORKERS": 4,  # Threads hashing at once
+    "MAX_QUEUE": 64,  # Hashings waiting for a thread, the next requests get a 503
+
+    "ALGORITHM": os.environ.get("PASSWORD_HASHER", "pbkdf2"),  # "pbkdf2", "scrypt" or "argon2" (needs argon2-cffi)
+    "PBKDF2_ITERATIONS": 870000,
+    "SCRYPT_WORK_FACTOR": 2 ** 14,
+    "SCRYPT_BLOCK_SIZE": 8,
+    "SCRYPT_PARALLELISM": 1,
+    "ARGON2_TIME_COST": 2,
+    "ARGON2_MEMORY_COST": 102400,  # KiB
+    "ARGON2_PARALLELISM": 8,
+}
+
+# The hasher of the algorithm hashes the new passwords, the others verify the
+# hashes made before a change and get replaced on the next login
+_PASSWORD_HASHERS = {
+    "pbkdf2": "accounts.hashers.PBKDF2PasswordHasher",
+    "scrypt": "accounts.hashers.ScryptPasswordHasher",
+    "argon2": "accounts.hashers.Argon2PasswordHasher",
+}
+PASSWORD_HASHERS = [_PASSWORD_HASHERS[PASSWORD_HASHING["ALGORITHM"]]] + [
+    path for algorithm, path in _PASSWORD_HASHERS.items() if algorithm != PASSWORD_HASHING["ALGORITHM"]
+]
+
+# Sliding window rate limits of the login and sign-up (utilities.rate_limit)
+# scope -> {"ip" or field of the body: (requests, window in seconds)}
+RATE_LIMIT = {
+    "BACKEND": (
+        "utilities.rate_limit.InMemoryRateLimiter" if REALTIME_BACKEND == "memory"
+        else "utilities.rate_limit.RedisRateLimiter"
+    ),
+    "OPTIONS": {} if REALTIME_BACKEND == "memory" else {"url": REDIS_URL},
+    "SCOPES": {
+        "login": {"ip": (20, 60), "username": (5, 60)},
+        "sign_up": {"ip": (5, 600)},
+        "availability": {"ip": (120, 60)},  # Checked on every keystroke of the sign-up form
+    },
+}
+
+# Counting Bloom filter of the usernames and emails taken (accounts.availability)
+# The Redis one is built with `python manage.py rebuild_availability_filter`
+AVAILABILITY_FILTER = {
+    "BACKEND": (
+        "accounts.availability.InMemoryAvailabilityFilter" if REALTIME_BACKEND == "memory"
+        else "accounts.availability.RedisAvailabilityFilter"
+    ),
+    "OPTIONS": {} if REALTIME_BACKEND == "memory" else {"url": REDIS_URL},
+    "CAPACITY": 1000000,  # Usernames + emails
+    "ERROR_RATE": 0.01,
+}
+
+# Adds the Server-Timing header (auth, validation, db, serialization, total) to every response
+SERVER_TIMING = os.environ.get("SERVER_TIMING") == "1"
+
+# Artificial delay of every API response, for trying the loading states of the frontend
+# Only used when DEBUG is on
+RESPONSE_DELAY_SECONDS = 0
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/5.1/topics/i18n/
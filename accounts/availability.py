@@ -0,0 +1,365 @@
+"""
+Availability of the usernames and emails without a query for every keystroke.
+
+The usernames and emails taken are kept in a counting Bloom filter: every
+value sets (increments) k counters picked by its hash. When one of the
+counters of a value is 0 the value was never added, it is available and the
+database is not asked. When all of them are set the value is probably taken
+and the database gives the answer (a false positive costs the query the
+availability check made before, ERROR_RATE of the free values pay it).
+
+The counters (not single bits) let a value be removed again when a user is
+deleted or changes its username (accounts.signals), so the filter does not
+fill up with values free again.
+
+The backend is picked with AVAILABILITY_FILTER["BACKEND"] in the settings:
+    - accounts.availability.RedisAvailabilityFilter keeps the counters in one
+      Redis string shared by every process, 4 bits per counter, read and
+      written with BITFIELD (one round trip per check). It has to be built
+      once with `python manage.py rebuild_availability_filter`, the database
+      answers every check until then.
+    - accounts.availability.InMemoryAvailabilityFilter keeps them in the
+      process and builds itself from the database on its first check, it only
+      sees the changes made by its own process.
+
+How to use:
+    - await is_taken("username", username) asks the database only when the filter says "maybe"
+    - await get_availability_filter().might_contain("username", username),
+      False means the username is free for sure
+    - get_availability_filter().add("username", username) / .remove(...) when it gets taken / freed
+"""
+
+import asyncio
+import hashlib
+import math
+import threading
+from functools import cache
+
+import redis
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.utils.module_loading import import_string
+from redis import asyncio as aioredis
+
+from realtime.metrics import Counter, register
+
+AVAILABILITY_FILTER_KEY = 'availability_filter'  # String: 4 bit counters of the counting Bloom filter
+# Next to the filter key, while a rebuild runs:
+#   <key>:building   String: the filter being built
+#   <key>:rebuilding String: set while the rebuild reads the database, the changes are logged meanwhile
+#   <key>:changes    List: "increment,position,position..." of every change made meanwhile
+
+# Seconds the rebuilding marker outlives a rebuild which died half way
+REBUILD_TIMEOUT = 60 * 60
+
+# Adds `increment` (1 or -1) to the counters of a value. A counter is never
+# incremented past 15, nor decremented at 15 (saturated) or at 0.
+APPLY_CHANGE_LUA = """
+local function apply_change(key, change)
+    local increment = tonumber(change[1])
+    for index = 2, #change do
+        local offset = '#' .. change[index]
+        local count = redis.call('BITFIELD', key, 'GET', 'u4', offset)[1]
+        if increment > 0 and count < 15 or increment < 0 and count > 0 and count < 15 then
+            redis.call('BITFIELD', key, 'SET', 'u4', offset, count + increment)
+        end
+    end
+end
+"""
+
+# Changes the counters of a value in the filter, if it is built, and logs the
+# change while a rebuild runs.
+#   KEYS: filter, rebuilding marker, changes log
+#   ARGV: increment, positions...
+CHANGE_SCRIPT = APPLY_CHANGE_LUA + """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('RPUSH', KEYS[3], table.concat(ARGV, ','))
+end
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    apply_change(KEYS[1], ARGV)
+end
+return 1
+"""
+
+# Replays the changes logged during the rebuild on the built filter and puts
+# it in place of the filter, in one step so no change is lost in between.
+#   KEYS: filter, building filter, rebuilding marker, changes log
+SWAP_SCRIPT = APPLY_CHANGE_LUA + """
+for _, entry in ipairs(redis.call('LRANGE', KEYS[4], 0, -1)) do
+    local change = {}
+    for value in string.gmatch(entry, '[^,]+') do
+        table.insert(change, value)
+    end
+    apply_change(KEYS[2], change)
+end
+redis.call('RENAME', KEYS[2], KEYS[1])
+redis.call('DEL', KEYS[3], KEYS[4])
+return 1
+"""
+
+# Fields of the user kept in the filter
+FIELDS = ("username", "email")
+
+# Availability checks, per what answered them ("filter" or "database")
+AVAILABILITY_CHECKS = register(
+    "accounts_availability_checks_total",
+    "Username and email availability checks, per what answered them.",
+    Counter(),
+    label="answered_by",
+)
+
+DEFAULT_AVAILABILITY_FILTER_SETTINGS = {
+    "CAPACITY": 1000000,  # Values (usernames + emails) the filter is sized for
+    "ERROR_RATE": 0.01,  # Free values answered "maybe taken" (and checked in the database) at CAPACITY
+}
+
+
+def get_availability_filter_settings():
+    """
+    Returns the AVAILABILITY_FILTER settings merged over the defaults, the Redis filter on REDIS_URL when not set.
+    """
+    return {
+        "BACKEND": "accounts.availability.RedisAvailabilityFilter",
+        "OPTIONS": {"url": settings.REDIS_URL},
+        **DEFAULT_AVAILABILITY_FILTER_SETTINGS,
+        **getattr(settings, "AVAILABILITY_FILTER", {}),
+    }
+
+
+def get_filter_size(capacity, error_rate):
+    """
+    Returns the number of counters and of hashes of a Bloom filter holding `capacity` values at `error_rate`.
+    """
+    size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    hashes = max(1, round(size / capacity * math.log(2)))
+    return size, hashes
+
+
+class BaseAvailabilityFilter:
+    """
+    Interface of the availability filter backends.
+    """
+
+    # Highest value of a counter, a counter this high is never decremented again
+    # (the values hashed on it are too many to know whether it can go down)
+    MAX_COUNT = 15
+
+    def __init__(self, capacity=None, error_rate=None):
+        filter_settings = get_availability_filter_settings()
+        self.size, self.hashes = get_filter_size(
+            capacity or filter_settings["CAPACITY"],
+            error_rate or filter_settings["ERROR_RATE"],
+        )
+
+    def positions(self, field, value):
+        """
+        Returns the counters of the value (double hashing of one blake2b digest).
+        """
+        digest = hashlib.blake2b(f"{field}:{value}".encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big") | 1
+        return [(first + index * second) % self.size for index in range(self.hashes)]
+
+    async def might_contain(self, field, value):
+        """
+        Returns False when the value is free for sure, True when it may be taken.
+        """
+        raise NotImplementedError
+
+    def add(self, field, value):
+        raise NotImplementedError
+
+    def remove(self, field, value):
+        raise NotImplementedError
+
+    def rebuild(self):
+        """
+        Builds the filter again from every user of the database.
+        """
+        raise NotImplementedError
+
+    def count_users(self, counters):
+        """
+        Increments `counters` (bytearray) for the fields of every user, returns the number of users.
+        """
+        users = 0
+        for user_values in get_user_model()._default_manager.values_list(*FIELDS).iterator(chunk_size=5000):
+            users += 1
+            for field, value in zip(FIELDS, user_values):
+                if value:
+                    for position in self.positions(field, value):
+                        counters[position] = min(self.MAX_COUNT, counters[position] + 1)
+        return users
+
+
+class InMemoryAvailabilityFilter(BaseAvailabilityFilter):
+    """
+    Counters of the process, one byte each.
+    """
+
+    def __init__(self, capacity=None, error_rate=None):
+        super().__init__(capacity, error_rate)
+        self.counters = None  # Built on the first check
+        self.loading = None
+        # Changes made while a build reads the database, (increment, field, value), replayed on the built counters
+        self.changes = None
+        # The build runs in a thread, the signals of the other threads change the counters meanwhile
+        self.lock = threading.Lock()
+
+    async def might_contain(self, field, value):
+        if self.counters is None:
+            # The database answers until the filter is built
+            if self.loading is None:
+                self.loading = asyncio.create_task(self.load())
+            return True
+
+        counters = self.counters
+        return all(counters[position] for position in self.positions(field, value))
+
+    async def load(self):
+        try:
+            # Off the shared sync thread, the whole users table is read
+            users = await database_sync_to_async(self.rebuild, thread_sensitive=False)()
+            print(f"Availability filter built with {users} users")
+        except Exception as e:
+            # Tried again on the next check, the database answers meanwhile
+            print("!!! Got Error building the availability filter !!!", e)
+            self.loading = None
+
+    def add(self, field, value):
+        self.change(1, field, value)
+
+    def remove(self, field, value):
+        self.change(-1, field, value)
+
+    def change(self, increment, field, value):
+        with self.lock:
+            if self.changes is not None:
+                # The build may have read the user already
+                self.changes.append((increment, field, value))
+            if self.counters is not None:
+                self.apply_change(self.counters, increment, field, value)
+            # Not built nor building, the build reads it from the database
+
+    def apply_change(self, counters, increment, field, value):
+        for position in self.positions(field, value):
+            if increment > 0:
+                counters[position] = min(self.MAX_COUNT, counters[position] + 1)
+            elif 0 < counters[position] < self.MAX_COUNT:
+                counters[position] -= 1
+
+    def rebuild(self):
+        with self.lock:
+            self.changes = []
+
+        counters = bytearray(self.size)
+        try:
+            users = self.count_users(counters)
+        except Exception:
+            with self.lock:
+                self.changes = None
+            raise
+
+        with self.lock:
+            for change in self.changes:
+                self.apply_change(counters, *change)
+            self.changes = None
+            self.counters = counters
+        return users
+
+
+class RedisAvailabilityFilter(BaseAvailabilityFilter):
+    """
+    Counters in one Redis string, 4 bits each (BITFIELD u4).
+
+    The checks use the async client, the changes come from the model signals
+    and the management command, which run in sync code, and use the sync one.
+    """
+
+    def __init__(self, url, capacity=None, error_rate=None, key=AVAILABILITY_FILTER_KEY, socket_timeout=0.25):
+        super().__init__(capacity, error_rate)
+        self.key = key
+        # Short timeouts, the database answers the checks while Redis is unreachable
+        self.client = aioredis.Redis.from_url(url, socket_timeout=socket_timeout, socket_connect_timeout=socket_timeout)
+        self.sync_client = redis.Redis.from_url(url, socket_timeout=socket_timeout, socket_connect_timeout=socket_timeout)
+        self.change_script = self.sync_client.register_script(CHANGE_SCRIPT)
+        self.swap_script = self.sync_client.register_script(SWAP_SCRIPT)
+        self.building_key = f"{key}:building"
+        self.rebuilding_key = f"{key}:rebuilding"
+        self.changes_key = f"{key}:changes"
+
+    async def might_contain(self, field, value):
+        arguments = []
+        for position in self.positions(field, value):
+            arguments.extend(("GET", "u4", f"#{position}"))
+
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                pipe.exists(self.key)
+                pipe.execute_command("BITFIELD", self.key, *arguments)
+                built, counters = await pipe.execute()
+        except (aioredis.ConnectionError, aioredis.TimeoutError) as e:
+            print("!!! Got Error reading the availability filter !!!", e)
+            return True
+
+        # Not built yet (rebuild_availability_filter), the database answers
+        return not built or all(counters)
+
+    def change(self, field, value, increment):
+        try:
+            self.change_script(
+                keys=[self.key, self.rebuilding_key, self.changes_key],
+                args=[increment, *self.positions(field, value)],
+            )
+        except redis.RedisError as e:
+            # A missed value only costs a query (or a "maybe taken") until the next rebuild
+            print("!!! Got Error updating the availability filter !!!", e)
+
+    def add(self, field, value):
+        self.change(field, value, 1)
+
+    def remove(self, field, value):
+        # Saturated counters (MAX_COUNT) are left as they are by the script
+        self.change(field, value, -1)
+
+    def rebuild(self):
+        # The changes made from now on are logged, the database read below may miss them
+        self.sync_client.delete(self.changes_key)
+        self.sync_client.set(self.rebuilding_key, 1, ex=REBUILD_TIMEOUT)
+
+        counters = bytearray(self.size + self.size % 2)
+        users = self.count_users(counters)
+
+        # Two counters per byte, the first one in the high bits like BITFIELD u4
+        data = bytes(high << 4 | low for high, low in zip(counters[0::2], counters[1::2]))
+
+        # Written next to the filter, then the logged changes are replayed on it and it is
+        # renamed over the filter in one script: the checks never see it half built
+        self.sync_client.set(self.building_key, data)
+        self.swap_script(keys=[self.key, self.building_key, self.rebuilding_key, self.changes_key])
+        return users
+
+
+@cache
+def get_availability_filter():
+    """
+    Returns the availability filter shared by the whole process.
+    """
+    filter_settings = get_availability_filter_settings()
+    return import_string(filter_settings["BACKEND"])(
+        capacity=filter_settings["CAPACITY"],
+        error_rate=filter_settings["ERROR_RATE"],
+        **filter_settings["OPTIONS"],
+    )
+
+
+async def is_taken(field, value):
+    """
+    Returns True when a user has the value (username or email), the database is only asked when the filter may have it.
+    """
+    if not await get_availability_filter().might_contain(field, value):
+        AVAILABILITY_CHECKS.inc("filter")
+        return False
+
+    AVAILABILITY_CHECKS.inc("database")
+    return await get_user_model()._default_manager.filter(**{field: value}).aexists()
@@ -0,0 +1,77 @@
+"""
+Password hashers with their cost taken from settings.PASSWORD_HASHING.
+
+Django's hashers have their cost (iterations, memory...) in class attributes,
+these read it from the settings so it can be tuned per deployment without
+code. Their algorithm names are Django's own ("pbkdf2_sha256", "scrypt",
+"argon2"), the hashes already stored stay valid.
+
+settings.PASSWORD_HASHERS lists the hasher of PASSWORD_HASHING["ALGORITHM"]
+first and the others after it, to verify the hashes made with them. A
+stored hash made with another algorithm or another cost is hashed again
+with the current ones on the next successful login
+(accounts.hashing.check_user_password), so changing the settings upgrades
+the users as they log in.
+
+Argon2 needs the argon2-cffi package (pip install argon2-cffi).
+
+How to use:
+    - PASSWORD_HASHING = {"ALGORITHM": "scrypt", "SCRYPT_WORK_FACTOR": 2 ** 15, ...} in the settings
+      (or the PASSWORD_HASHER environment variable for the algorithm)
+    - python manage.py benchmark_password_hasher --target-ms 250 to pick the cost
+"""
+
+from django.contrib.auth import hashers
+
+from .hashing import get_password_hashing_settings
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    """
+    PBKDF2-SHA256 with PASSWORD_HASHING["PBKDF2_ITERATIONS"] iterations.
+    """
+
+    @property
+    def iterations(self):
+        return get_password_hashing_settings()["PBKDF2_ITERATIONS"]
+
+
+class ScryptPasswordHasher(hashers.ScryptPasswordHasher):
+    """
+    scrypt with PASSWORD_HASHING["SCRYPT_WORK_FACTOR"], ["SCRYPT_BLOCK_SIZE"] and ["SCRYPT_PARALLELISM"].
+    """
+
+    @property
+    def work_factor(self):
+        return get_password_hashing_settings()["SCRYPT_WORK_FACTOR"]
+
+    @property
+    def block_size(self):
+        return get_password_hashing_settings()["SCRYPT_BLOCK_SIZE"]
+
+    @property
+    def parallelism(self):
+        return get_password_hashing_settings()["SCRYPT_PARALLELISM"]
+
+    @property
+    def maxmem(self):
+        # Memory needed by scrypt (128 * N * r * p bytes) with some room, OpenSSL refuses above its 32 MB default
+        return 2 * 128 * self.work_factor * self.block_size * self.parallelism
+
+
+class Argon2PasswordHasher(hashers.Argon2PasswordHasher):
+    """
+    Argon2id with PASSWORD_HASHING["ARGON2_TIME_COST"], ["ARGON2_MEMORY_COST"] (KiB) and ["ARGON2_PARALLELISM"].
+    """
+
+    @property
+    def time_cost(self):
+        return get_password_hashing_settings()["ARGON2_TIME_COST"]
+
+    @property
+    def memory_cost(self):
+        return get_password_hashing_settings()["ARGON2_MEMORY_COST"]
+
+    @property
+    def parallelism(self):
+        return get_password_hashing_settings()["ARGON2_PARALLELISM"]
@@ -0,0 +1,209 @@
+"""
+Password hashing off the event loop.
+
+Hashing a password (PBKDF2) is CPU work taking hundreds of milliseconds. Under
+Daphne the sync views run it in the one thread Django gives to sync code, so
+a burst of logins queues behind itself and the websockets of the process
+wait with it. The async account views hand the hashing to this pool instead:
+a bounded number of worker threads (hashlib releases the GIL while hashing)
+and a bounded queue in front of them. When the queue is full the request is
+refused with PasswordHashingBusy right away rather than waiting for seconds.
+
+The depth of the queue and the time spent waiting in it are exposed with the
+realtime metrics (realtime.exposition).
+
+How to use:
+    - user = await authenticate_user(username, password)
+    - if await check_user_password(user, password): ...
+    - await set_user_password(user, new_password), then await user.asave()
+    - await hash_password(password) for a user not created yet
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import check_password, make_password
+
+from realtime.metrics import Counter, Gauge, Histogram, register
+
+DEFAULT_PASSWORD_HASHING_SETTINGS = {
+    "WORKERS": 4,  # Threads hashing passwords, about the number of CPU cores left to Daphne
+    "MAX_QUEUE": 64,  # Hashings waiting for a thread at most, the next ones are refused
+
+    # Hasher of the new passwords and its cost (accounts.hashers), the defaults are Django's
+    "ALGORITHM": "pbkdf2",  # "pbkdf2", "scrypt" or "argon2"
+    "PBKDF2_ITERATIONS": 870000,
+    "SCRYPT_WORK_FACTOR": 2 ** 14,
+    "SCRYPT_BLOCK_SIZE": 8,
+    "SCRYPT_PARALLELISM": 1,
+    "ARGON2_TIME_COST": 2,
+    "ARGON2_MEMORY_COST": 102400,  # KiB
+    "ARGON2_PARALLELISM": 8,
+}
+
+# Hashings waiting for a free thread
+HASHING_QUEUE_DEPTH = register(
+    "accounts_password_hashing_queue_depth",
+    "Password hashings waiting for a thread of the pool.",
+    Gauge(),
+)
+
+# Time a hashing waited for a thread
+HASHING_QUEUE_WAIT = register(
+    "accounts_password_hashing_queue_wait_milliseconds",
+    "Time a password hashing waited for a thread of the pool.",
+    Histogram(),
+)
+
+# Time of the hashing itself
+HASHING_DURATION = register(
+    "accounts_password_hashing_milliseconds",
+    "Time spent hashing one password.",
+    Histogram(),
+)
+
+# Stored hashes upgraded to the current hasher on login, per algorithm they were made with
+PASSWORD_REHASHES = register(
+    "accounts_password_rehashes_total",
+    "Stored password hashes made again with the current hasher on login.",
+    Counter(),
+    label="from_algorithm",
+)
+
+
+def get_password_hashing_settings():
+    """
+    Returns the PASSWORD_HASHING settings merged over the defaults.
+    """
+    return {**DEFAULT_PASSWORD_HASHING_SETTINGS, **getattr(settings, "PASSWORD_HASHING", {})}
+
+
+class PasswordHashingBusy(Exception):
+    """
+    Raised when the queue of the hashing pool is full.
+    """
+
+
+class HashingPool:
+    """
+    Bounded thread pool running the password hashing of the process.
+    """
+
+    def __init__(self):
+        self.executor = None
+        self.workers = 0
+        # Hashings submitted and not finished yet, the ones beyond `workers` are waiting
+        self.in_flight = 0
+
+    def update_queue_depth(self):
+        HASHING_QUEUE_DEPTH.set(max(0, self.in_flight - self.workers))
+
+    async def run(self, function, *args):
+        """
+        Runs function(*args) in a thread of the pool and returns its result.
+        """
+        hashing_settings = get_password_hashing_settings()
+        if self.executor is None:
+            self.workers = hashing_settings["WORKERS"]
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hashing")
+
+        if self.in_flight - self.workers >= hashing_settings["MAX_QUEUE"]:
+            raise PasswordHashingBusy
+
+        submitted_at = time.perf_counter()
+
+        def timed_function():
+            started_at = time.perf_counter()
+            result = function(*args)
+            return result, started_at, time.perf_counter()
+
+        self.in_flight += 1
+        self.update_queue_depth()
+        try:
+            loop = asyncio.get_running_loop()
+            result, started_at, finished_at = await loop.run_in_executor(self.executor, timed_function)
+        finally:
+            self.in_flight -= 1
+            self.update_queue_depth()
+
+        HASHING_QUEUE_WAIT.observe((started_at - submitted_at) * 1000)
+        HASHING_DURATION.observe((finished_at - started_at) * 1000)
+        return result
+
+
+# Hashing pool of the process
+hashing_pool = HashingPool()
+
+
+async def hash_password(raw_password):
+    """
+    Returns the encoded password, hashed in the pool.
+    """
+    return await hashing_pool.run(make_password, raw_password)
+
+
+async def set_user_password(user, raw_password):
+    """
+    Async user.set_password(), the user still has to be saved.
+    """
+    user.password = await hash_password(raw_password)
+    user._password = raw_password
+
+
+async def check_user_password(user, raw_password):
+    """
+    Async user.check_password(), returns True when the password matches.
+
+    Like Django, a password stored with another hasher or another cost than
+    the current ones (accounts.hashers) is hashed again and saved, which is
+    how the users get upgraded when the hasher settings change.
+
+    The upgrade is best effort: it is skipped while every thread of the pool
+    is busy (the next login upgrades the user) and never fails the login.
+    PasswordHashingBusy is only raised when the check itself can not be queued.
+    """
+    must_update = []
+
+    def setter(raw_password):
+        # Called from the thread of the pool, the hash and the save are done back on the event loop
+        must_update.append(True)
+
+    matches = await hashing_pool.run(check_password, raw_password, user.password, setter)
+    if matches and must_update and hashing_pool.in_flight < hashing_pool.workers:
+        from_algorithm = user.password.split("$", 1)[0]
+        try:
+            await set_user_password(user, raw_password)
+            await user.asave(update_fields=["password"])
+        except PasswordHashingBusy:
+            # Other hashings took the free threads meanwhile
+            return matches
+        except Exception as e:
+            print("!!! Got Error upgrading the password hash !!!", e)
+            return matches
+        PASSWORD_REHASHES.inc(from_algorithm)
+    return matches
+
+
+async def authenticate_user(username, password):
+    """
+    Async authenticate() for the username and password, returns the user or None.
+
+    Does what django.contrib.auth.backends.ModelBackend does (the only
+    authentication backend of the project) with the async ORM and the pool.
+    """
+    if username is None or password is None:
+        return None
+
+    User = get_user_model()
+    user = await User._default_manager.filter(**{User.USERNAME_FIELD: username}).afirst()
+    if user is None:
+        # Hashing anyway so an unknown username takes as long as a wrong password
+        await hash_password(password)
+        return None
+
+    if await check_user_password(user, password) and user.is_active:
+        return user
+    return None
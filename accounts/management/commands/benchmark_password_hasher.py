@@ -0,0 +1,139 @@
+import os
+import statistics
+import time
+
+from django.contrib.auth import hashers
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.hashing import get_password_hashing_settings
+
+# Password hashed by the benchmark
+BENCHMARK_PASSWORD = "Benchmark-Passw0rd!"
+
+# Lowest costs worth using (OWASP password storage cheat sheet), below them more CPU is the answer, not a cheaper hash
+MINIMUM_COSTS = {
+    "pbkdf2": 600000,
+    "scrypt": 2 ** 14,
+    "argon2": 2,
+}
+
+
+def make_hasher(algorithm, cost, hashing_settings):
+    """
+    Returns the Django hasher of the algorithm with the given cost (iterations, work factor or time cost).
+    """
+    if algorithm == "pbkdf2":
+        hasher = hashers.PBKDF2PasswordHasher()
+        hasher.iterations = cost
+    elif algorithm == "scrypt":
+        hasher = hashers.ScryptPasswordHasher()
+        hasher.work_factor = cost
+        hasher.block_size = hashing_settings["SCRYPT_BLOCK_SIZE"]
+        hasher.parallelism = hashing_settings["SCRYPT_PARALLELISM"]
+        hasher.maxmem = 2 * 128 * cost * hasher.block_size * hasher.parallelism
+    else:
+        hasher = hashers.Argon2PasswordHasher()
+        hasher.time_cost = cost
+        hasher.memory_cost = hashing_settings["ARGON2_MEMORY_COST"]
+        hasher.parallelism = hashing_settings["ARGON2_PARALLELISM"]
+    return hasher
+
+
+def measure(hasher, rounds):
+    """
+    Returns the median milliseconds of hashing the benchmark password once.
+    """
+    durations = []
+    for _ in range(rounds):
+        salt = hasher.salt()
+        started = time.perf_counter()
+        hasher.encode(BENCHMARK_PASSWORD, salt)
+        durations.append((time.perf_counter() - started) * 1000)
+    return statistics.median(durations)
+
+
+def recommend_cost(algorithm, cost, milliseconds, target_ms):
+    """
+    Returns the highest cost estimated to hash within target_ms, the time grows linearly with every cost.
+    """
+    estimate = cost * target_ms / milliseconds
+    if algorithm == "pbkdf2":
+        return max(1000, int(estimate // 1000 * 1000))
+    if algorithm == "scrypt":
+        # The work factor has to be a power of 2
+        work_factor = 2
+        while work_factor * 2 <= estimate:
+            work_factor *= 2
+        return work_factor
+    return max(1, int(estimate))
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the cost of the password hasher on this machine and recommends its "
+        "PASSWORD_HASHING cost for a target login latency or logins per second per core."
+    )
+
+    # Setting holding the scaled cost of every algorithm
+    COST_SETTINGS = {
+        "pbkdf2": "PBKDF2_ITERATIONS",
+        "scrypt": "SCRYPT_WORK_FACTOR",
+        "argon2": "ARGON2_TIME_COST",
+    }
+
+    def add_arguments(self, parser):
+        hashing_settings = get_password_hashing_settings()
+
+        parser.add_argument("--algorithm", choices=list(self.COST_SETTINGS), default=hashing_settings["ALGORITHM"])
+        parser.add_argument("--target-ms", type=float, default=250, help="Time one login may spend hashing.")
+        parser.add_argument(
+            "--logins-per-second", type=float, default=None,
+            help="Logins one CPU core has to handle every second, lowers the target when needed.",
+        )
+        parser.add_argument("--rounds", type=int, default=5, help="Hashes measured per cost, the median is kept.")
+
+    def handle(self, *args, **options):
+        algorithm = options["algorithm"]
+        hashing_settings = get_password_hashing_settings()
+        cost_setting = self.COST_SETTINGS[algorithm]
+        cost = hashing_settings[cost_setting]
+
+        target_ms = options["target_ms"]
+        if options["logins_per_second"]:
+            target_ms = min(target_ms, 1000 / options["logins_per_second"])
+        if target_ms <= 0 or options["rounds"] < 1:
+            raise CommandError("The target and the rounds have to be positive.")
+
+        try:
+            current_ms = measure(make_hasher(algorithm, cost, hashing_settings), options["rounds"])
+        except ValueError as e:
+            # Argon2 without argon2-cffi, or a scrypt cost OpenSSL refuses
+            raise CommandError(f"Cannot hash with {algorithm}: {e}")
+
+        self.stdout.write(f"Current {algorithm} cost {cost_setting}={cost}: {current_ms:.1f} ms per hash")
+        self.report(current_ms, hashing_settings)
+
+        recommended = recommend_cost(algorithm, cost, current_ms, target_ms)
+        recommended_ms = measure(make_hasher(algorithm, recommended, hashing_settings), options["rounds"])
+
+        self.stdout.write(f"\nRecommended for {target_ms:.0f} ms: {cost_setting}={recommended} ({recommended_ms:.1f} ms per hash)")
+        self.report(recommended_ms, hashing_settings)
+
+        if recommended < MINIMUM_COSTS[algorithm]:
+            self.stdout.write(self.style.WARNING(
+                f"{cost_setting}={recommended} is below the minimum of {MINIMUM_COSTS[algorithm]} for {algorithm}, "
+                "give the logins more CPU instead of lowering the cost."
+            ))
+        if algorithm == "argon2" and recommended_ms > target_ms:
+            self.stdout.write(self.style.WARNING(
+                "One pass is over the target, lower ARGON2_MEMORY_COST to go faster."
+            ))
+
+        self.stdout.write(f'\nPASSWORD_HASHING = {{..., "ALGORITHM": "{algorithm}", "{cost_setting}": {recommended}}}')
+        self.stdout.write("Stored hashes are upgraded to the new cost on the next login of each user.")
+
+    def report(self, milliseconds, hashing_settings):
+        # Hashing takes a whole core, the pool runs at most WORKERS at once
+        per_core = 1000 / milliseconds
+        cores = min(hashing_settings["WORKERS"], os.cpu_count() or 1)
+        self.stdout.write(f"    {per_core:.1f} logins/s per core, {per_core * cores:.1f} logins/s per process ({cores} hashing threads)")
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.availability import get_availability_filter
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds the availability filter of the usernames and emails again from the database. "
+        "Run it once after deploying the Redis filter, and whenever it may have missed changes "
+        "(users changed with update() or raw SQL, Redis flushed)."
+    )
+
+    def handle(self, *args, **options):
+        availability_filter = get_availability_filter()
+
+        started = time.perf_counter()
+        users = availability_filter.rebuild()
+
+        self.stdout.write(
+            f"Availability filter built with {users} users in {time.perf_counter() - started:.1f} s "
+            f"({availability_filter.size} counters, {availability_filter.hashes} hashes per value)"
+        )
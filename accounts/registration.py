@@ -10,7 +10,10 @@ If you have any questions while using this, ask him.
 
 
 from django.contrib.auth import get_user_model
+from django.db import IntegrityError
 from .validators import *
+from .hashing import hash_password
+from .availability import is_taken
 
 User = get_user_model()
 # This will be used to create a user model.
@@ -27,6 +30,7 @@ class CustomUserRegistration:
 
     Methods:
         1. register_user_if_valid(self, registration_data) -> bool
+           aregister_user_if_valid(self, registration_data), the same for the async views
         2. valid_password(self) -> bool
         3. user_doesnot_exist(self) -> bool
         4. get_full_name(self) -> str
@@ -84,6 +88,63 @@ class CustomUserRegistration:
         else:
             return False
 
+    async def aregister_user_if_valid(self, registration_data):
+        """
+        Async register_user_if_valid():
+            The existence checks use the availability filter (accounts.availability)
+            and the async ORM, and the password is hashed in
+            the hashing pool (accounts.hashing), so the event loop is never blocked.
+            PasswordHashingBusy is raised when the pool is full.
+        """
+        self.email = registration_data.get("email")
+        self.username = registration_data.get("username")
+
+        self.password = registration_data.get("password")
+        self.confirm_password = registration_data.get("confirm_password")
+
+        self.gender = registration_data.get("gender")
+
+        if not self.all_exists():
+            self.message_to_client = "All credentials were not provided"
+            return False
+
+        if not (self.valid_password() and self.valid_username(check_exists=False) and self.check_gender()):
+            return False
+
+        if await is_taken("username", self.username):
+            self.message_to_client = "Username already exists"
+            return False
+
+        if not await self.auser_doesnot_exist():
+            return False
+
+        encoded_password = await hash_password(self.password)
+        try:
+            # One insert, the password is hashed before instead of saving the user twice
+            created_user = await User.objects.acreate(
+                                username=self.username,
+                                email = self.email,
+                                gender = self.gender,
+                                password = encoded_password,
+                                )
+
+            self.message_to_client = "Your Account was created successfully"
+            self.success_status = True
+            return created_user
+
+        except IntegrityError:
+            # Taken after the checks above (another sign-up in between), or missed by the availability filter
+            if await User.objects.filter(username=self.username).aexists():
+                self.message_to_client = "Username already exists"
+            else:
+                self.message_to_client = "Sorry, this email already exists"
+            return False
+
+        except Exception as e:
+            print("Error happened when creating a new user:",e)
+            self.message_to_client = "Some error happened when creating your account."
+            return False
+
     # Checks if given passwords are same or not
     def valid_password(self) -> bool:
         
@@ -122,11 +183,21 @@ class CustomUserRegistration:
         
         return True
     
-    def valid_username(self) -> bool:
+    async def auser_doesnot_exist(self) -> bool:
+        """
+        Async user_doesnot_exist()
+        """
+        if await is_taken("email", self.email):
+            self.message_to_client = "Sorry, this email already exists"
+            return False
+
+        return True
+
+    def valid_username(self, check_exists=True) -> bool:
         """
         Checks if username is valid or not using the validate_username() function
         """
-        validated_data = validate_username(self.username)
+        validated_data = validate_username(self.username, check_exists)
 
         if validated_data["is_valid"]:
             return True
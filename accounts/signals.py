@@ -0,0 +1,56 @@
+"""
+Keeps the availability filter (accounts.availability) in step with the users.
+
+The values of a user are remembered when it is loaded, so a saved change of
+username or email frees the old value in the filter and takes the new one.
+
+How to use:
+    Connected by AccountsConfig.ready(), nothing to call.
+"""
+
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .availability import FIELDS, get_availability_filter
+
+User = get_user_model()
+
+
+def get_values(user):
+    # Read from __dict__, a deferred field must not cost a query here
+    return {field: user.__dict__.get(field) for field in FIELDS}
+
+
+@receiver(post_init, sender=User)
+def remember_values(sender, instance, **kwargs):
+    instance._availability_values = get_values(instance)
+
+
+@receiver(post_save, sender=User)
+def update_availability(sender, instance, created, update_fields=None, **kwargs):
+    availability_filter = get_availability_filter()
+    saved_values = instance._availability_values
+    values = get_values(instance)
+
+    for field in FIELDS:
+        if update_fields is not None and field not in update_fields:
+            continue
+
+        old_value, value = saved_values.get(field), values[field]
+        if not created and old_value == value:
+            continue
+
+        if old_value and not created:
+            availability_filter.remove(field, old_value)
+        if value:
+            availability_filter.add(field, value)
+        saved_values[field] = value
+
+
+@receiver(post_delete, sender=User)
+def free_availability(sender, instance, **kwargs):
+    availability_filter = get_availability_filter()
+    for field, value in instance._availability_values.items():
+        if value:
+            availability_filter.remove(field, value)
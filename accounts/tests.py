@@ -1,3 +1,294 @@
-from django.test import TestCase
+import asyncio
+import threading
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.http import HttpResponse
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from utilities.rate_limit import InMemoryRateLimiter, get_rate_limiter
+from utilities.server_timing import ServerTimingMiddleware, install_query_timer, timed
+
+from .availability import AVAILABILITY_CHECKS, InMemoryAvailabilityFilter, get_availability_filter, is_taken
+from .hashers import PBKDF2PasswordHasher, ScryptPasswordHasher
+from .hashing import (
+    HASHING_QUEUE_DEPTH, PASSWORD_REHASHES, HashingPool, PasswordHashingBusy, authenticate_user, check_user_password,
+    hash_password,
+)
+
+# The in-memory filter, no Redis needed
+MEMORY_AVAILABILITY_FILTER = {
+    "BACKEND": "accounts.availability.InMemoryAvailabilityFilter",
+    "OPTIONS": {},
+    "CAPACITY": 1000,
+}
+
+
+class InMemoryRateLimiterTests(SimpleTestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def make_request(self, ip="10.0.0.1", username="alice", **meta):
+        request = self.factory.post("/accounts/login/", REMOTE_ADDR=ip, **meta)
+        request.data = {"username": username}
+        return request
+
+    async def test_limits_per_ip_and_per_field(self):
+        limiter = InMemoryRateLimiter(scopes={"login": {"ip": (3, 60), "username": (2, 60)}})
+
+        self.assertEqual(await limiter.check("login", self.make_request()), 0)
+        self.assertEqual(await limiter.check("login", self.make_request()), 0)
+
+        # The username is full, whatever the IP
+        retry_after = await limiter.check("login", self.make_request(ip="10.0.0.2"))
+        self.assertTrue(0 < retry_after <= 60)
+
+        # The rejected request was not counted in the IP window
+        self.assertEqual(await limiter.check("login", self.make_request(username="bob")), 0)
+        self.assertTrue(await limiter.check("login", self.make_request(username="carol")))
+
+    async def test_window_slides(self):
+        limiter = InMemoryRateLimiter(scopes={"login": {"ip": (1, 60)}})
+
+        with mock.patch("utilities.rate_limit.time.monotonic", return_value=1000):
+            self.assertEqual(await limiter.check("login", self.make_request()), 0)
+            self.assertEqual(await limiter.check("login", self.make_request()), 60)
+
+        with mock.patch("utilities.rate_limit.time.monotonic", return_value=1060):
+            self.assertEqual(await limiter.check("login", self.make_request()), 0)
+
+    @override_settings(RATE_LIMIT={"TRUSTED_PROXY_HEADER": "HTTP_X_FORWARDED_FOR", "TRUSTED_PROXY_COUNT": 1})
+    async def test_client_ip_from_the_trusted_proxy(self):
+        limiter = InMemoryRateLimiter(scopes={"login": {"ip": (1, 60)}})
+
+        self.assertEqual(await limiter.check("login", self.make_request(HTTP_X_FORWARDED_FOR="1.1.1.1")), 0)
+        # Behind the same proxy, another client has its own window
+        self.assertEqual(await limiter.check("login", self.make_request(HTTP_X_FORWARDED_FOR="2.2.2.2")), 0)
+        # A forged address in front of the header does not give a new window
+        request = self.make_request(HTTP_X_FORWARDED_FOR="9.9.9.9, 1.1.1.1")
+        self.assertTrue(await limiter.check("login", request))
+
+
+@override_settings(RATE_LIMIT={
+    "BACKEND": "utilities.rate_limit.InMemoryRateLimiter",
+    "OPTIONS": {},
+    "SCOPES": {"login": {"ip": (1, 60)}},
+})
+class LoginRateLimitTests(TestCase):
+
+    def setUp(self):
+        get_rate_limiter.cache_clear()
+        self.addCleanup(get_rate_limiter.cache_clear)
+
+    async def test_too_many_attempts_are_rejected_before_authenticating(self):
+        data = {"username": "alice", "password": "wrong"}
+        self.assertNotEqual((await self.async_client.post("/account/login/", data)).status_code, 429)
+
+        with mock.patch("accounts.views.authenticate_user") as authenticate_user:
+            response = await self.async_client.post("/account/login/", data)
+
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(0 < int(response["Retry-After"]) <= 60)
+        authenticate_user.assert_not_called()
+
+
+@override_settings(AVAILABILITY_FILTER=MEMORY_AVAILABILITY_FILTER)
+class AvailabilityFilterTests(TestCase):
+
+    def setUp(self):
+        get_availability_filter.cache_clear()
+        self.addCleanup(get_availability_filter.cache_clear)
+
+    async def test_add_and_remove(self):
+        availability_filter = InMemoryAvailabilityFilter()
+        await sync_to_async(availability_filter.rebuild)()
+
+        self.assertFalse(await availability_filter.might_contain("username", "alice"))
+
+        availability_filter.add("username", "alice")
+        availability_filter.add("username", "bob")
+        self.assertTrue(await availability_filter.might_contain("username", "alice"))
+        self.assertFalse(await availability_filter.might_contain("email", "alice"))
+
+        availability_filter.remove("username", "alice")
+        self.assertFalse(await availability_filter.might_contain("username", "alice"))
+        self.assertTrue(await availability_filter.might_contain("username", "bob"))
+
+    async def test_saturated_counters_are_never_decremented(self):
+        availability_filter = InMemoryAvailabilityFilter()
+        await sync_to_async(availability_filter.rebuild)()
+
+        for _ in range(availability_filter.MAX_COUNT + 1):
+            availability_filter.add("username", "alice")
+        for _ in range(availability_filter.MAX_COUNT + 1):
+            availability_filter.remove("username", "alice")
+
+        self.assertTrue(await availability_filter.might_contain("username", "alice"))
+
+    def test_rebuild_reads_the_users(self):
+        get_user_model().objects.create(username="alice", email="alice@example.com")
+        availability_filter = InMemoryAvailabilityFilter()
+
+        self.assertEqual(availability_filter.rebuild(), 1)
+        positions = availability_filter.positions("username", "alice")
+        self.assertTrue(all(availability_filter.counters[position] for position in positions))
+
+    async def test_is_taken(self):
+        await get_user_model().objects.acreate(username="alice", email="alice@example.com")
+        await sync_to_async(get_availability_filter().rebuild)()
+        answered_by_filter = AVAILABILITY_CHECKS.values.get("filter", 0)
+
+        self.assertTrue(await is_taken("username", "alice"))
+        self.assertTrue(await is_taken("email", "alice@example.com"))
+        self.assertFalse(await is_taken("username", "bob"))
+        # Only the free value was answered without the database
+        self.assertEqual(AVAILABILITY_CHECKS.values["filter"], answered_by_filter + 1)
+
+
+@override_settings(AVAILABILITY_FILTER=MEMORY_AVAILABILITY_FILTER)
+class AvailabilityFilterLoadTests(TransactionTestCase):
+    """
+    The filter builds itself from a thread of its own, so the test data is committed.
+    """
+
+    async def test_built_on_the_first_check(self):
+        await get_user_model().objects.acreate(username="alice", email="alice@example.com")
+        availability_filter = InMemoryAvailabilityFilter()
+
+        with mock.patch("channels.db.close_old_connections") as close_old_connections:
+            # The database answers until the filter is built
+            self.assertTrue(await availability_filter.might_contain("username", "bob"))
+            await availability_filter.loading
+
+        close_old_connections.assert_called()
+        self.assertTrue(await availability_filter.might_contain("username", "alice"))
+        self.assertFalse(await availability_filter.might_contain("username", "bob"))
+
+
+@override_settings(SERVER_TIMING=True)
+class ServerTimingTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def parse(self, response):
+        return dict(metric.split(";", 1) for metric in response["Server-Timing"].split(", "))
+
+    def test_sync_views(self):
+        def view(request):
+            with timed(request, "validation"):
+                get_user_model().objects.count()
+            return HttpResponse()
+
+        metrics = self.parse(ServerTimingMiddleware(view)(self.factory.get("/")))
+
+        self.assertEqual(list(metrics), ["validation", "db", "total"])
+        self.assertTrue(metrics["db"].endswith('desc="1 queries"'))
+
+    async def test_queries_of_the_async_orm_are_counted(self):
+        async def view(request):
+            await get_user_model().objects.acount()
+            await get_user_model().objects.filter(username="alice").aexists()
+            return HttpResponse()
+
+        middleware = ServerTimingMiddleware(view)
+        # The connection of the ORM thread was opened by the test case before the receiver was connected
+        await sync_to_async(install_query_timer)(connection=connection)
+        metrics = self.parse(await middleware(self.factory.get("/")))
+
+        self.assertTrue(metrics["db"].endswith('desc="2 queries"'))
+
+    async def test_api_responses(self):
+        response = await self.async_client.post("/account/login/", {"username": "alice", "password": "wrong"})
+
+        self.assertIn("auth", self.parse(response))
+
+    @override_settings(SERVER_TIMING=False)
+    def test_off_by_default(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            ServerTimingMiddleware(lambda request: HttpResponse())
+
+
+@override_settings(PASSWORD_HASHING={"WORKERS": 1, "MAX_QUEUE": 1, "PBKDF2_ITERATIONS": 1000})
+class HashingPoolTests(SimpleTestCase):
+
+    async def test_runs_in_the_threads_of_the_pool(self):
+        pool = HashingPool()
+
+        self.assertTrue((await pool.run(lambda: threading.current_thread().name)).startswith("password-hashing"))
+
+    async def test_refuses_when_the_queue_is_full(self):
+        pool = HashingPool()
+        release = threading.Event()
+
+        # One hashing running, one waiting for the thread
+        running = asyncio.ensure_future(pool.run(release.wait))
+        waiting = asyncio.ensure_future(pool.run(release.wait))
+        await asyncio.sleep(0)
+        self.assertEqual(HASHING_QUEUE_DEPTH.value, 1)
+
+        with self.assertRaises(PasswordHashingBusy):
+            await pool.run(release.wait)
+
+        release.set()
+        self.assertEqual(await asyncio.gather(running, waiting), [True, True])
+        self.assertEqual((pool.in_flight, HASHING_QUEUE_DEPTH.value), (0, 0))
+
+    async def test_hash_and_check(self):
+        user = get_user_model()(username="alice")
+        user.password = await hash_password("secret")
+
+        self.assertTrue(user.password.startswith("pbkdf2_sha256$1000$"))
+        self.assertTrue(await check_user_password(user, "secret"))
+        self.assertFalse(await check_user_password(user, "wrong"))
+
+
+@override_settings(
+    PASSWORD_HASHING={"ALGORITHM": "pbkdf2", "PBKDF2_ITERATIONS": 1000, "SCRYPT_WORK_FACTOR": 2 ** 4},
+    PASSWORD_HASHERS=["accounts.hashers.PBKDF2PasswordHasher", "accounts.hashers.ScryptPasswordHasher"],
+)
+class PasswordRehashTests(TestCase):
+
+    async def create_user(self, password):
+        return await get_user_model().objects.acreate(username="alice", email="alice@example.com", password=password)
+
+    async def test_hashes_of_an_older_cost_are_upgraded_on_login(self):
+        await self.create_user(PBKDF2PasswordHasher().encode("secret", "salt", iterations=500))
+        rehashes = PASSWORD_REHASHES.values.get("pbkdf2_sha256", 0)
+
+        user = await authenticate_user("alice", "secret")
+
+        self.assertTrue(user.password.startswith("pbkdf2_sha256$1000$"))
+        await user.arefresh_from_db()
+        self.assertTrue(user.password.startswith("pbkdf2_sha256$1000$"))
+        self.assertEqual(PASSWORD_REHASHES.values["pbkdf2_sha256"], rehashes + 1)
+
+    async def test_hashes_of_another_algorithm_are_upgraded_on_login(self):
+        await self.create_user(await sync_to_async(make_password)("secret", hasher=ScryptPasswordHasher()))
+
+        user = await authenticate_user("alice", "secret")
+
+        await user.arefresh_from_db()
+        self.assertTrue(user.password.startswith("pbkdf2_sha256$1000$"))
+
+    async def test_current_hashes_and_wrong_passwords_are_left_alone(self):
+        password = await sync_to_async(make_password)("secret")
+        user = await self.create_user(password)
+
+        self.assertFalse(await check_user_password(user, "wrong"))
+        self.assertTrue(await check_user_password(user, "secret"))
+        await user.arefresh_from_db()
+        self.assertEqual(user.password, password)
+
+    async def test_a_failed_upgrade_does_not_fail_the_login(self):
+        user = await self.create_user(PBKDF2PasswordHasher().encode("secret", "salt", iterations=500))
+
+        with mock.patch("accounts.hashing.set_user_password", side_effect=PasswordHashingBusy):
+            self.assertTrue(await check_user_password(user, "secret"))
+        with mock.patch.object(user, "asave", side_effect=RuntimeError("database down")):
+            self.assertTrue(await check_user_password(user, "secret"))
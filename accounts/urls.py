@@ -10,6 +10,7 @@ urlpatterns = [
     path("login/", views.LoginView.as_view(), name="login"),
     path("sign-up/", views.RegisterView.as_view(), name="sign_up"),
     path('token-refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path("availability/", views.AvailabilityView.as_view(), name="availability"),
 
     # User Profile Data
     path('auth-user-quick-data/', views.AuthUserQuickData.as_view(), name='auth_user_quick_data'),
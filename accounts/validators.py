@@ -9,7 +9,7 @@ import re
 # Getting User Model using django given function
 User = get_user_model()
 
-def validate_username(username):
+def validate_username(username, check_exists=True):
     """
     Validates a username based on specific criteria:
     1. Username must not be empty or consist only of whitespace.
@@ -22,6 +22,7 @@ def validate_username(username):
 
     Args:
         username (str): The username to validate.
+        check_exists (bool): Whether to run the 7th check, the async views run it with the async ORM.
 
     Returns:
         dict: A dictionary containing:
@@ -70,7 +71,7 @@ def validate_username(username):
         return fail("Username cannot be only numbers!")
 
     # Check if the username already exists in the database
-    if User.objects.filter(username=username).exists():
+    if check_exists and User.objects.filter(username=username).exists():
         return fail("Username already exists")
 
     # If all validations pass, set `is_valid` to True
@@ -1,9 +1,10 @@
 # django imports
-from django.contrib.auth import get_user_model, authenticate
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
 
 # rest_framework imports
 from rest_framework.views import APIView
-from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework_simplejwt.tokens import RefreshToken
@@ -13,27 +14,46 @@ from .serializers import UserProfileDataSerializer
 
 # imports from APPS
 from utilities.response_utilities import ResponseUtilities
+from utilities.async_views import AsyncAPIView
 from .registration import CustomUserRegistration
+from .hashing import PasswordHashingBusy, authenticate_user, check_user_password, set_user_password
+from .availability import is_taken
 from .validators import validate_username, validate_password, validate_pin, compress_image
 
 
 # Getting USER Model with the django given function
 User = get_user_model()
 
-class LoginView(APIView, ResponseUtilities):
+# The views hashing passwords are async (utilities.async_views) and hash in the
+# thread pool of accounts.hashing, so a burst of logins does not hold the
+# thread Daphne runs the sync views in.
+# When the pool is full they answer 503 with this message.
+HASHING_BUSY_MESSAGE = "Too many requests right now, please try again in a moment."
 
-    permission_classes = [AllowAny]
-    
-    def post(self, request, format=None):
+class LoginView(AsyncAPIView, ResponseUtilities):
+    # Per IP and per username (RATE_LIMIT in the settings), checked before any query or hashing
+    throttle_scope = "login"
+
+    async def post(self, request, format=None):
         username = request.data.get("username")
         password = request.data.get("password")
-        print(username, password)
-        user = authenticate(request, username = username, password = password)
+        with self.timed("auth"):
+            try:
+                user = await authenticate_user(username, password)
+            except PasswordHashingBusy:
+                self.message_to_client = HASHING_BUSY_MESSAGE
+                return await self.get_async_response(status=503)
 
         if user:
             print("User is authenticated✅")
             refresh = RefreshToken.for_user(user)
 
+            # Claims used by the websocket to build the user from the token without a DB query
+            # (realtime.middleware.JWTAuthMiddleware), they are copied into the access token too
+            refresh["username"] = user.username
+            refresh["gender"] = user.gender
+            refresh["age"] = user.age
+
             self.success_status = True
             self.message_to_client = "logged in successfully"
             self.response_data = {
@@ -44,16 +64,62 @@ class LoginView(APIView, ResponseUtilities):
             print("User is not authenticated")
             self.message_to_client = "username or password was not matched !"
 
-        return Response(self.get_generated_response())
+        return await self.get_async_response()
     
-class RegisterView(APIView, ResponseUtilities, CustomUserRegistration):
+class RegisterView(AsyncAPIView, ResponseUtilities, CustomUserRegistration):
+    throttle_scope = "sign_up"
     
-    def post(self, request, format=None):
+    async def post(self, request, format=None):
         print("Here to signup !")
-        user = self.register_user_if_valid(request.data)
-        print(self.get_generated_response())
+        with self.timed("validation"):
+            try:
+                user = await self.aregister_user_if_valid(request.data)
+            except PasswordHashingBusy:
+                self.message_to_client = HASHING_BUSY_MESSAGE
+                return await self.get_async_response(status=503)
+
+        return await self.get_async_response()
+
+class AvailabilityView(AsyncAPIView, ResponseUtilities):
+    """
+        Live check of the sign-up form: GET ?username=... and/or ?email=...
+
+        Answers {"username": {"available": bool, "message": str}, "email": {...}} in response_data.
+        A free value is mostly answered by the availability filter without any query (accounts.availability).
+    """
+    throttle_scope = "availability"
+
+    async def get(self, request, format=None):
+        username = request.GET.get("username")
+        email = request.GET.get("email")
+
+        if not username and not email:
+            self.message_to_client = "No username or email provided"
+            return await self.get_async_response()
+
+        self.response_data = {}
+        if username:
+            validate_data = validate_username(username, check_exists=False)
+            if not validate_data["is_valid"]:
+                self.response_data["username"] = {"available": False, "message": validate_data["message"]}
+            elif await is_taken("username", username):
+                self.response_data["username"] = {"available": False, "message": "Username already exists"}
+            else:
+                self.response_data["username"] = {"available": True, "message": ""}
 
-        return Response(self.get_generated_response())
+        if email:
+            try:
+                validate_email(email)
+            except ValidationError:
+                self.response_data["email"] = {"available": False, "message": "Enter a valid email address"}
+            else:
+                if await is_taken("email", email):
+                    self.response_data["email"] = {"available": False, "message": "Sorry, this email already exists"}
+                else:
+                    self.response_data["email"] = {"available": True, "message": ""}
+
+        self.success_status = True
+        return await self.get_async_response()
 
 class AuthUserQuickData(APIView, ResponseUtilities):
 
@@ -61,7 +127,8 @@ class AuthUserQuickData(APIView, ResponseUtilities):
     
     def get(self, request, format=None):
         try:
-            self.response_data = UserProfileDataSerializer(instance = request.user).data
+            with self.timed("serialization"):
+                self.response_data = UserProfileDataSerializer(instance = request.user).data
             self.success_status = True
         except:
             self.message_to_client = "Something went wrong when fetching the data"
@@ -81,7 +148,8 @@ class UpdateUsernameView(APIView, ResponseUtilities):
             # Returns a dictionary with:
             # - 'is_valid' (bool): True if the username is valid, False if not.
             # - 'message' (str): A message explaining the validation result (empty if valid, error message if invalid).
-            validate_data = validate_username(new_username)
+            with self.timed("validation"):
+                validate_data = validate_username(new_username)
 
             if validate_data["is_valid"]:
                 # If username is valid, update it
@@ -160,11 +228,11 @@ class UpdateProfilePhotoView(APIView, ResponseUtilities):
 
         return Response(self.get_generated_response())
     
-class UpdatePasswordView(APIView, ResponseUtilities):
+class UpdatePasswordView(AsyncAPIView, ResponseUtilities):
     # Only authenticated users can access this view
-    permission_classes = [IsAuthenticated]
+    authentication_required = True
 
-    def post(self, request, format=None):
+    async def post(self, request, format=None):
         old_password = request.data.get("old_password", None)
         new_password = request.data.get("new_password", None)
         confirm_password = request.data.get("confirm_password", None)
@@ -173,21 +241,24 @@ class UpdatePasswordView(APIView, ResponseUtilities):
             # Check if old password is provided
             if not old_password:
                 self.message_to_client = "Old Password is required !"
-                return Response(self.get_generated_response())
+                return await self.get_async_response()
             
             # First, check if the old password is correct
             user = request.user
-            if not user.check_password(old_password):  # Verifies if the old password matches
+            with self.timed("auth"):
+                password_matches = await check_user_password(user, old_password)
+            if not password_matches:  # Verifies if the old password matches
                 self.message_to_client = "Incorrect old password !"
-                return Response(self.get_generated_response())
+                return await self.get_async_response()
             
             # Validate the new password using the validate_password function
-            validate_data = validate_password(new_password, confirm_password)
+            with self.timed("validation"):
+                validate_data = validate_password(new_password, confirm_password)
 
             if validate_data["is_valid"]:
                 # If password is valid, update it
-                user.set_password(new_password)  # This safely hashes the new password
-                user.save()
+                await set_user_password(user, new_password)  # This safely hashes the new password
+                await user.asave()
 
                 self.success_status = True  # Mark the operation as successful
                 self.message_to_client = "Password changed successfully."
@@ -195,18 +266,22 @@ class UpdatePasswordView(APIView, ResponseUtilities):
                 # If validation fails, return the error message
                 self.message_to_client = validate_data["message"]
 
+        except PasswordHashingBusy:
+            self.message_to_client = HASHING_BUSY_MESSAGE
+            return await self.get_async_response(status=503)
+
         except Exception as e:
             # Handle any unexpected errors during the process
             self.message_to_client = "Error occurred while changing password!"
 
         # Return the structured response with status and message
-        return Response(self.get_generated_response())
+        return await self.get_async_response()
 
-class UpdatePINView(APIView, ResponseUtilities):
+class UpdatePINView(AsyncAPIView, ResponseUtilities):
     # Only authenticated users can access this view
-    permission_classes = [IsAuthenticated]
+    authentication_required = True
 
-    def post(self, request, format=None):
+    async def post(self, request, format=None):
         password = request.data.get("password", None)  # User account password
         new_pin = request.data.get("new_pin", None)
         confirm_pin = request.data.get("confirm_pin", None)
@@ -215,22 +290,25 @@ class UpdatePINView(APIView, ResponseUtilities):
             # Check if password is provided
             if not password:
                 self.message_to_client = "Password is required to change the PIN"
-                return Response(self.get_generated_response())
+                return await self.get_async_response()
 
             # First, check if the old password is correct
             user = request.user
-            if not user.check_password(password):  # Verifies if the old password matches
+            with self.timed("auth"):
+                password_matches = await check_user_password(user, password)
+            if not password_matches:  # Verifies if the old password matches
                 self.message_to_client = "Incorrect password."
-                return Response(self.get_generated_response())
+                return await self.get_async_response()
 
             # Validate the new PIN using the verify_pin function
-            validate_data = validate_pin(new_pin, confirm_pin)
+            with self.timed("validation"):
+                validate_data = validate_pin(new_pin, confirm_pin)
 
             if validate_data["is_valid"]:
                 # If PIN is valid, update it
                 # Here, we update the PIN field or any field you want to store the PIN
                 user.pin = new_pin  # You can modify this based on where the PIN is stored
-                user.save()
+                await user.asave()
 
                 self.success_status = True  # Mark the operation as successful
                 self.message_to_client = "PIN changed successfully."
@@ -238,9 +316,13 @@ class UpdatePINView(APIView, ResponseUtilities):
                 # If validation fails, return the error message
                 self.message_to_client = validate_data["message"]
 
+        except PasswordHashingBusy:
+            self.message_to_client = HASHING_BUSY_MESSAGE
+            return await self.get_async_response(status=503)
+
         except Exception as e:
             # Handle any unexpected errors during the process
             self.message_to_client = "Error occurred while changing PIN!"
 
         # Return the structured response with status and message
-        return Response(self.get_generated_response())
\ No newline at end of file
+        return await self.get_async_response()
\ No newline at end of file
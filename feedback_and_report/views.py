@@ -17,7 +17,10 @@ class HandleFeedbackAndReport(APIView, ResponseUtilities):
     def post(self, request, format=None):
         serializer = FeedBackAndReportSerializer(data=request.data)
 
-        if serializer.is_valid():
+        with self.timed("validation"):
+            is_valid = serializer.is_valid()
+
+        if is_valid:
             serializer.save()
             self.success_status = True
             self.message_to_client = "We received your feedback ! Thank You So much !"
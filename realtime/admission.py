@@ -0,0 +1,103 @@
+"""
+Admission control and queue position updates of the waiting lobby.
+
+Admission:
+    - A process accepts at most MAX_CONNECTIONS websockets.
+    - The lobby holds at most MAX_LOBBY_SIZE waiting users.
+    Users over the limits get {"signal_type": "busy", "retry_after": seconds}
+    and are disconnected, the retry_after is jittered so they do not all come back at once.
+
+Queue position:
+    Every STATUS_INTERVAL seconds the matcher (run_matcher command) reads the
+    lobby status once and sends it to the group of the waiting users. Every
+    consumer estimates its own position and wait from it, so nothing is
+    queried per user.
+"""
+
+import bisect
+import random
+import time
+
+from django.conf import settings
+
+# Group of the consumers whose users are waiting in the lobby
+WAITING_GROUP = "waiting_lobby"
+
+DEFAULT_ADMISSION_SETTINGS = {
+    "MAX_CONNECTIONS": 5000,  # Websockets per process
+    "MAX_LOBBY_SIZE": 50000,  # Users waiting in the lobby, 0 for no limit
+    "RETRY_AFTER": 10,  # Seconds the shed users are asked to wait (plus up to 50% jitter)
+    "STATUS_INTERVAL": 2,  # Seconds between two queue position updates
+    "STATUS_MARKS": 32,  # Users sampled from the queue for the position estimates
+}
+
+
+def get_admission_settings():
+    """
+    Returns the REALTIME_ADMISSION settings merged over the defaults.
+    """
+    return {**DEFAULT_ADMISSION_SETTINGS, **getattr(settings, "REALTIME_ADMISSION", {})}
+
+
+def retry_after(seconds):
+    """
+    Returns the seconds to wait before retrying, with jitter.
+    """
+    return round(seconds * (1 + random.random() / 2), 1)
+
+
+def estimate_position(marks, enqueued_at):
+    """
+    Estimates the rank of a user in the queue from the sampled marks.
+
+    Args:
+        marks (list): [enqueued_at, rank] of sampled users, oldest first.
+        enqueued_at (float): When the user joined the lobby.
+
+    Returns:
+        int: The estimated position, 1 being the next in line.
+    """
+    if not marks:
+        return 1
+
+    index = bisect.bisect_right([mark[0] for mark in marks], enqueued_at)
+    if index == 0:
+        return 1
+    if index == len(marks):
+        return marks[-1][1] + 1
+
+    # Linear interpolation between the two marks around the user
+    (before_time, before_rank), (after_time, after_rank) = marks[index - 1], marks[index]
+    share = (enqueued_at - before_time) / (after_time - before_time) if after_time > before_time else 0
+    return round(before_rank + share * (after_rank - before_rank)) + 1
+
+
+class LobbyStatusBroadcaster:
+    """
+    Reads the lobby status once and sends it to every waiting user through the group.
+    """
+
+    def __init__(self, lobby, channel_layer, marks):
+        self.lobby = lobby
+        self.channel_layer = channel_layer
+        self.marks = marks
+        self.last_matched = None
+        self.last_time = None
+
+    async def broadcast(self):
+        status = await self.lobby.status(self.marks)
+        now = time.monotonic()
+
+        # Users matched per second since the last broadcast
+        match_rate = None
+        if self.last_matched is not None and now > self.last_time:
+            match_rate = max(0, status["matched"] - self.last_matched) / (now - self.last_time)
+        self.last_matched = status["matched"]
+        self.last_time = now
+
+        await self.channel_layer.group_send(WAITING_GROUP, {
+            "type": "lobby.status",
+            "size": status["size"],
+            "marks": status["marks"],
+            "match_rate": match_rate,
+        })
@@ -0,0 +1,120 @@
+"""
+Text chat between the two users of a match session.
+
+The messages are relayed through the consumers like the signaling, and
+saved to the database in batches: the consumer only appends the message to
+the in-memory buffer of the process, which is written with one bulk insert
+once it holds BATCH_SIZE messages or FLUSH_MS after its first message. The
+insert runs in a worker thread with database_sync_to_async, never on the
+event loop, which also closes the database connections gone stale since the
+last batch.
+
+The recent history of a session is kept by the consumers of its two users
+in a ring buffer of HISTORY_SIZE messages, so reading it never queries the
+database.
+
+How to use:
+    - message = build_message(session, sender, text) once the text is validated with clean_text()
+    - chat_writer.add(message) to get it saved
+    - await chat_writer.flush() before the process stops
+"""
+
+import asyncio
+import time
+from datetime import datetime, timezone
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .models import ChatMessage
+
+DEFAULT_CHAT_SETTINGS = {
+    "MAX_LENGTH": 1000,  # Characters of one message
+    "BATCH_SIZE": 100,  # Messages written in one bulk insert at most
+    "FLUSH_MS": 500,  # Time a message waits in the buffer at most
+    "HISTORY_SIZE": 50,  # Recent messages kept per session for the history
+}
+
+
+def get_chat_settings():
+    """
+    Returns the REALTIME_CHAT settings merged over the defaults.
+    """
+    return {**DEFAULT_CHAT_SETTINGS, **getattr(settings, "REALTIME_CHAT", {})}
+
+
+def clean_text(text, max_length):
+    """
+    Returns the text without surrounding spaces, None when it is not a valid message.
+    """
+    if not isinstance(text, str):
+        return None
+
+    text = text.strip()
+    if not text or len(text) > max_length:
+        return None
+    return text
+
+
+def build_message(session, sender, text):
+    """
+    Returns the message as sent to the clients and kept in the history.
+    """
+    return {"session": session, "sender": sender, "text": text, "sent_at": time.time()}
+
+
+def _save_messages(messages):
+    ChatMessage.objects.bulk_create([
+        ChatMessage(
+            session=message["session"],
+            sender=message["sender"],
+            text=message["text"],
+            sent_date=datetime.fromtimestamp(message["sent_at"], tz=timezone.utc),
+        )
+        for message in messages
+    ])
+
+
+class ChatWriter:
+    """
+    Buffers the chat messages of the process and writes them in batches.
+    """
+
+    def __init__(self):
+        self.buffer = []
+        self.task = None
+        # Tasks of the full batches being written, kept so they are not garbage collected
+        self.writing = set()
+
+    def add(self, message):
+        self.buffer.append(message)
+
+        chat_settings = get_chat_settings()
+        if len(self.buffer) >= chat_settings["BATCH_SIZE"]:
+            task = asyncio.create_task(self.flush())
+            self.writing.add(task)
+            task.add_done_callback(self.writing.discard)
+        elif self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.flush(delay=chat_settings["FLUSH_MS"] / 1000))
+
+    async def flush(self, delay=0):
+        """
+        Writes the buffered messages, after `delay` seconds.
+        """
+        if delay:
+            await asyncio.sleep(delay)
+
+        # The buffer is swapped before the insert, messages coming in meanwhile go to the next batch
+        messages, self.buffer = self.buffer, []
+        if not messages:
+            return
+
+        try:
+            await database_sync_to_async(_save_messages)(messages)
+        except Exception as e:
+            # Losing a batch of chat history must not take the websockets down
+            print("!!! Got Error when saving the chat messages !!!", e)
+
+
+# Chat writer of the process
+chat_writer = ChatWriter()
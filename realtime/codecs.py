@@ -0,0 +1,64 @@
+"""
+Frame codecs of the realtime websocket.
+
+JSON text frames are the default. Clients asking for the MessagePack
+subprotocol (Sec-WebSocket-Protocol: guffmandu.msgpack) exchange binary
+MessagePack frames instead, which are smaller and cheaper to encode and
+decode for the big SDP blobs of the signaling. Clients which have to offer
+a subprotocol (e.g. to send their token as one) but want JSON can ask for
+guffmandu.json.
+
+How to use:
+    - codec = select_codec(scope["subprotocols"]) at the handshake
+    - accept the connection with codec.subprotocol
+    - codec.encode(content) / codec.decode(frame) for every frame
+"""
+
+import json
+
+import msgpack
+
+MSGPACK_SUBPROTOCOL = "guffmandu.msgpack"
+JSON_SUBPROTOCOL = "guffmandu.json"
+
+
+class JSONCodec:
+    subprotocol = None
+    binary = False
+
+    @staticmethod
+    def encode(content):
+        return json.dumps(content)
+
+    @staticmethod
+    def decode(data):
+        return json.loads(data)
+
+
+class JSONSubprotocolCodec(JSONCodec):
+    subprotocol = JSON_SUBPROTOCOL
+
+
+class MessagePackCodec:
+    subprotocol = MSGPACK_SUBPROTOCOL
+    binary = True
+
+    @staticmethod
+    def encode(content):
+        return msgpack.packb(content, use_bin_type=True)
+
+    @staticmethod
+    def decode(data):
+        return msgpack.unpackb(data, raw=False)
+
+
+def select_codec(subprotocols):
+    """
+    Returns the codec for the subprotocols offered by the client, JSON when none is supported.
+    """
+    subprotocols = subprotocols or ()
+    if MSGPACK_SUBPROTOCOL in subprotocols:
+        return MessagePackCodec
+    if JSON_SUBPROTOCOL in subprotocols:
+        return JSONSubprotocolCodec
+    return JSONCodec
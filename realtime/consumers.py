@@ -1,13 +1,27 @@
-import redis
-import json
+import asyncio
+import time
+from collections import deque
+from functools import partial
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
 from urllib.parse import parse_qs
 
-# Connecting to the Redis server
-redis_client = redis.Redis(host='localhost', port=6379, decode_responses=True)
-
-# Globalizing the key name for the waiting lobby in Redis
-WAITING_LOBBY = 'waiting_lobby'
+from .admission import WAITING_GROUP, estimate_position, get_admission_settings, retry_after
+from .chat import build_message, chat_writer, clean_text, get_chat_settings
+from .codecs import JSONCodec, select_codec
+from .drain import drain, make_resume_token, use_resume_token
+from .lobby import get_lobby
+from .matchmaking import (
+    MAX_RELAX_LEVEL, RELAX_STEP_SECONDS, build_profile, bucket_of, find_partner, get_recent_partners_settings,
+    notify_match, relax,
+)
+from .matcher import get_matcher_settings, latency_reporter
+from .metrics import (
+    ACTIVE_CONNECTIONS, CHANNEL_SEND_LATENCY, CONNECTIONS_CLOSED, DISCONNECTS, MATCH_WAIT,
+    SIGNALS_DROPPED, SIGNALS_RELAYED,
+)
+from .presence import PRESENCE_TTL, presence
+from .throttling import SignalRateLimiter, TokenBucket, get_signal_rates
 
 class ConnectionConsumer(AsyncJsonWebsocketConsumer):
     """
@@ -15,16 +29,92 @@ class ConnectionConsumer(AsyncJsonWebsocketConsumer):
     for users in the waiting lobby.
     """
 
+    user_data = None
+    bucket = None
+    waiting = False  # True while the user is in the waiting lobby
+    enqueued_at = None  # When the user joined the waiting lobby
+    counted = False  # True once the connection is counted in ACTIVE_CONNECTIONS
+    flooding = False  # True once the connection is closed for flooding
+    codec = JSONCodec
+
+    # Role of the user who receives the signal, by signal type
+    user_mapping_by_type = {
+        "offer": "user2",
+        "answer": "user1",
+        "ice_candidate_user1": "user2",
+        "ice_candidate_user2": "user1",
+    }
+    ice_candidate_types = ("ice_candidate_user1", "ice_candidate_user2")
+
+    # Longest session id accepted from a client, the server makes them 12 characters long
+    max_session_length = 64
+
+    # Close code sent to clients which keep flooding after their signals got dropped,
+    # more than max_dropped_signals within dropped_signals_window seconds
+    flooding_close_code = 4008
+    max_dropped_signals = getattr(settings, "REALTIME_MAX_DROPPED_SIGNALS", 50)
+    dropped_signals_window = getattr(settings, "REALTIME_DROPPED_SIGNALS_WINDOW", 60)
+
+    # Close code sent to the users shed by the admission control
+    busy_close_code = 4029
+    # Close code sent to the users of a draining worker (service restart)
+    drain_close_code = 1012
+    admission = get_admission_settings()
+
+    # Trickle ICE candidates following the first one of a burst are batched for this long
+    # before being sent to the peer in one channel layer message, 0 turns the batching off
+    ice_batch_seconds = getattr(settings, "REALTIME_ICE_BATCH_MS", 0) / 1000
+
     async def connect(self):
         """
         Handles the initial connection of a user.
 
+        - Sheds the connection when the process has too many connections or is draining.
         - Retrieves the username from the request.
         - Closes the connection if no username is provided.
-        - Pushes the user data (channel name and username) to the Redis waiting lobby.
-        - Accepts the WebSocket connection.
+        - Pushes the user data (channel name, username and match filters) to the Redis waiting lobby,
+          or sheds the connection when the lobby is full.
+          Users coming back from a drained worker with ?resume=<token> keep their place in the queue.
+        - Accepts the WebSocket connection with the codec (JSON / MessagePack) the client asked for.
         - Attempts to match the user with another user in the waiting lobby.
         """
+        # The state of the connection is set before anything can shed it,
+        # disconnect() runs for the shed connections too
+
+        # Match sessions of this connection: session -> {"role": ..., "peer": channel_name}
+        self.sessions = {}
+
+        # Token buckets of the signals sent by this client
+        self.rate_limiter = SignalRateLimiter(get_signal_rates())
+        # Dropped signals allowed before closing, refilled over the window so old drops are forgotten
+        self.dropped_signals = TokenBucket(
+            self.max_dropped_signals / self.dropped_signals_window, self.max_dropped_signals,
+        )
+
+        # ICE candidates waiting to be sent as a batch: session -> (signal_type, [sdp, ...])
+        self.ice_buffers = {}
+        self.ice_flush_tasks = {}
+
+        # Recent chat messages of the match sessions: session -> ring buffer of messages
+        self.chat_settings = get_chat_settings()
+        self.chat_history = {}
+
+        # The frame codec is picked from the subprotocols offered by the client
+        self.codec = select_codec(self.scope.get("subprotocols"))
+
+        # Every connection is counted until disconnect(), even the rejected ones
+        ACTIVE_CONNECTIONS.inc()
+        self.counted = True
+        if ACTIVE_CONNECTIONS.value > self.admission["MAX_CONNECTIONS"]:
+            await self.shed("server_full")
+            return
+
+        # The SIGTERM handler of the server is in place once a connection comes in
+        drain.install()
+        if drain.draining:
+            await self.shed("draining")
+            return
+        drain.track(self.channel_name)
 
         # Retrieve the username of the user
         username = self.get_username()
@@ -32,86 +122,525 @@ class ConnectionConsumer(AsyncJsonWebsocketConsumer):
         # Reject the connection if no username is provided
         if not username:
             print("Connection without username rejected !")
-            self.close()
+            await self.close()
             return
         
-        # Store the user's data (channel name and username)
-        self.user_data = json.dumps({
-            "username": username,
-            "channel_name": self.channel_name
-        })
+        # Store the user's data (channel name, username, attributes and match filters)
+        query_params = parse_qs(self.scope['query_string'].decode())
+
+        # Clients sending ?ice_batch=1 receive batched ICE candidates as one frame
+        self.receives_ice_batches = query_params.get("ice_batch", [None])[0] == "1"
+
+        self.user_data = build_profile(username, self.scope["user"], query_params)
+        self.user_data["channel_name"] = self.channel_name
+        self.bucket = bucket_of(self.user_data)
         
+        resume_token = query_params.get("resume", [None])[0]
+        enqueued_at = await use_resume_token(resume_token, username) if resume_token else None
+
         # Add the user to the waiting pool in Redis
-        redis_client.lpush(WAITING_LOBBY, self.user_data)
+        if not await self.join_lobby(enqueued_at=enqueued_at):
+            await self.shed("lobby_full")
+            return
 
         # Accept the WebSocket connection (handshake)
-        await self.accept()
+        await self.accept(self.codec.subprotocol)
 
         # Try to match the user with another user in the waiting pool
-        await self.match_user()
+        # In "tick" mode the background matcher (run_matcher command) does the matching
+        if get_matcher_settings()["MODE"] == "inline":
+            latency_reporter.start()
+            await self.match_user()
+
+    async def shed(self, reason):
+        """
+        Tells the client to come back later and closes the connection.
+        """
+        CONNECTIONS_CLOSED.inc(reason)
+
+        await self.accept(self.codec.subprotocol)
+        await self.send_json({
+            "signal_type": "busy",
+            "reason": reason,
+            "retry_after": retry_after(self.admission["RETRY_AFTER"]),
+        })
+        await self.close(code=self.busy_close_code)
+
+    async def join_lobby(self, end_sessions=(), enqueued_at=None):
+        """
+        Adds the user to the waiting lobby, ending the given match sessions in the same step.
+        The user gets `enqueued_at` as its time of joining when given (resumed from a drained worker).
+
+        Returns:
+            bool: False when the lobby is full and the user was not added.
+        """
+        self.enqueued_at = await get_lobby().add(
+            self.channel_name, self.user_data, self.bucket, PRESENCE_TTL,
+            end_sessions=end_sessions,
+            max_size=self.admission["MAX_LOBBY_SIZE"],
+            enqueued_at=enqueued_at,
+        )
+        if self.enqueued_at is None:
+            return False
+
+        presence.track(self.channel_name)
+        await self.channel_layer.group_add(WAITING_GROUP, self.channel_name)
+        self.waiting = True
+
+        if get_matcher_settings()["MODE"] == "inline":
+            asyncio.create_task(self.rematch_on_relax(self.enqueued_at))
+        return True
+
+    async def rematch_on_relax(self, enqueued_at):
+        """
+        Looks for a partner again every time the filters of the waiting user get relaxed ("inline" mode).
+
+        The background matcher pairs everybody again on every tick, in "inline"
+        mode a user looks for a partner on its own when it joins, the relaxed
+        filters would only be seen by the users joining after it otherwise.
+
+        It stops once the user is not waiting since `enqueued_at` anymore
+        (matched, left, gone), it is never cancelled in the middle of a match.
+        """
+        level = int((time.time() - enqueued_at) // RELAX_STEP_SECONDS) + 1
+        for level in range(level, MAX_RELAX_LEVEL + 1):
+            await asyncio.sleep(max(0, enqueued_at + level * RELAX_STEP_SECONDS - time.time()))
+            if not self.waiting or self.enqueued_at != enqueued_at:
+                return
+
+            try:
+                await self.match_user()
+            except Exception as e:
+                # The next relax level tries again
+                print("!!! Got Error when matching a relaxed user !!!", e)
+
+    async def leave_lobby(self):
+        """
+        Removes the user from the waiting lobby.
+        """
+        presence.untrack(self.channel_name)
+        await get_lobby().remove(self.channel_name, self.bucket)
+        await self.channel_layer.group_discard(WAITING_GROUP, self.channel_name)
+        self.waiting = False
+
+    async def presence_timeout(self, event):
+        """
+        Takes the user out of the lobby once its client stopped sending heartbeats (see realtime.presence).
+
+        The client is told with a "busy" message, it sends "next" to get back in the lobby.
+        """
+        if not self.waiting:
+            return
+
+        await self.leave_lobby()
+        await self.send_json({
+            "signal_type": "busy",
+            "reason": "presence_timeout",
+            "retry_after": 0,
+        })
+
+    async def worker_drain(self, event):
+        """
+        Hands the user over to another worker before this one stops (see realtime.drain).
+
+        The user leaves the lobby with a token to get its place back, the
+        batched ICE candidates are sent to the peers, then the client is told
+        when to reconnect.
+        """
+        resume = None
+        if self.waiting:
+            resume = make_resume_token(self.user_data["username"], self.enqueued_at)
+            await self.leave_lobby()
+
+        for session in list(self.ice_buffers):
+            await self.flush_ice_candidates(session)
+
+        CONNECTIONS_CLOSED.inc("draining")
+        await self.send_json({
+            "signal_type": "reconnect",
+            "retry_after": event["retry_after"],
+            "resume": resume,
+        })
+        await self.close(code=self.drain_close_code)
+
+    async def lobby_status(self, event):
+        """
+        Sends the estimated queue position and wait to the waiting client.
+
+        The status is computed once per tick for the whole lobby (see realtime.admission).
+        """
+        if not self.waiting:
+            return
+
+        position = estimate_position(event["marks"], self.enqueued_at)
+        match_rate = event["match_rate"]
+
+        await self.send_json({
+            "signal_type": "queue_position",
+            "position": position,
+            "lobby_size": event["size"],
+            "estimated_wait": round(position / match_rate) if match_rate else None,
+        })
+
+    async def end_sessions(self, reason):
+        """
+        Tells the peers of the user's match sessions that the user left and forgets the sessions.
+
+        Returns:
+            list: The ended session ids, they still have to be deleted from Redis.
+        """
+        sessions = list(self.sessions)
+
+        for session in sessions:
+            # Candidates still in the buffers are sent before the session goes away
+            if session in self.ice_buffers:
+                await self.flush_ice_candidates(session)
+
+            self.chat_history.pop(session, None)
+            await self.send_to_channel(self.sessions.pop(session)["peer"], {
+                "type": "peer.left",
+                "session": session,
+                "reason": reason,
+            })
+
+        return sessions
+
+    async def peer_left(self, event):
+        """
+        Forgets the session the peer left and tells the client about it.
+        """
+        self.sessions.pop(event["session"], None)
+        self.ice_buffers.pop(event["session"], None)
+        self.chat_history.pop(event["session"], None)
+
+        await self.send_json({
+            "signal_type": "peer_left",
+            "session": event["session"],
+            "reason": event["reason"],
+        })
     
     async def match_user(self):
-        # Check if there are at least 2 users in the waiting pool
-        waiting_count = redis_client.llen(WAITING_LOBBY)
-        if waiting_count > 1:
+        # Look for a compatible partner and take both users out of the waiting pool,
+        # with the filters relaxed for the time the user has been waiting
+        # None is returned when nobody compatible is waiting
+        profile = relax(self.user_data, time.time() - self.enqueued_at)
+        match = await find_partner(get_lobby(), self.channel_name, profile)
+        if match:
             print("Matching users...")
+            await notify_match(self.channel_layer, *match)
 
-            # Pop two users from the right of the waiting pool in Redis
-            user1 = json.loads(redis_client.rpop(WAITING_LOBBY))
-            user2 = json.loads(redis_client.rpop(WAITING_LOBBY))
-            # Create a unique room name based on both users
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        """
+        Decodes the frame with the codec of the connection and passes it to receive_json.
 
-            data_to_send = {
-                    "type": "match.notification",   # Type of event to trigger the corresponding handler
-                    "user1":user1,
-                    "user2":user2
-            }
-            await self.channel_layer.send(user1["channel_name"], data_to_send)
+        JSON text frames are always accepted, binary frames only with the MessagePack codec.
+        """
+        if bytes_data is not None and self.codec.binary:
+            content = self.codec.decode(bytes_data)
+        elif text_data:
+            content = JSONCodec.decode(text_data)
+        else:
+            return
+
+        await self.receive_json(content, **kwargs)
+
+    async def send_json(self, content, close=False):
+        """
+        Encodes the content with the codec of the connection and sends it as text or binary frame.
+        """
+        if self.codec.binary:
+            await self.send(bytes_data=self.codec.encode(content), close=close)
+        else:
+            await self.send(text_data=self.codec.encode(content), close=close)
 
     async def match_notification(self, event):
+        """
+        Keeps the match session in the consumer's cache and tells the client about the match.
+        """
+        if self.enqueued_at:
+            MATCH_WAIT.observe((time.time() - self.enqueued_at) * 1000)
+
+        # The user is out of the lobby now
+        presence.untrack(self.channel_name)
+        await self.channel_layer.group_discard(WAITING_GROUP, self.channel_name)
+        self.waiting = False
+
+        self.sessions[event["session"]] = {
+            "role": event["role"],
+            "peer": event["peer_channel_name"],
+            "peer_username": event["peer_username"],
+        }
+
         await self.send_json({
-            "signal_type":"match",
-            "user1":event["user1"],
-            "user2":event["user2"],
+            "signal_type": "match",
+            "session": event["session"],
+            "role": event["role"],
+            "peer": {"username": event["peer_username"]},
         })
 
     async def receive_json(self, content, **kwargs):
         """
+            Waiting clients may send {"signal_type": "heartbeat"} (see realtime.presence).
+            {"signal_type": "next"} leaves the current partner and queues the user again,
+            {"signal_type": "leave"} leaves the current partner (or the lobby) without queueing.
+            {"signal_type": "block", "session": ...} keeps the partner of the session from being
+            matched with the user again (the client still sends "next" or "leave" to leave it).
+            {"signal_type": "chat", "session": ..., "text": ...} sends a text message to the partner,
+            {"signal_type": "chat_history", "session": ...} returns the recent messages of the session.
+            The old partner gets {"signal_type": "peer_left", "session": ..., "reason": ...}.
+
+            Every signal type is rate limited per connection (see realtime.throttling),
+            unknown and excess signals and the ones with an invalid session are
+            dropped and a client which keeps flooding gets disconnected.
+
             This format will be coming in the content 
             content = {
-                "signal_type":"offer / answer / ice_candiate_user1 / ice_candiate_user2",
+                "session":"session_id_from_the_match_message",
+                "signal_type":"offer / answer / ice_candidate_user1 / ice_candidate_user2",
                 "sdp":"sdp_of_user",
-                "user1":{
-                    "channel_name":"user1_channel_name",
-                    "username":"username_of_user1"
-                },
-                "user2":{
-                    "channel_name":"user2_channel_name",
-                    "username":"username_of_user2"
-                }
             }
+
+            The peer's channel is resolved from the session on the server,
+            so a client can only send signals to the user it was matched with.
+
+            When REALTIME_ICE_BATCH_MS is set, the first ICE candidate of a burst
+            is sent right away and the ones following it are sent together
+            once the batch window is over.
         """
-        # try:
-        user_mapping_by_type = {
-            "offer": "user2",
-            "answer": "user1",
-            "ice_candidate_user1": "user2",
-            "ice_candidate_user2": "user1",
-        }
+        signal_type = content.get("signal_type") if isinstance(content, dict) else None
+
+        # Rejected here, before anything reaches Redis or the channel layer
+        if not self.rate_limiter.is_known(signal_type):
+            await self.drop_signal("unknown")
+            return
+        if not self.rate_limiter.allow(signal_type):
+            await self.drop_signal("rate_limited")
+            return
+
+        session = content.get("session")
+        # The session is a key of the caches and of Redis, a list or a map would break the lookups
+        if session is not None and not (isinstance(session, str) and 0 < len(session) <= self.max_session_length):
+            await self.drop_signal("invalid_session")
+            return
+
+        # Heartbeats only keep the user's presence in the lobby alive
+        if signal_type == "heartbeat":
+            presence.heartbeat(self.channel_name)
+            return
+
+        # "next": leave the current partner and get matched again on the same connection
+        if signal_type == "next":
+            ended_sessions = await self.end_sessions("next")
+            if ended_sessions or not self.waiting:
+                if not await self.join_lobby(end_sessions=ended_sessions):
+                    # The lobby is full, the client can send "next" again later
+                    await self.send_json({
+                        "signal_type": "busy",
+                        "reason": "lobby_full",
+                        "retry_after": retry_after(self.admission["RETRY_AFTER"]),
+                    })
+                    return
+            if get_matcher_settings()["MODE"] == "inline":
+                await self.match_user()
+            return
+
+        # "leave": leave the current partner (or the lobby) and stay connected without waiting
+        if signal_type == "leave":
+            await get_lobby().end_sessions(await self.end_sessions("leave"))
+            if self.waiting:
+                await self.leave_lobby()
+            return
+
+        # "block": never get matched with the partner of the session again
+        if signal_type == "block":
+            match_session = await self.get_match_session(session) if session else None
+            if match_session and match_session.get("peer_username"):
+                recent_partners = get_recent_partners_settings()
+                await get_lobby().block(
+                    self.user_data["username"], match_session["peer_username"],
+                    recent_partners["BLOCK_TTL"], recent_partners["MAX_PARTNERS"],
+                )
+            return
+
+        if signal_type in ("chat", "chat_history"):
+            await self.handle_chat(signal_type, session, content)
+            return
+
+        target_role = self.user_mapping_by_type.get(signal_type)
+        if not target_role or not session:
+            return
+
+        match_session = await self.get_match_session(session)
+
+        # A user can not send signals to itself (e.g. an offer from user2)
+        if not match_session or match_session["role"] == target_role:
+            return
+
+        if self.ice_batch_seconds:
+            if signal_type in self.ice_candidate_types:
+                # Candidates following the first one of the burst wait for the flush
+                if session in self.ice_buffers:
+                    self.ice_buffers[session][1].append(content.get("sdp"))
+                    return
+
+                self.ice_buffers[session] = (signal_type, [])
+                task = self.ice_flush_tasks[session] = asyncio.create_task(
+                    self.flush_ice_candidates(session, delay=self.ice_batch_seconds)
+                )
+                task.add_done_callback(partial(self.ice_flush_done, session))
+            else:
+                # Candidates buffered before an offer / answer must not be overtaken by it
+                await self.flush_ice_candidates(session)
+
+        SIGNALS_RELAYED.inc(signal_type)
+        await self.send_to_channel(match_session["peer"], {
+            "type": "handle.signal",
+            "session": session,
+            "signal_type": signal_type,
+            "sdp": content.get("sdp"),
+        })
+
+    async def handle_chat(self, signal_type, session, content):
+        """
+        Relays a chat message to the partner of the session, or sends the recent messages back.
+        """
+        match_session = self.sessions.get(session)
+        if not match_session:
+            return
 
-        user_to_send = user_mapping_by_type[content["signal_type"]]
-        content["type"] = "handle.signal"
+        if signal_type == "chat_history":
+            await self.send_json({
+                "signal_type": "chat_history",
+                "session": session,
+                "messages": list(self.chat_history.get(session, ())),
+            })
+            return
+
+        text = clean_text(content.get("text"), self.chat_settings["MAX_LENGTH"])
+        if text is None:
+            return
+
+        message = build_message(session, self.user_data["username"], text)
+        self.remember_chat_message(message)
+        # Only the sender saves the message, the insert happens later with the rest of the batch
+        chat_writer.add(message)
+
+        SIGNALS_RELAYED.inc(signal_type)
+        await self.send_to_channel(match_session["peer"], {"type": "chat.message", "message": message})
+
+    def remember_chat_message(self, message):
+        history = self.chat_history.get(message["session"])
+        if history is None:
+            history = self.chat_history[message["session"]] = deque(maxlen=self.chat_settings["HISTORY_SIZE"])
+        history.append(message)
+
+    async def chat_message(self, event):
+        """
+        Sends the chat message of the partner to the client.
+        """
+        message = event["message"]
+        if message["session"] not in self.sessions:
+            return
+
+        self.remember_chat_message(message)
+        await self.send_json({"signal_type": "chat", **message})
+
+    async def flush_ice_candidates(self, session, delay=0):
+        """
+        Sends the ICE candidates buffered for the session to the peer in one message.
+        """
+        if delay:
+            await asyncio.sleep(delay)
+        else:
+            task = self.ice_flush_tasks.pop(session, None)
+            if task and task is not asyncio.current_task():
+                task.cancel()
+
+        self.ice_flush_tasks.pop(session, None)
+        signal_type, candidates = self.ice_buffers.pop(session, (None, None))
+        if not candidates:
+            return
+
+        SIGNALS_RELAYED.inc(signal_type, len(candidates))
+        await self.send_to_channel(self.sessions[session]["peer"], {
+            "type": "handle.ice.batch",
+            "session": session,
+            "signal_type": signal_type,
+            "sdps": candidates,
+        })
+
+    def ice_flush_done(self, session, task):
+        """
+        Forgets the finished flush task of the session and logs its error, nobody awaits it.
+        """
+        if self.ice_flush_tasks.get(session) is task:
+            del self.ice_flush_tasks[session]
 
-        await self.channel_layer.send(content[user_to_send]["channel_name"], content)
+        if not task.cancelled() and task.exception():
+            print("!!! Got Error when flushing the ICE candidates !!!", task.exception())
 
-        # except Exception as e:
-        #     print("!!! Got Error when signaling through users !!!", e)
-        #     # Handle any unexpected errors gracefully
-        #     return
+    async def send_to_channel(self, channel_name, message):
+        """
+        Sends the message to another consumer through the channel layer and records how long it took.
+        """
+        started = time.perf_counter()
+        await self.channel_layer.send(channel_name, message)
+        CHANNEL_SEND_LATENCY.observe((time.perf_counter() - started) * 1000)
+
+    async def drop_signal(self, reason):
+        """
+        Counts the dropped signal and closes the connection when the client keeps flooding.
+        """
+        SIGNALS_DROPPED.inc(reason)
+
+        if not self.dropped_signals.consume() and not self.flooding:
+            self.flooding = True
+            CONNECTIONS_CLOSED.inc("flooding")
+            await self.close(code=self.flooding_close_code)
+
+    async def get_match_session(self, session):
+        """
+        Returns the cached match session {"role": ..., "peer": ..., "peer_username": ...},
+        None if the user is not in it.
+
+        Sessions missing from the cache are looked up in Redis once and cached.
+        """
+        match_session = self.sessions.get(session)
+        if match_session:
+            return match_session
+
+        channels = await get_lobby().get_session(session)
+        for role, peer_role in (("user1", "user2"), ("user2", "user1")):
+            if channels.get(role) == self.channel_name:
+                match_session = self.sessions[session] = {
+                    "role": role,
+                    "peer": channels[peer_role],
+                    "peer_username": channels.get(f"{peer_role}_username"),
+                }
+                return match_session
+
+        return None
 
     async def handle_signal(self, data):
         data.pop("type")
         await self.send_json(data)
+
+    async def handle_ice_batch(self, data):
+        """
+        Sends the batched ICE candidates as one frame, or one frame per candidate
+        to the clients which did not ask for batches.
+        """
+        data.pop("type")
+        if self.receives_ice_batches:
+            await self.send_json(data)
+            return
+
+        for sdp in data["sdps"]:
+            await self.send_json({
+                "session": data["session"],
+                "signal_type": data["signal_type"],
+                "sdp": sdp,
+            })
         
     async def transfer_between(self, event):
         """
@@ -139,10 +668,26 @@ class ConnectionConsumer(AsyncJsonWebsocketConsumer):
         Handles the WebSocket disconnection.
 
         - Removes the user from the Redis waiting lobby.
+        - Tells the peers that the user left and ends the match sessions.
         - Cleans up the connection before closing it.
+
+        It also runs for the connections shed by connect() (server full, draining),
+        which never joined the lobby nor got a match session.
         """
+        DISCONNECTS.inc(str(code))
+        if self.counted:
+            ACTIVE_CONNECTIONS.dec()
+        drain.untrack(self.channel_name)
+
         # Remove the user from the Redis waiting pool
-        redis_client.lrem(WAITING_LOBBY, 0, self.user_data)
+        if self.waiting:
+            await self.leave_lobby()
+
+        # The match sessions of this user can not be used anymore
+        # No round trip for the shed connections, Redis may be going away with a draining worker
+        ended_sessions = await self.end_sessions("disconnect")
+        if ended_sessions:
+            await get_lobby().end_sessions(ended_sessions)
 
         # Handle any necessary cleanup before closing the connection
         await self.close()
@@ -0,0 +1,160 @@
+"""
+Graceful drain of a websocket worker on SIGTERM.
+
+When a worker is stopped (deploy, scale down) it first drains its websockets
+instead of dying with users in the lobby and calls mid-signaling:
+    1. New connections are shed with {"signal_type": "busy", "reason": "draining"}.
+    2. Every consumer of the process takes its user out of the lobby, flushes
+       the ICE candidates it was batching and sends
+       {"signal_type": "reconnect", "retry_after": seconds, "resume": token},
+       then closes with 1012 (service restart).
+       The retry_after is spread over RECONNECT_SPREAD seconds so the clients
+       do not all come back to the other workers at once.
+    3. The worker waits for the consumers to be gone (at most TIMEOUT seconds)
+       and writes the buffered chat messages before letting the server stop.
+
+The resume token is signed and holds the time the user joined the lobby. A
+client reconnecting with ?resume=<token> gets its place in the queue back
+instead of going to the end of it. A token is used once: its random nonce
+is marked as used in the lobby, so it can not be replayed to jump the queue.
+
+How to use:
+    - drain.track(channel_name) on connect and drain.untrack(channel_name) on disconnect
+    - drain.install() once the event loop of the server is running (done on the first connect)
+"""
+
+import asyncio
+import os
+import random
+import secrets
+import signal
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core import signing
+
+from .chat import chat_writer
+from .lobby import get_lobby
+
+DEFAULT_DRAIN_SETTINGS = {
+    "TIMEOUT": 20,  # Seconds the worker waits for its consumers to be gone
+    "RECONNECT_SPREAD": 10,  # Clients are asked to come back within this many seconds
+    "RESUME_MAX_AGE": 120,  # Seconds a resume token stays valid
+}
+
+RESUME_SALT = "realtime.drain.resume"
+
+
+def get_drain_settings():
+    """
+    Returns the REALTIME_DRAIN settings merged over the defaults.
+    """
+    return {**DEFAULT_DRAIN_SETTINGS, **getattr(settings, "REALTIME_DRAIN", {})}
+
+
+def make_resume_token(username, enqueued_at):
+    """
+    Returns the signed token giving the user its place in the lobby back on the next connection.
+    """
+    return signing.dumps(
+        {"username": username, "enqueued_at": enqueued_at, "nonce": secrets.token_urlsafe(12)},
+        salt=RESUME_SALT,
+    )
+
+
+async def use_resume_token(token, username):
+    """
+    Returns the enqueue time saved in the token, None if it is invalid, expired, of another user or used already.
+    """
+    max_age = get_drain_settings()["RESUME_MAX_AGE"]
+    try:
+        data = signing.loads(token, salt=RESUME_SALT, max_age=max_age)
+    except signing.BadSignature:
+        return None
+
+    if data.get("username") != username or not isinstance(data.get("nonce"), str):
+        return None
+    if not await get_lobby().use_resume_nonce(data["nonce"], max_age):
+        return None
+    return data.get("enqueued_at")
+
+
+class DrainController:
+    """
+    Keeps the websockets of the process and drains them when the process is asked to stop.
+    """
+
+    def __init__(self):
+        self.channels = set()
+        self.draining = False
+        self.installed = False
+        self.previous_handler = None
+        self.task = None
+
+    def track(self, channel_name):
+        self.channels.add(channel_name)
+
+    def untrack(self, channel_name):
+        self.channels.discard(channel_name)
+
+    def install(self):
+        """
+        Puts the drain in front of the SIGTERM handler of the server.
+
+        It has to run after the server installed its own handler, which is
+        called once the drain is over.
+        """
+        if self.installed:
+            return
+        self.installed = True
+
+        try:
+            self.previous_handler = signal.getsignal(signal.SIGTERM)
+            signal.signal(signal.SIGTERM, self.handle_sigterm)
+        except ValueError:
+            # Signals can only be handled in the main thread, the server stops the hard way then
+            print("!!! Drain on SIGTERM not installed, the event loop is not in the main thread !!!")
+
+    def handle_sigterm(self, signum, frame):
+        if self.draining:
+            return
+        self.draining = True
+
+        loop = asyncio.get_event_loop()
+        self.task = loop.create_task(self.drain(signum, frame))
+
+    async def drain(self, signum=signal.SIGTERM, frame=None):
+        """
+        Drains every websocket of the process, then hands the signal over to the server.
+        """
+        drain_settings = get_drain_settings()
+        channel_layer = get_channel_layer()
+
+        print(f"Draining {len(self.channels)} websockets...")
+        for channel_name in list(self.channels):
+            try:
+                await channel_layer.send(channel_name, {
+                    "type": "worker.drain",
+                    "retry_after": round(random.uniform(0, drain_settings["RECONNECT_SPREAD"]), 1),
+                })
+            except Exception as e:
+                print("!!! Got Error when draining a websocket !!!", e)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + drain_settings["TIMEOUT"]
+        while self.channels and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+
+        # The chat messages still in the buffer are written before the process stops
+        await chat_writer.flush()
+
+        if callable(self.previous_handler):
+            self.previous_handler(signum, frame)
+        elif self.previous_handler != signal.SIG_IGN:
+            # No handler of the server, the default one stops the process
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+
+# Drain controller of the process
+drain = DrainController()
@@ -0,0 +1,85 @@
+"""
+HTTP endpoint serving the realtime metrics of the process.
+
+The metrics (realtime.metrics) are kept in the memory of every Daphne
+process, recording them never does any I/O. This endpoint renders them in
+the Prometheus text format when scraped, the lobby depth is the only value
+read from the lobby and it is read at most once every LOBBY_DEPTH_INTERVAL
+seconds, whatever the number of scrapes.
+
+The endpoint is answered by the ASGI application itself, before Django, so
+a scrape costs no middleware or database work. Only the ALLOWED_IPS can
+scrape it.
+
+How to use:
+    application = ProtocolTypeRouter({"http": MetricsEndpoint(django_asgi_app), ...})
+    curl http://127.0.0.1:8000/metrics
+"""
+
+import time
+
+from django.conf import settings
+
+from .lobby import get_lobby
+from .metrics import LOBBY_DEPTH, render_metrics
+
+DEFAULT_METRICS_SETTINGS = {
+    "PATH": "/metrics",
+    "ALLOWED_IPS": ["127.0.0.1", "::1"],
+    "LOBBY_DEPTH_INTERVAL": 5,  # Seconds the lobby depth is cached for
+}
+
+
+def get_metrics_settings():
+    """
+    Returns the REALTIME_METRICS settings merged over the defaults.
+    """
+    return {**DEFAULT_METRICS_SETTINGS, **getattr(settings, "REALTIME_METRICS", {})}
+
+
+class MetricsEndpoint:
+    """
+    ASGI middleware answering the metrics path and passing every other request to the wrapped application.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        metrics_settings = get_metrics_settings()
+        self.path = metrics_settings["PATH"]
+        self.allowed_ips = set(metrics_settings["ALLOWED_IPS"])
+        self.lobby_depth_interval = metrics_settings["LOBBY_DEPTH_INTERVAL"]
+        self.lobby_depth_read_at = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            return await self.app(scope, receive, send)
+
+        client = scope.get("client")
+        if not client or client[0] not in self.allowed_ips:
+            return await self.respond(send, 403, b"Forbidden\n")
+
+        await self.refresh_lobby_depth()
+        await self.respond(send, 200, render_metrics().encode())
+
+    async def refresh_lobby_depth(self):
+        now = time.monotonic()
+        if self.lobby_depth_read_at is not None and now - self.lobby_depth_read_at < self.lobby_depth_interval:
+            return
+
+        self.lobby_depth_read_at = now
+        try:
+            LOBBY_DEPTH.set(await get_lobby().size())
+        except Exception as e:
+            # The other metrics are still worth serving while the lobby is down
+            print("!!! Got Error reading the lobby depth !!!", e)
+
+    async def respond(self, send, status, body):
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"text/plain; version=0.0.4; charset=utf-8"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
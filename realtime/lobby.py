@@ -0,0 +1,686 @@
+"""
+Waiting lobby used by the realtime app for matchmaking.
+
+The lobby backend is picked with REALTIME_LOBBY["BACKEND"] in the settings:
+    - realtime.lobby.RedisLobby (default) is shared by every process through Redis.
+      All the operations are done through an asyncio Redis client so the
+      consumers never block the event loop while waiting for Redis.
+    - realtime.memory_lobby.InMemoryLobby lives in the process, for a single
+      Daphne process and for tests (no Redis needed).
+    - realtime.sharded_lobby.ShardedLobby spreads the lobby over many Redis hosts.
+
+How to use:
+    - Get the shared lobby with get_lobby()
+    - await lobby.add(channel_name, user, bucket, presence_ttl) when a user starts waiting
+    - await lobby.claim_pair(...) to take a matched pair out of the lobby
+      (realtime.matchmaking.find_partner decides which pair)
+    - await lobby.remove(channel_name, bucket) when a user leaves before getting matched
+    - await lobby.get_session(session) to find which channels are in a match session
+    - await lobby.refresh_presence(channel_names, ttl) to keep waiting users alive
+      (realtime.presence does it for every process)
+    - await lobby.status(marks) for the lobby size and queue positions (realtime.admission)
+    - await lobby.remember_partners(pairs, ttl, max_partners) once users got matched and
+      await lobby.get_avoided_pairs(pairs) to keep them from meeting again too soon
+    - await lobby.use_resume_nonce(nonce, ttl) so a resume token (realtime.drain) is used once
+"""
+
+import json
+import time
+from functools import cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from redis import asyncio as aioredis
+
+# Globalizing the key names for the waiting lobby in Redis
+WAITING_LOBBY = 'waiting_lobby'  # Sorted set: channel_name -> enqueue time
+WAITING_LOBBY_USERS = 'waiting_lobby:users'  # Hash: channel_name -> user data (json)
+
+WAITING_LOBBY_BUCKET = 'waiting_lobby:bucket:'  # Sorted set per matchmaking bucket: channel_name -> enqueue time
+MATCH_SESSION = 'match_session:'  # Hash per match session: role (user1 / user2) -> channel_name, <role>_username -> username
+WAITING_LOBBY_PRESENCE = 'waiting_lobby:presence'  # Sorted set: channel_name -> time its presence expires
+WAITING_LOBBY_MATCHED = 'waiting_lobby:matched'  # Counter of all the users matched so far
+RECENT_PARTNERS = 'recent_partners:'  # Sorted set per username: partner username -> time the exclusion ends
+RESUME_USED = 'resume_used:'  # String per resume token used already (realtime.drain)
+
+# Match sessions are only needed while the two users are signaling
+MATCH_SESSION_TTL = 60 * 60
+
+# Adds a user to the lobby unless the lobby is full, in a single server side step.
+# Match sessions given after the first four keys are deleted first (rematch).
+#   KEYS: lobby, users hash, bucket, presence, match sessions to end...
+#   ARGV: channel, user data, enqueue time, presence expiry, max lobby size (0 for no limit)
+ADD_SCRIPT = """
+for index = 5, #KEYS do
+    redis.call('DEL', KEYS[index])
+end
+
+local max_size = tonumber(ARGV[5])
+if max_size > 0 and redis.call('ZCARD', KEYS[1]) >= max_size then
+    return 0
+end
+
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+redis.call('ZADD', KEYS[3], ARGV[3], ARGV[1])
+redis.call('ZADD', KEYS[4], ARGV[4], ARGV[1])
+return 1
+"""
+
+# Takes both users out of the lobby in a single server side step and creates
+# their match session. Nothing is taken when one of them is already gone, so
+# a pair can never be half taken by two workers racing with each other.
+# Users whose presence expired are not taken either, they are left for the reaper.
+#   KEYS: lobby, users hash, bucket of user1, bucket of user2, match session, presence, matched counter
+#   ARGV: channel of user1, channel of user2, session ttl, current time,
+#         1 to create the session (0 when it is kept on another host, see realtime.sharded_lobby)
+CLAIM_PAIR_SCRIPT = """
+local user1 = redis.call('HGET', KEYS[2], ARGV[1])
+local user2 = redis.call('HGET', KEYS[2], ARGV[2])
+if not user1 or not user2 then
+    return nil
+end
+
+local now = tonumber(ARGV[4])
+for _, channel in ipairs({ARGV[1], ARGV[2]}) do
+    local expires_at = redis.call('ZSCORE', KEYS[6], channel)
+    if not expires_at or tonumber(expires_at) < now then
+        return nil
+    end
+end
+
+redis.call('ZREM', KEYS[1], ARGV[1], ARGV[2])
+redis.call('HDEL', KEYS[2], ARGV[1], ARGV[2])
+redis.call('ZREM', KEYS[6], ARGV[1], ARGV[2])
+redis.call('ZREM', KEYS[3], ARGV[1])
+redis.call('ZREM', KEYS[4], ARGV[2])
+if ARGV[5] == '1' then
+    redis.call(
+        'HSET', KEYS[5], 'user1', ARGV[1], 'user2', ARGV[2],
+        'user1_username', cjson.decode(user1)['username'], 'user2_username', cjson.decode(user2)['username']
+    )
+    redis.call('EXPIRE', KEYS[5], ARGV[3])
+end
+redis.call('INCRBY', KEYS[7], 2)
+return {user1, user2}
+"""
+
+# Adds a partner to the recent partners of a user, never shortening an
+# exclusion already there (a block outlives a recent match), then drops the
+# ended exclusions, keeps the `max partners` latest ones and lets the whole
+# key expire with its last exclusion.
+#   KEYS: recent partners of the user
+#   ARGV: partner username, time the exclusion ends, current time, max partners
+REMEMBER_PARTNER_SCRIPT = """
+redis.call('ZADD', KEYS[1], 'GT', ARGV[2], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[3])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[4]) - 1)
+
+local last = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+if last[2] then
+    redis.call('EXPIREAT', KEYS[1], math.ceil(tonumber(last[2])))
+end
+return 1
+"""
+
+# Takes one user out of the lobby if its presence has not expired, the
+# sharded lobby pairs users of two different Redis hosts with it.
+#   KEYS: lobby, users hash, bucket, presence
+#   ARGV: channel, current time
+#   Returns: {user data, presence expiry} or nil
+TAKE_SCRIPT = """
+local user = redis.call('HGET', KEYS[2], ARGV[1])
+local expires_at = redis.call('ZSCORE', KEYS[4], ARGV[1])
+if not user or not expires_at or tonumber(expires_at) < tonumber(ARGV[2]) then
+    return nil
+end
+
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('ZREM', KEYS[3], ARGV[1])
+redis.call('ZREM', KEYS[4], ARGV[1])
+return {user, expires_at}
+"""
+
+
+def bucket_key(bucket):
+    return WAITING_LOBBY_BUCKET + bucket
+
+
+def session_key(session):
+    return MATCH_SESSION + session
+
+
+def resume_used_key(nonce):
+    return RESUME_USED + nonce
+
+
+def recent_partners_key(username):
+    return RECENT_PARTNERS + username
+
+
+def partners_to_check(pairs):
+    """
+    Returns the one way exclusions to look up for the given pairs, both ways.
+
+    Returns:
+        dict: username -> list of partner usernames.
+    """
+    checks = {}
+    for username1, username2 in pairs:
+        checks.setdefault(username1, {})[username2] = None
+        checks.setdefault(username2, {})[username1] = None
+    return {username: list(partners) for username, partners in checks.items()}
+
+
+class BaseLobby:
+    """
+    Operations every lobby backend implements, see RedisLobby for what each of them does.
+
+    Users are dictionaries, channels are channel names of the channel layer
+    and buckets are the matchmaking buckets of realtime.matchmaking.
+    """
+
+    async def add(self, channel_name, user, bucket, presence_ttl, end_sessions=(), max_size=0, enqueued_at=None):
+        raise NotImplementedError
+
+    async def remove(self, channel_name, bucket):
+        raise NotImplementedError
+
+    async def remove_many(self, entries):
+        raise NotImplementedError
+
+    async def oldest(self, count, offset=0):
+        raise NotImplementedError
+
+    async def peek_buckets(self, buckets, count):
+        raise NotImplementedError
+
+    async def get_users(self, channel_names, buckets=None):
+        raise NotImplementedError
+
+    async def refresh_presence(self, channel_names, presence_ttl):
+        raise NotImplementedError
+
+    async def reap_expired(self, limit):
+        raise NotImplementedError
+
+    async def claim_pair(self, channel1, bucket1, channel2, bucket2, session):
+        raise NotImplementedError
+
+    async def claim_pairs(self, pairs):
+        raise NotImplementedError
+
+    async def size(self):
+        raise NotImplementedError
+
+    async def status(self, marks):
+        raise NotImplementedError
+
+    async def remember_partners(self, pairs, ttl, max_partners):
+        raise NotImplementedError
+
+    async def block(self, username, blocked_username, ttl, max_partners):
+        raise NotImplementedError
+
+    async def get_avoided_pairs(self, pairs):
+        raise NotImplementedError
+
+    async def get_session(self, session):
+        raise NotImplementedError
+
+    async def end_sessions(self, sessions):
+        raise NotImplementedError
+
+    async def use_resume_nonce(self, nonce, ttl):
+        raise NotImplementedError
+
+
+class RedisLobby(BaseLobby):
+    """
+    Keeps the waiting users in Redis sorted sets scored by the time they joined.
+
+    The lowest score is always the user who has been waiting the longest, so
+    the FIFO order is kept, while a user can be removed with ZREM (O(log n))
+    and HDEL (O(1)) instead of scanning the whole lobby.
+
+    Every user is in the global lobby and in the sorted set of its
+    matchmaking bucket (see realtime.matchmaking), the bucket sets are the
+    index used to find a compatible partner.
+
+    A user is only matched while its presence has not expired. The presence
+    is refreshed by the process holding the user's connection, so when that
+    process dies its users expire and get reaped instead of being matched.
+    """
+
+    def __init__(self, url, max_connections=50):
+        # One connection pool is shared by every consumer of the process.
+        # When all the connections are busy the consumer waits for a free one
+        # instead of failing, which keeps bursts of connects from erroring out.
+        self.pool = aioredis.BlockingConnectionPool.from_url(
+            url,
+            decode_responses=True,
+            max_connections=max_connections,
+        )
+        self.client = aioredis.Redis(connection_pool=self.pool)
+        self.add_script = self.client.register_script(ADD_SCRIPT)
+        self.claim_pair_script = self.client.register_script(CLAIM_PAIR_SCRIPT)
+        self.remember_partner_script = self.client.register_script(REMEMBER_PARTNER_SCRIPT)
+        self.take_script = self.client.register_script(TAKE_SCRIPT)
+
+    async def add(self, channel_name, user, bucket, presence_ttl, end_sessions=(), max_size=0, enqueued_at=None):
+        """
+        Adds the user (dictionary) to the waiting lobby under the given bucket.
+
+        The time of joining and the bucket are saved in the user data as `enqueued_at` and `bucket`.
+        The presence of the user expires after `presence_ttl` seconds unless refreshed.
+        Match sessions given in `end_sessions` are deleted in the same step,
+        which is how a matched user is put back in the lobby (rematch).
+        The user is not added when the lobby already has `max_size` users (0 for no limit).
+        A user coming back from a drained worker (realtime.drain) gives its
+        original `enqueued_at` to get its place in the queue back.
+
+        Returns:
+            float or None: The enqueue time, None when the lobby is full.
+        """
+        enqueued_at = enqueued_at or time.time()
+        presence_expires_at = time.time() + presence_ttl
+        user = {**user, "enqueued_at": enqueued_at, "bucket": bucket}
+        added = await self.add_script(
+            keys=[
+                WAITING_LOBBY, WAITING_LOBBY_USERS, bucket_key(bucket), WAITING_LOBBY_PRESENCE,
+                *(session_key(session) for session in end_sessions),
+            ],
+            args=[channel_name, json.dumps(user), enqueued_at, presence_expires_at, max_size],
+        )
+        return enqueued_at if added else None
+
+    async def remove(self, channel_name, bucket):
+        """
+        Removes the user from the waiting lobby if it is still there.
+        """
+        await self.remove_many([(channel_name, bucket)])
+
+    async def remove_many(self, entries):
+        """
+        Removes many users at once, entries is a list of (channel_name, bucket).
+
+        The bucket can be None when it is not known, the bucket index is then
+        cleaned up lazily by the matchmaking.
+        """
+        async with self.client.pipeline(transaction=True) as pipe:
+            for channel_name, bucket in entries:
+                pipe.hdel(WAITING_LOBBY_USERS, channel_name)
+                pipe.zrem(WAITING_LOBBY, channel_name)
+                pipe.zrem(WAITING_LOBBY_PRESENCE, channel_name)
+                if bucket:
+                    pipe.zrem(bucket_key(bucket), channel_name)
+            await pipe.execute()
+
+    async def oldest(self, count, offset=0):
+        """
+        Returns the channel names of the `count` users who waited the longest after the `offset` first ones.
+        """
+        return await self.client.zrange(WAITING_LOBBY, offset, offset + count - 1)
+
+    async def oldest_with_times(self, count):
+        """
+        Returns (enqueued_at, channel_name) of the `count` users who waited the longest.
+        """
+        members = await self.client.zrange(WAITING_LOBBY, 0, count - 1, withscores=True)
+        return [(score, channel_name) for channel_name, score in members]
+
+    async def peek_buckets(self, buckets, count):
+        """
+        Returns the oldest `count` users of every given bucket in one round trip.
+
+        Returns:
+            list: (channel_name, bucket) tuples, the user who waited the longest first.
+        """
+        entries = await self.peek_buckets_with_times(buckets, count)
+        return [(channel_name, bucket) for _, channel_name, bucket in entries]
+
+    async def peek_buckets_with_times(self, buckets, count):
+        """
+        Same as peek_buckets() with the enqueue times, as (enqueued_at, channel_name, bucket) tuples.
+        """
+        async with self.client.pipeline(transaction=False) as pipe:
+            for bucket in buckets:
+                pipe.zrange(bucket_key(bucket), 0, count - 1, withscores=True)
+            results = await pipe.execute()
+
+        entries = [
+            (score, channel_name, bucket)
+            for bucket, members in zip(buckets, results)
+            for channel_name, score in members
+        ]
+        entries.sort()
+        return entries
+
+    async def get_users(self, channel_names, buckets=None):
+        """
+        Returns the user data of the given channels.
+
+        None is returned for the ones not in the lobby and for the ones whose presence expired.
+        The buckets of the users can be given when they are known, only the sharded lobby uses them.
+        """
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.hmget(WAITING_LOBBY_USERS, channel_names)
+            pipe.zmscore(WAITING_LOBBY_PRESENCE, channel_names)
+            users, presence = await pipe.execute()
+
+        now = time.time()
+        return [
+            json.loads(user) if user and expires_at and expires_at >= now else None
+            for user, expires_at in zip(users, presence)
+        ]
+
+    async def refresh_presence(self, channel_names, presence_ttl):
+        """
+        Pushes the presence expiry of the given waiting users `presence_ttl` seconds away.
+
+        Users not waiting anymore are not added back (ZADD XX), so it is one
+        command for all the users of a process.
+        """
+        if not channel_names:
+            return
+
+        expires_at = time.time() + presence_ttl
+        await self.client.zadd(
+            WAITING_LOBBY_PRESENCE,
+            {channel_name: expires_at for channel_name in channel_names},
+            xx=True,
+        )
+
+    async def reap_expired(self, limit):
+        """
+        Removes up to `limit` users whose presence expired from the lobby.
+
+        Returns:
+            int: Number of users removed.
+        """
+        channel_names = await self.client.zrangebyscore(
+            WAITING_LOBBY_PRESENCE, "-inf", time.time(), start=0, num=limit,
+        )
+        if not channel_names:
+            return 0
+
+        users = await self.client.hmget(WAITING_LOBBY_USERS, channel_names)
+        await self.remove_many([
+            (channel_name, user and json.loads(user)["bucket"])
+            for channel_name, user in zip(channel_names, users)
+        ])
+        return len(channel_names)
+
+    def _claim_keys(self, bucket1, bucket2, session):
+        return [
+            WAITING_LOBBY, WAITING_LOBBY_USERS, bucket_key(bucket1), bucket_key(bucket2),
+            session_key(session), WAITING_LOBBY_PRESENCE, WAITING_LOBBY_MATCHED,
+        ]
+
+    async def claim_pair(self, channel1, bucket1, channel2, bucket2, session, create_session=True):
+        """
+        Atomically takes both users out of the lobby and creates their match session.
+
+        The session is not created with `create_session=False`, the caller keeps it
+        somewhere else (the sharded lobby keeps it on the host of the session).
+
+        Returns:
+            tuple or None: (user1, user2) as dictionaries, None if any of them is not in the lobby anymore.
+        """
+        pair = await self.claim_pair_script(
+            keys=self._claim_keys(bucket1, bucket2, session),
+            args=[channel1, channel2, MATCH_SESSION_TTL, time.time(), int(create_session)],
+        )
+        if not pair:
+            return None
+
+        user1, user2 = pair
+        return json.loads(user1), json.loads(user2)
+
+    async def claim_pairs(self, pairs, create_sessions=True):
+        """
+        Takes many pairs out of the lobby in one pipelined round trip.
+
+        Args:
+            pairs (list): (channel1, bucket1, channel2, bucket2, session) tuples.
+            create_sessions (bool): Same as `create_session` of claim_pair().
+
+        Returns:
+            list: (session, user1, user2) for every pair claimed, the pairs where a user was gone are left out.
+        """
+        now = time.time()
+        async with self.client.pipeline(transaction=False) as pipe:
+            for channel1, bucket1, channel2, bucket2, session in pairs:
+                await self.claim_pair_script(
+                    keys=self._claim_keys(bucket1, bucket2, session),
+                    args=[channel1, channel2, MATCH_SESSION_TTL, now, int(create_sessions)],
+                    client=pipe,
+                )
+            results = await pipe.execute()
+
+        return [
+            (pair[4], json.loads(result[0]), json.loads(result[1]))
+            for pair, result in zip(pairs, results)
+            if result
+        ]
+
+    async def take(self, channel_name, bucket):
+        """
+        Atomically takes one user out of the lobby.
+
+        Returns:
+            tuple or None: (user, presence expiry), None if the user is not in the lobby or expired.
+        """
+        taken = await self.take_script(
+            keys=[WAITING_LOBBY, WAITING_LOBBY_USERS, bucket_key(bucket), WAITING_LOBBY_PRESENCE],
+            args=[channel_name, time.time()],
+        )
+        if not taken:
+            return None
+
+        user, expires_at = taken
+        return json.loads(user), float(expires_at)
+
+    async def put_back(self, user, expires_at):
+        """
+        Puts a user taken with take() back in its place in the lobby.
+        """
+        await self.add_script(
+            keys=[WAITING_LOBBY, WAITING_LOBBY_USERS, bucket_key(user["bucket"]), WAITING_LOBBY_PRESENCE],
+            args=[user["channel_name"], json.dumps(user), user["enqueued_at"], expires_at, 0],
+        )
+
+    async def create_sessions(self, matches, count_matched=True):
+        """
+        Creates the match sessions of users (dictionaries) taken out of the lobby, in one round trip.
+
+        Args:
+            matches (list): (session, user1, user2) tuples.
+            count_matched (bool): Counts the users as matched, False when claim_pair() counted them already.
+        """
+        async with self.client.pipeline(transaction=True) as pipe:
+            for session, user1, user2 in matches:
+                pipe.hset(session_key(session), mapping={
+                    "user1": user1["channel_name"], "user2": user2["channel_name"],
+                    "user1_username": user1["username"], "user2_username": user2["username"],
+                })
+                pipe.expire(session_key(session), MATCH_SESSION_TTL)
+            if count_matched:
+                pipe.incrby(WAITING_LOBBY_MATCHED, 2 * len(matches))
+            await pipe.execute()
+
+    async def size(self):
+        """
+        Returns the number of users waiting in the lobby.
+        """
+        return await self.client.zcard(WAITING_LOBBY)
+
+    async def status(self, marks):
+        """
+        Returns the lobby size, a sample of the queue and how many users were matched so far.
+
+        Instead of the rank of every user, the enqueue time of `marks` users
+        spread evenly over the queue is returned, every user can estimate its
+        own position from them (see realtime.admission.estimate_position).
+
+        Returns:
+            dict: {"size": int, "marks": [[enqueued_at, rank], ...], "matched": int}
+        """
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.zcard(WAITING_LOBBY)
+            pipe.get(WAITING_LOBBY_MATCHED)
+            size, matched = await pipe.execute()
+
+        ranks = sorted({round(mark * (size - 1) / max(marks - 1, 1)) for mark in range(marks)}) if size else []
+        async with self.client.pipeline(transaction=False) as pipe:
+            for rank in ranks:
+                pipe.zrange(WAITING_LOBBY, rank, rank, withscores=True)
+            results = await pipe.execute()
+
+        return {
+            "size": size,
+            "marks": [
+                [members[0][1], rank]
+                for rank, members in zip(ranks, results)
+                if members
+            ],
+            "matched": int(matched or 0),
+        }
+
+    async def remember_partners(self, pairs, ttl, max_partners):
+        """
+        Keeps the users of every pair from being matched together for `ttl` seconds.
+
+        Args:
+            pairs (list): (username1, username2) tuples, both users remember each other.
+            ttl (int): Seconds the exclusion lasts.
+            max_partners (int): Most recent partners kept per user, the oldest ones are forgotten first.
+        """
+        await self.remember_partners_of(
+            [
+                entry
+                for username1, username2 in pairs
+                for entry in ((username1, username2), (username2, username1))
+            ],
+            ttl, max_partners,
+        )
+
+    async def remember_partners_of(self, entries, ttl, max_partners):
+        """
+        Same as remember_partners() one way only, entries are (username, partner) tuples.
+        """
+        if not entries:
+            return
+
+        now = time.time()
+        async with self.client.pipeline(transaction=False) as pipe:
+            for username, partner in entries:
+                await self.remember_partner_script(
+                    keys=[recent_partners_key(username)],
+                    args=[partner, now + ttl, now, max_partners],
+                    client=pipe,
+                )
+            await pipe.execute()
+
+    async def block(self, username, blocked_username, ttl, max_partners):
+        """
+        Keeps `blocked_username` away from the user for `ttl` seconds.
+
+        Only the blocking user remembers it, get_avoided_pairs() checks both ways.
+        """
+        await self.remember_partner_script(
+            keys=[recent_partners_key(username)],
+            args=[blocked_username, time.time() + ttl, time.time(), max_partners],
+        )
+
+    async def get_avoided_pairs(self, pairs):
+        """
+        Returns the given pairs whose users met recently or where one blocked the other.
+
+        Only the given pairs are looked up, never the whole recent partners of a user.
+
+        Args:
+            pairs (list): (username1, username2) tuples, e.g. a user and its candidates.
+
+        Returns:
+            set: The avoided pairs, in both orders.
+        """
+        avoided = await self.get_avoided_partners(partners_to_check(pairs))
+        return avoided | {(partner, username) for username, partner in avoided}
+
+    async def get_avoided_partners(self, checks):
+        """
+        Looks up one way exclusions in one pipelined round trip, one ZMSCORE per username.
+
+        Args:
+            checks (dict): username -> list of partner usernames to look up.
+
+        Returns:
+            set: (username, partner) tuples of the partners the user still avoids.
+        """
+        if not checks:
+            return set()
+
+        now = time.time()
+        async with self.client.pipeline(transaction=False) as pipe:
+            for username, partners in checks.items():
+                pipe.zmscore(recent_partners_key(username), partners)
+            results = await pipe.execute()
+
+        return {
+            (username, partner)
+            for (username, partners), scores in zip(checks.items(), results)
+            for partner, ends_at in zip(partners, scores)
+            if ends_at is not None and float(ends_at) > now
+        }
+
+    async def get_session(self, session):
+        """
+        Returns the channels of a match session as {"user1": channel_name, "user2": channel_name},
+        with the usernames as "user1_username" and "user2_username".
+
+        An empty dictionary is returned when the session does not exist (or expired).
+        """
+        return await self.client.hgetall(session_key(session))
+
+    async def end_sessions(self, sessions):
+        """
+        Deletes the given match sessions.
+        """
+        if sessions:
+            await self.client.delete(*(session_key(session) for session in sessions))
+
+    async def use_resume_nonce(self, nonce, ttl):
+        """
+        Marks the nonce of a resume token as used for `ttl` seconds (the lifetime of the token).
+
+        Returns:
+            bool: True the first time only, so a token can not be replayed.
+        """
+        return bool(await self.client.set(resume_used_key(nonce), 1, nx=True, ex=ttl))
+
+
+def get_lobby_settings():
+    """
+    Returns the REALTIME_LOBBY settings, the Redis lobby on REDIS_URL when they are not set.
+    """
+    lobby_settings = getattr(settings, "REALTIME_LOBBY", None)
+    if lobby_settings is None:
+        return {
+            "BACKEND": "realtime.lobby.RedisLobby",
+            "OPTIONS": {
+                "url": settings.REDIS_URL,
+                "max_connections": getattr(settings, "REDIS_MAX_CONNECTIONS", 50),
+            },
+        }
+    return {"OPTIONS": {}, **lobby_settings}
+
+
+@cache
+def get_lobby():
+    """
+    Returns the lobby shared by the whole process.
+    """
+    lobby_settings = get_lobby_settings()
+    return import_string(lobby_settings["BACKEND"])(**lobby_settings["OPTIONS"])
@@ -0,0 +1,414 @@
+import asyncio
+import base64
+import json
+import os
+import resource
+import secrets
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+
+from realtime.lobby import get_lobby
+from realtime.matcher import BatchMatcher, get_matcher_settings
+
+
+def percentiles(values):
+    """
+    Returns count and p50/p95/p99/max of the values (milliseconds), exact since every value is kept.
+    """
+    if not values:
+        return {"count": 0}
+
+    values = sorted(values)
+
+    def at(percent):
+        return round(values[min(len(values) - 1, int(len(values) * percent / 100))], 2)
+
+    return {"count": len(values), "p50": at(50), "p95": at(95), "p99": at(99), "max": round(values[-1], 2)}
+
+
+class NetworkCommunicator:
+    """
+    Websocket client over the network, with the methods of WebsocketCommunicator the load test uses.
+
+    A minimal RFC 6455 client on asyncio streams (text frames only): the
+    websocket libraries installed with Daphne run on Twisted, which cannot
+    share the process with asyncio ones.
+    """
+
+    def __init__(self, host, port, path):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, timeout):
+        key = base64.b64encode(os.urandom(16)).decode()
+        try:
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), timeout)
+            self.writer.write((
+                f"GET {self.path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+                f"Upgrade: websocket\r\nConnection: Upgrade\r\n"
+                f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n"
+            ).encode())
+            response = await asyncio.wait_for(self.reader.readuntil(b"\r\n\r\n"), timeout)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return False, None
+        return response.startswith(b"HTTP/1.1 101"), None
+
+    async def receive_json_from(self, timeout):
+        return json.loads(await asyncio.wait_for(self.receive_text(), timeout))
+
+    async def receive_text(self):
+        message = b""
+        while True:
+            try:
+                head = await self.reader.readexactly(2)
+                length = head[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack("!H", await self.reader.readexactly(2))[0]
+                elif length == 127:
+                    length = struct.unpack("!Q", await self.reader.readexactly(8))[0]
+                payload = await self.reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                payload, head = b"", (0x88, 0)
+
+            opcode = head[0] & 0x0F
+            # Same as WebsocketCommunicator on a closed socket
+            assert opcode != 0x8, "The socket was closed"
+            if opcode == 0x9:
+                await self.send_frame(0xA, payload)
+                continue
+            if opcode in (0x0, 0x1):
+                message += payload
+                if head[0] & 0x80:
+                    return message.decode()
+
+    async def send_json_to(self, data):
+        await self.send_frame(0x1, json.dumps(data).encode())
+
+    async def send_frame(self, opcode, payload):
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            head = struct.pack("!BB", 0x80 | opcode, 0x80 | length)
+        elif length < 2 ** 16:
+            head = struct.pack("!BBH", 0x80 | opcode, 0x80 | 126, length)
+        else:
+            head = struct.pack("!BBQ", 0x80 | opcode, 0x80 | 127, length)
+        masked = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+        self.writer.write(head + mask + masked)
+        await self.writer.drain()
+
+    async def disconnect(self, timeout=5):
+        if self.writer is None or self.writer.is_closing():
+            return
+        try:
+            await self.send_frame(0x8, struct.pack("!H", 1000))
+            # The server answers the close frame before the socket goes, what it still sends is dropped
+            while True:
+                await asyncio.wait_for(self.receive_text(), timeout)
+        except (OSError, asyncio.TimeoutError, AssertionError):
+            pass
+        finally:
+            self.writer.close()
+
+
+class LoadTest:
+    """
+    Simulated clients going through the whole realtime path of the ASGI application:
+    connect, match, offer, answer and trickle ICE, then disconnect.
+
+    `communicator` makes the client of a websocket path:
+        - in-process (WebsocketCommunicator on the application): the consumers,
+          the channel layer and the lobby of the settings are exercised without
+          a network, but the clients share the process and its CPU with them,
+          the numbers are estimates of the realtime path, not of a server
+        - over the network (NetworkCommunicator) to a server running in other
+          processes (--server), whose CPU is measured apart from the clients
+    """
+
+    def __init__(self, communicator, clients, concurrency, ice_candidates, timeout):
+        self.communicator = communicator
+        self.clients = clients
+        self.connecting = asyncio.Semaphore(concurrency)
+        self.ice_candidates = ice_candidates
+        self.timeout = timeout
+        self.run_id = secrets.token_hex(3)
+
+        self.connect_times = []
+        self.match_times = []
+        self.offer_answer_times = []
+        self.ice_times = []
+        self.errors = {}
+        self.connects_done_at = None
+        # CPU seconds of the server processes, None when the clients run in the server's process
+        self.server_cpu = None
+
+    def error(self, reason):
+        self.errors[reason] = self.errors.get(reason, 0) + 1
+
+    async def receive(self, communicator, *signal_types):
+        """
+        Returns the next message of one of the given types, other messages (queue position...) are skipped.
+        """
+        while True:
+            message = await communicator.receive_json_from(timeout=self.timeout)
+            if message.get("signal_type") in signal_types:
+                return message
+
+    async def client(self, index):
+        communicator = self.communicator(f"/connection-request/?username=load-{self.run_id}-{index}")
+
+        async with self.connecting:
+            started = time.perf_counter()
+            connected, _ = await communicator.connect(timeout=self.timeout)
+            self.connect_times.append((time.perf_counter() - started) * 1000)
+            self.connects_done_at = time.perf_counter()
+
+        if not connected:
+            self.error("not_connected")
+            return
+
+        try:
+            match = await self.receive(communicator, "match", "busy")
+            if match["signal_type"] == "busy":
+                self.error(f"busy_{match['reason']}")
+                return
+            self.match_times.append((time.perf_counter() - started) * 1000)
+
+            session = match["session"]
+            role = match["role"]
+
+            # user1 makes the offer, user2 answers it
+            if role == "user1":
+                sent_at = time.perf_counter()
+                await communicator.send_json_to({"session": session, "signal_type": "offer", "sdp": "offer"})
+                await self.receive(communicator, "answer")
+                self.offer_answer_times.append((time.perf_counter() - sent_at) * 1000)
+            else:
+                await self.receive(communicator, "offer")
+                await communicator.send_json_to({"session": session, "signal_type": "answer", "sdp": "answer"})
+
+            # Both sides trickle their candidates and wait for all the candidates of the peer
+            sent_at = time.perf_counter()
+            for candidate in range(self.ice_candidates):
+                await communicator.send_json_to({
+                    "session": session,
+                    "signal_type": f"ice_candidate_{role}",
+                    "candidate": candidate,
+                })
+
+            peer_candidate_type = "ice_candidate_user2" if role == "user1" else "ice_candidate_user1"
+            for _ in range(self.ice_candidates):
+                await self.receive(communicator, peer_candidate_type)
+            if self.ice_candidates:
+                self.ice_times.append((time.perf_counter() - sent_at) * 1000)
+        except asyncio.TimeoutError:
+            self.error("timeout")
+        except AssertionError:
+            # The communicator asserts on a closed socket
+            self.error("closed")
+        finally:
+            await communicator.disconnect()
+
+    async def run(self, matcher=None):
+        matcher_task = asyncio.create_task(matcher.run()) if matcher else None
+
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        await asyncio.gather(*(self.client(index) for index in range(self.clients)))
+        self.elapsed = time.perf_counter() - started
+        self.cpu = time.process_time() - cpu_started
+        self.connect_elapsed = (self.connects_done_at or time.perf_counter()) - started
+
+        if matcher_task:
+            matcher_task.cancel()
+
+    def report(self):
+        matches = len(self.match_times) // 2
+        return {
+            "clients": self.clients,
+            "elapsed_seconds": round(self.elapsed, 2),
+            "connects_per_second": round(len(self.connect_times) / self.connect_elapsed, 1) if self.connect_elapsed else None,
+            "matches": matches,
+            "matches_per_second": round(matches / self.elapsed, 1) if self.elapsed else None,
+            "connect_ms": percentiles(self.connect_times),
+            "time_to_match_ms": percentiles(self.match_times),
+            "offer_answer_rtt_ms": percentiles(self.offer_answer_times),
+            "ice_exchange_ms": percentiles(self.ice_times),
+            **self.cpu_report(matches),
+            "errors": self.errors,
+        }
+
+    def cpu_report(self, matches):
+        if not matches:
+            return {"cpu_ms_per_match": None}
+        if self.server_cpu is not None:
+            return {"cpu_ms_per_match": round(self.server_cpu * 1000 / matches, 3)}
+        # The simulated clients run in the same process, their CPU is in it and it is only an upper bound
+        return {"in_process_cpu_ms_per_match": round(self.cpu * 1000 / matches, 3)}
+
+
+class ServerProcesses:
+    """
+    Daphne (and the background matcher in "tick" mode) started in processes of their own.
+
+    Their CPU time is read from /proc between the server being ready and
+    being stopped, so the startup (Django imports) and the drain are left
+    out. Without /proc it is read once they exited (RUSAGE_CHILDREN), with
+    them. The processes only share the lobby and the channel layer through Redis, the
+    in-memory backends only work with one Daphne process in "inline" mode.
+    """
+
+    def __init__(self, host, port, with_matcher):
+        self.host = host
+        self.port = port
+        self.with_matcher = with_matcher
+        self.processes = []
+        self.cpu_before = None
+
+    def start(self, timeout=30):
+        self.children_cpu_before = self.children_cpu()
+        self.processes.append(subprocess.Popen([
+            sys.executable, "-m", "daphne", "-b", self.host, "-p", str(self.port), "GuffMandu.asgi:application",
+        ], env=os.environ.copy()))
+        if self.with_matcher:
+            self.processes.append(subprocess.Popen(
+                [sys.executable, "manage.py", "run_matcher"], env=os.environ.copy(),
+            ))
+
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                socket.create_connection((self.host, self.port), timeout=1).close()
+                self.cpu_before = self.processes_cpu()
+                return
+            except OSError:
+                if time.monotonic() > deadline or self.processes[0].poll() is not None:
+                    self.stop()
+                    raise CommandError(f"The server did not start on {self.host}:{self.port}.")
+                time.sleep(0.2)
+
+    def stop(self):
+        """
+        Stops the processes and returns the CPU seconds they used since they were ready.
+        """
+        cpu = self.processes_cpu()
+        if cpu is not None and self.cpu_before is not None:
+            cpu -= self.cpu_before
+
+        for process in self.processes:
+            if process.poll() is None:
+                # Daphne drains the websockets still open on SIGTERM (realtime.drain)
+                process.send_signal(signal.SIGTERM)
+        for process in self.processes:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+        if cpu is None:
+            cpu = self.children_cpu() - self.children_cpu_before
+        return cpu
+
+    def processes_cpu(self):
+        """
+        Returns the CPU seconds used so far by the running processes, None without /proc.
+        """
+        ticks = 0
+        try:
+            for process in self.processes:
+                with open(f"/proc/{process.pid}/stat") as stat:
+                    # utime and stime, after the command name in parentheses
+                    fields = stat.read().rsplit(")", 1)[1].split()
+                ticks += int(fields[11]) + int(fields[12])
+        except OSError:
+            return None
+        return ticks / os.sysconf("SC_CLK_TCK")
+
+    def children_cpu(self):
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs simulated websocket clients through connect, match, offer, answer and ICE exchange "
+        "against the realtime app and reports the throughput and latencies. By default the clients "
+        "run in the same process as the app (estimates), with --server against a Daphne server "
+        "started in its own process."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=1000, help="Simulated clients, rounded up to an even number.")
+        parser.add_argument("--concurrency", type=int, default=200, help="Connects in flight at the same time.")
+        parser.add_argument("--ice-candidates", type=int, default=5, help="ICE candidates sent by every client.")
+        parser.add_argument("--timeout", type=float, default=30, help="Seconds a client waits for every message.")
+        parser.add_argument(
+            "--server", action="store_true",
+            help="Start Daphne (and run_matcher in tick mode) in other processes and connect over the network.",
+        )
+        parser.add_argument("--port", type=int, default=8765, help="Port of the server started with --server.")
+
+    def handle(self, *args, **options):
+        if options["clients"] < 2:
+            raise CommandError("At least 2 clients are needed to get a match.")
+
+        matcher_settings = get_matcher_settings()
+        tick_mode = matcher_settings["MODE"] == "tick"
+
+        if options["server"]:
+            host, port = "127.0.0.1", options["port"]
+            communicator = lambda path: NetworkCommunicator(host, port, path)
+        else:
+            # Imported here, the ASGI module sets the Django application up
+            from GuffMandu.asgi import application
+            communicator = lambda path: WebsocketCommunicator(application, path)
+
+        load_test = LoadTest(
+            communicator,
+            clients=options["clients"] + options["clients"] % 2,
+            concurrency=options["concurrency"],
+            ice_candidates=options["ice_candidates"],
+            timeout=options["timeout"],
+        )
+
+        # In "tick" mode nobody is matched without the background matcher,
+        # it runs in this process with the in-process clients
+        matcher = None
+        if tick_mode and not options["server"]:
+            matcher = BatchMatcher(
+                lobby=get_lobby(),
+                channel_layer=get_channel_layer(),
+                tick_ms=matcher_settings["TICK_MS"],
+                batch_size=matcher_settings["BATCH_SIZE"],
+                report_interval=None,
+            )
+
+        where = f"a server on port {options['port']}" if options["server"] else "this process (estimates)"
+        self.stdout.write(
+            f"Running {load_test.clients} clients against {where} (matcher mode: {matcher_settings['MODE']})..."
+        )
+
+        if options["server"]:
+            server = ServerProcesses(host, port, with_matcher=tick_mode)
+            server.start()
+            try:
+                asyncio.run(load_test.run())
+            finally:
+                load_test.server_cpu = server.stop()
+        else:
+            asyncio.run(load_test.run(matcher))
+
+        for name, value in load_test.report().items():
+            self.stdout.write(f"{name}: {value}")
@@ -0,0 +1,70 @@
+import asyncio
+
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from realtime.admission import LobbyStatusBroadcaster, get_admission_settings
+from realtime.lobby import get_lobby
+from realtime.matcher import BatchMatcher, get_matcher_settings
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the background matcher which pairs the users of the waiting lobby on a fixed tick, "
+        "reaps the expired users and sends the queue position updates."
+    )
+
+    def add_arguments(self, parser):
+        matcher_settings = get_matcher_settings()
+
+        parser.add_argument("--tick-ms", type=int, default=matcher_settings["TICK_MS"])
+        parser.add_argument("--batch-size", type=int, default=matcher_settings["BATCH_SIZE"])
+        parser.add_argument("--report-interval", type=int, default=matcher_settings["REPORT_INTERVAL"])
+        parser.add_argument("--steal-tick-ms", type=int, default=matcher_settings["STEAL_TICK_MS"])
+
+    def handle(self, *args, **options):
+        matching = get_matcher_settings()["MODE"] == "tick"
+        if not matching:
+            self.stdout.write(self.style.WARNING(
+                'REALTIME_MATCHER["MODE"] is not "tick", only reaping and queue position updates will run.'
+            ))
+
+        admission = get_admission_settings()
+        lobby = get_lobby()
+        channel_layer = get_channel_layer()
+
+        # A sharded lobby gets one matcher per shard, the matcher of the whole
+        # lobby then only steals the pairs across shards on a slower tick
+        shards = getattr(lobby, "shard_lobbies", [])
+        shard_matchers = [
+            BatchMatcher(
+                lobby=shard,
+                channel_layer=channel_layer,
+                tick_ms=options["tick_ms"],
+                batch_size=options["batch_size"],
+                report_interval=None,
+            )
+            for shard in shards
+        ] if matching else []
+
+        matcher = BatchMatcher(
+            lobby=lobby,
+            channel_layer=channel_layer,
+            tick_ms=options["steal_tick_ms"] if shards else options["tick_ms"],
+            batch_size=options["batch_size"],
+            # In "inline" mode the matches, and so their latency, are in the Daphne processes
+            report_interval=options["report_interval"] if matching else None,
+            matching=matching,
+            status_broadcaster=LobbyStatusBroadcaster(lobby, channel_layer, admission["STATUS_MARKS"]),
+            status_interval=admission["STATUS_INTERVAL"],
+        )
+
+        self.stdout.write(f"Running every {options['tick_ms']} ms on {max(len(shards), 1)} shard(s)...")
+        try:
+            asyncio.run(self.run_all([matcher, *shard_matchers]))
+        except KeyboardInterrupt:
+            if matching:
+                matcher.report()
+
+    async def run_all(self, matchers):
+        await asyncio.gather(*(matcher.run() for matcher in matchers))
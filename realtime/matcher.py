@@ -0,0 +1,215 @@
+"""
+Background matcher of the realtime app.
+
+Instead of matching inside the connect() of whoever arrives second, the
+matcher drains the oldest users of the waiting lobby on a fixed tick, pairs
+them in bulk and takes all the pairs out of the lobby in one pipelined round
+trip. It trades a little latency (at most one tick) for much higher
+throughput when a lot of users are connecting.
+
+How to use:
+    - Set REALTIME_MATCHER["MODE"] = "tick" in the settings
+    - Run `python manage.py run_matcher` next to the Daphne workers
+
+The matcher also reaps the expired users and sends the queue position
+updates (realtime.admission), so it is worth running in "inline" mode too,
+it just does not match users then.
+
+The match latency p50/p95/p99 is printed every REPORT_INTERVAL by the
+process which makes the matches: the matcher in "tick" mode, every Daphne
+process (latency_reporter) in "inline" mode.
+"""
+
+import asyncio
+import time
+
+from django.conf import settings
+
+from .matchmaking import bucket_of, find_pairs, new_session_id, notify_match, remember_matches
+from .metrics import MATCH_LATENCY_WINDOW
+from .presence import REAP_BATCH_SIZE
+
+DEFAULT_MATCHER_SETTINGS = {
+    "MODE": "inline",  # "inline": match on connect, "tick": background matcher
+    "TICK_MS": 100,  # Time between two matching passes
+    "BATCH_SIZE": 500,  # Oldest users taken from the lobby in one pass
+    "REPORT_INTERVAL": 60,  # Seconds between two match latency reports
+    "STEAL_TICK_MS": 1000,  # Time between two cross-shard passes (realtime.sharded_lobby)
+}
+
+
+def get_matcher_settings():
+    """
+    Returns the REALTIME_MATCHER settings merged over the defaults.
+    """
+    return {**DEFAULT_MATCHER_SETTINGS, **getattr(settings, "REALTIME_MATCHER", {})}
+
+
+class BatchMatcher:
+    """
+    Pairs the users of the waiting lobby in bulk.
+
+    Methods:
+        1. tick(self) -> int
+        2. match_window(self, offset) -> tuple
+        3. run(self)
+        4. report(self)
+    """
+
+    def __init__(self, lobby, channel_layer, tick_ms, batch_size, report_interval,
+                 matching=True, status_broadcaster=None, status_interval=None):
+        self.lobby = lobby
+        self.channel_layer = channel_layer
+        self.tick_seconds = tick_ms / 1000
+        self.batch_size = batch_size
+        self.report_interval = report_interval
+        self.matching = matching
+        self.status_broadcaster = status_broadcaster
+        self.status_interval = status_interval
+        # Start of the window matched behind the oldest users when they can not be paired
+        self.offset = 0
+
+    async def tick(self):
+        """
+        Runs one matching pass over the oldest users of the lobby.
+
+        Users whose presence expired (their Daphne worker died) are reaped first.
+
+        When the oldest users can not be paired with each other (e.g. a batch of
+        users nobody waiting fits yet), the users behind them must not wait
+        for them: a second window, starting further in the lobby every tick it
+        finds no pair, is matched too. It goes back behind the oldest users
+        once it reached the end of the lobby.
+
+        Returns:
+            int: Number of pairs matched.
+        """
+        await self.lobby.reap_expired(REAP_BATCH_SIZE)
+
+        matched, seen = await self.match_window(0)
+        if matched or seen < self.batch_size:
+            return matched
+
+        # Windows overlap by half, the users at the edge of a window are seen with the ones after them too
+        step = max(1, self.batch_size // 2)
+        self.offset = max(self.offset, step)
+
+        matched, seen = await self.match_window(self.offset)
+        if seen < self.batch_size:
+            self.offset = 0
+        elif not matched:
+            self.offset += step
+        return matched
+
+    async def match_window(self, offset):
+        """
+        Pairs the `batch_size` users waiting the longest after the `offset` first ones.
+
+        Returns:
+            tuple: (pairs matched, users in the window).
+        """
+        channel_names = await self.lobby.oldest(self.batch_size, offset)
+        if len(channel_names) < 2:
+            return 0, len(channel_names)
+
+        # Users who left or whose presence expired come back as None,
+        # they are removed by the presence reaper
+        users = [user for user in await self.lobby.get_users(channel_names) if user is not None]
+        pairs = await find_pairs(self.lobby, users)
+        if not pairs:
+            return 0, len(channel_names)
+
+        matched = await self.lobby.claim_pairs([
+            (user1["channel_name"], bucket_of(user1), user2["channel_name"], bucket_of(user2), new_session_id())
+            for user1, user2 in pairs
+        ])
+        await remember_matches(self.lobby, [(user1, user2) for _, user1, user2 in matched])
+
+        await asyncio.gather(*(
+            notify_match(self.channel_layer, session, user1, user2)
+            for session, user1, user2 in matched
+        ))
+        return len(matched), len(channel_names)
+
+    async def run(self):
+        """
+        Runs the matching passes forever, one every tick.
+
+        Without matching only the expired users are reaped every tick.
+        Without a report interval nothing is reported (matchers of the shards of a sharded lobby).
+        The lobby status goes to the waiting users every status interval.
+        """
+        last_report = last_status = time.monotonic()
+
+        while True:
+            started = time.monotonic()
+
+            try:
+                if self.matching:
+                    await self.tick()
+                else:
+                    await self.lobby.reap_expired(REAP_BATCH_SIZE)
+
+                if self.status_broadcaster and started - last_status >= self.status_interval:
+                    await self.status_broadcaster.broadcast()
+                    last_status = started
+            except Exception as e:
+                # A failing pass (e.g. Redis restarting) must not kill the matcher
+                print("!!! Got Error in the matching pass !!!", e)
+
+            if self.report_interval and started - last_report >= self.report_interval:
+                self.report()
+                last_report = started
+
+            # Sleeping only for the rest of the tick keeps the passes evenly spaced
+            elapsed = time.monotonic() - started
+            await asyncio.sleep(max(0, self.tick_seconds - elapsed))
+
+    def report(self):
+        """
+        Prints the time-to-match p50/p95/p99 of the last interval (total and per bucket).
+        """
+        report_match_latency()
+
+
+def report_match_latency():
+    """
+    Prints the time-to-match p50/p95/p99 of this process since the last report, total and per bucket.
+
+    Only the report window is reset, the Prometheus histograms keep counting.
+    """
+    print("Match latency (ms):", MATCH_LATENCY_WINDOW.total.summary())
+    for bucket, summary in MATCH_LATENCY_WINDOW.summary().items():
+        print(f"    {bucket}:", summary)
+    MATCH_LATENCY_WINDOW.reset()
+
+
+class LatencyReporter:
+    """
+    Reports the match latency of a Daphne process every REPORT_INTERVAL, the matches of "inline" mode are made there.
+    """
+
+    def __init__(self):
+        self.task = None
+
+    def start(self):
+        """
+        Starts the reporting task in the running event loop if it is not running yet.
+        """
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        interval = get_matcher_settings()["REPORT_INTERVAL"]
+        if not interval:
+            return
+
+        while True:
+            await asyncio.sleep(interval)
+            # Idle processes stay quiet
+            if MATCH_LATENCY_WINDOW.total.count:
+                report_match_latency()
+
+
+# Match latency reporter of the process
+latency_reporter = LatencyReporter()
@@ -0,0 +1,503 @@
+"""
+Matchmaking rules of the realtime app.
+
+Every waiting user is indexed in exactly one bucket of the lobby, the bucket
+is made from the user's own attributes (gender, age band and language).
+A user's match filters are turned into the small list of buckets which can
+hold a compatible partner, so finding a partner only looks at the oldest few
+users of those buckets instead of scanning the whole lobby.
+
+The longer a user waits the more its filters are relaxed (see relax()), so
+users with rare filters are not starved by the ones who match easily.
+
+Users who met within REALTIME_RECENT_PARTNERS["WINDOW"] seconds, or where
+one blocked the other, are never matched together. The recent partners of
+every user are kept in the lobby, and only the candidate pairs are looked
+up there (see RedisLobby.get_avoided_pairs), never the database.
+
+How to use:
+    - Build the profile of the connecting user with build_profile()
+    - Add the user to the lobby under bucket_of(profile)
+    - await find_partner(lobby, channel_name, profile) to get a matched pair
+      or let the background matcher (realtime.matcher) pair users with find_pairs()
+    - await notify_match(channel_layer, session, user1, user2) once a pair is taken out of the lobby
+    - await remember_matches(lobby, pairs) so the matched users are not paired again too soon
+"""
+
+import re
+import secrets
+import time
+from collections import deque
+
+from django.conf import settings
+
+from .metrics import MATCH_LATENCY_BY_BUCKET, MATCH_LATENCY_WINDOW
+
+# Gender codes are the same as accounts.models.User.Gender, 'u' is for unknown
+GENDERS = ("m", "f", "o")
+UNKNOWN = "u"
+
+# Ages are grouped in bands of 10 years (10, 20, ... 90)
+AGE_BAND_WIDTH = 10
+MIN_AGE = 10
+MAX_AGE = 99
+
+DEFAULT_LANGUAGE = "en"
+LANGUAGE_PATTERN = re.compile(r'^[a-z]{2,8}$')
+
+# How many of the oldest users of every bucket are looked at for one match
+BUCKET_PEEK_SIZE = 4
+
+# Times a batch is paired again without the avoided pairs found in the lobby (see find_pairs())
+FIND_PAIRS_ROUNDS = 3
+
+# Filters of a waiting user are relaxed by one level every RELAX_STEP_SECONDS
+#   1: age range widened by RELAX_AGE_STEP years on both sides
+#   2: age filter dropped
+#   3: gender filter dropped
+#   4: language filter dropped (anybody is accepted)
+RELAX_STEP_SECONDS = 15
+RELAX_AGE_STEP = 5
+MAX_RELAX_LEVEL = 4
+
+DEFAULT_RECENT_PARTNERS_SETTINGS = {
+    "WINDOW": 60 * 60,  # Seconds two users who met are not matched again
+    "MAX_PARTNERS": 100,  # Recent partners (and blocked users) remembered per user
+    "BLOCK_TTL": 30 * 24 * 60 * 60,  # Seconds a blocked user is kept away
+}
+
+
+def get_recent_partners_settings():
+    """
+    Returns the REALTIME_RECENT_PARTNERS settings merged over the defaults.
+    """
+    return {**DEFAULT_RECENT_PARTNERS_SETTINGS, **getattr(settings, "REALTIME_RECENT_PARTNERS", {})}
+
+
+def _parse_age(value):
+    """
+    Returns the age as int when it is a valid age, otherwise None.
+    """
+    try:
+        age = int(value)
+    except (TypeError, ValueError):
+        return None
+
+    if MIN_AGE <= age <= MAX_AGE:
+        return age
+    return None
+
+
+def _parse_gender(value):
+    """
+    Returns the gender code when it is a known gender, otherwise None.
+    """
+    if value and value.lower() in GENDERS:
+        return value.lower()
+    return None
+
+
+def _parse_language(value):
+    """
+    Returns the language code in lower case, default language if it is not a valid code.
+    """
+    if value and LANGUAGE_PATTERN.match(value.lower()):
+        return value.lower()
+    return DEFAULT_LANGUAGE
+
+
+def build_profile(username, user, query_params):
+    """
+    Builds the matchmaking profile of a user.
+
+    Args:
+        username (str): Username of the connecting user.
+        user: scope["user"] of the connection.
+        query_params (dict): Parsed query string of the connection (parse_qs format).
+
+    Own attributes come from the authenticated user, anonymous users can send
+    them in the query string (gender, age, language).
+    Match filters always come from the query string:
+        - prefer_gender: comma separated genders, e.g. "f" or "m,o"
+        - min_age / max_age: accepted age range of the partner
+        - language: the partner must speak the same language
+
+    Returns:
+        dict: The profile which is stored with the user in the lobby.
+    """
+    def param(name):
+        return query_params.get(name, [None])[0]
+
+    if user.is_authenticated:
+        gender = _parse_gender(getattr(user, "gender", None))
+        age = _parse_age(getattr(user, "age", None))
+    else:
+        gender = _parse_gender(param("gender"))
+        age = _parse_age(param("age"))
+
+    prefer_gender = [
+        gender_code
+        for gender_code in (param("prefer_gender") or "").lower().split(",")
+        if gender_code in GENDERS
+    ]
+
+    return {
+        "username": username,
+        "gender": gender or UNKNOWN,
+        "age": age,
+        "language": _parse_language(param("language")),
+        "preferences": {
+            "genders": prefer_gender,
+            "min_age": _parse_age(param("min_age")),
+            "max_age": _parse_age(param("max_age")),
+        },
+    }
+
+
+def age_band(age):
+    """
+    Returns the age band of the given age, 'u' when the age is unknown.
+    """
+    if age is None:
+        return UNKNOWN
+    return str(age // AGE_BAND_WIDTH * AGE_BAND_WIDTH)
+
+
+def bucket_of(profile):
+    """
+    Returns the bucket the user is indexed under in the lobby.
+    """
+    return f'{profile["gender"]}:{age_band(profile["age"])}:{profile["language"]}'
+
+
+def bucket_group(bucket):
+    """
+    Returns the group of a bucket, its language.
+
+    Every candidate bucket of a user is in the user's own group until the
+    language filter is relaxed (see candidate_buckets()).
+    """
+    return bucket.rsplit(":", 1)[-1]
+
+
+def new_session_id():
+    """
+    Returns a short random id for a match session.
+    """
+    return secrets.token_urlsafe(9)
+
+
+def relax(profile, waited_seconds):
+    """
+    Returns a copy of the profile with the filters relaxed for the time it waited.
+
+    Only the filters are relaxed, the user's own attributes (and so its
+    bucket) never change.
+    """
+    level = min(int(waited_seconds // RELAX_STEP_SECONDS), MAX_RELAX_LEVEL)
+    if level == 0:
+        return profile
+
+    preferences = dict(profile["preferences"])
+
+    if level == 1:
+        if preferences["min_age"] is not None:
+            preferences["min_age"] = max(MIN_AGE, preferences["min_age"] - RELAX_AGE_STEP)
+        if preferences["max_age"] is not None:
+            preferences["max_age"] = min(MAX_AGE, preferences["max_age"] + RELAX_AGE_STEP)
+    else:
+        preferences["min_age"] = None
+        preferences["max_age"] = None
+
+    if level >= 3:
+        preferences["genders"] = []
+
+    if level >= 4:
+        preferences["any_language"] = True
+
+    return {**profile, "preferences": preferences, "relax_level": level}
+
+
+def relax_for_now(user, now):
+    """
+    Relaxes the filters of a user taken from the lobby by how long it has been waiting.
+    """
+    return relax(user, now - user["enqueued_at"])
+
+
+def candidate_buckets(profile):
+    """
+    Returns every bucket which can hold a partner accepted by the user's filters.
+
+    None is returned when the user accepts anybody, the whole lobby is the
+    candidate then and it is looked at in waiting order instead.
+    """
+    preferences = profile["preferences"]
+
+    if preferences.get("any_language"):
+        return None
+
+    genders = preferences["genders"] or (*GENDERS, UNKNOWN)
+
+    min_age = preferences["min_age"]
+    max_age = preferences["max_age"]
+    if min_age is None and max_age is None:
+        # Without an age filter the users with unknown age are accepted too
+        bands = [age_band(age) for age in range(MIN_AGE, MAX_AGE + 1, AGE_BAND_WIDTH)]
+        bands.append(UNKNOWN)
+    else:
+        first_band = (min_age or MIN_AGE) // AGE_BAND_WIDTH * AGE_BAND_WIDTH
+        last_band = max_age or MAX_AGE
+        bands = [age_band(age) for age in range(first_band, last_band + 1, AGE_BAND_WIDTH)]
+
+    return [
+        f'{gender}:{band}:{profile["language"]}'
+        for gender in genders
+        for band in bands
+    ]
+
+
+def accepts(profile, other):
+    """
+    Checks if the other user passes the match filters of the profile.
+    """
+    preferences = profile["preferences"]
+
+    if profile["language"] != other["language"] and not preferences.get("any_language"):
+        return False
+
+    if preferences["genders"] and other["gender"] not in preferences["genders"]:
+        return False
+
+    min_age = preferences["min_age"]
+    max_age = preferences["max_age"]
+    if min_age is not None or max_age is not None:
+        if other["age"] is None:
+            return False
+        if min_age is not None and other["age"] < min_age:
+            return False
+        if max_age is not None and other["age"] > max_age:
+            return False
+
+    return True
+
+
+def is_compatible(profile, other):
+    """
+    Both users have to accept each other to be matched.
+    """
+    return accepts(profile, other) and accepts(other, profile)
+
+
+def is_avoided(avoided, profile, other):
+    """
+    Checks if the two users met recently or one of them blocked the other.
+
+    Args:
+        avoided (set): (username1, username2) pairs to avoid, from lobby.get_avoided_pairs().
+    """
+    return (profile["username"], other["username"]) in avoided
+
+
+async def remember_matches(lobby, pairs):
+    """
+    Remembers the users of the matched pairs as recent partners of each other.
+
+    Args:
+        pairs (list): (user1, user2) tuples of user dictionaries.
+    """
+    recent_partners = get_recent_partners_settings()
+    await lobby.remember_partners(
+        [(user1["username"], user2["username"]) for user1, user2 in pairs],
+        recent_partners["WINDOW"],
+        recent_partners["MAX_PARTNERS"],
+    )
+
+
+async def find_partner(lobby, channel_name, profile):
+    """
+    Finds a compatible partner for the user and takes both out of the lobby.
+
+    Only the oldest BUCKET_PEEK_SIZE users of the candidate buckets are looked
+    at, so the cost does not grow with the size of the lobby. If nobody
+    compatible is found the user stays in the lobby and gets found by a later
+    user instead. The candidates are checked with their filters relaxed for
+    the time they have been waiting. Recent partners and blocked users are skipped.
+
+    A waiting user looking again gives its relaxed profile (see relax()),
+    when it accepts anybody the oldest users of the whole lobby are the candidates.
+
+    Returns:
+        tuple or None: (session, partner, user), the partner being the one who waited longer.
+    """
+    buckets = candidate_buckets(profile)
+    if buckets is None:
+        # The bucket of these candidates is read from their data below
+        candidates = [(candidate_channel, None) for candidate_channel in await lobby.oldest(BUCKET_PEEK_SIZE + 1)]
+    else:
+        candidates = await lobby.peek_buckets(buckets, BUCKET_PEEK_SIZE)
+    candidates = [candidate for candidate in candidates if candidate[0] != channel_name]
+    if not candidates:
+        return None
+
+    users = await lobby.get_users(
+        [candidate_channel for candidate_channel, _ in candidates],
+        [bucket for _, bucket in candidates],
+    )
+    avoided = await lobby.get_avoided_pairs(
+        [(profile["username"], candidate["username"]) for candidate in users if candidate]
+    )
+
+    now = time.time()
+    stale = []
+    for (candidate_channel, bucket), candidate in zip(candidates, users):
+        if candidate is None:
+            # The user left but the bucket index still has it
+            stale.append((candidate_channel, bucket))
+            continue
+
+        if is_avoided(avoided, profile, candidate) or not is_compatible(profile, relax_for_now(candidate, now)):
+            continue
+        bucket = bucket or candidate["bucket"]
+
+        # Another worker might have taken one of the two users already,
+        # in that case just try the next candidate
+        session = new_session_id()
+        pair = await lobby.claim_pair(
+            candidate_channel, bucket,
+            channel_name, bucket_of(profile),
+            session,
+        )
+        if pair:
+            match = (session, *pair)
+            await remember_matches(lobby, [pair])
+            break
+    else:
+        match = None
+
+    if stale:
+        await lobby.remove_many(stale)
+
+    return match
+
+
+def pair_batch(users, avoided=None):
+    """
+    Pairs the compatible users of a batch taken from the lobby.
+
+    Args:
+        users (list): User dictionaries, the user who waited the longest first.
+        avoided (set): (username1, username2) pairs which must not be paired (see is_avoided()).
+
+    The users are indexed by bucket once, then every user (oldest first) takes
+    the oldest compatible user still unpaired from its candidate buckets.
+    Serving the oldest first with their filters relaxed by waiting time is
+    what keeps the users with rare filters from starving.
+
+    Returns:
+        list: (user1, user2) tuples, user1 being the one who waited longer.
+    """
+    now = time.time()
+    relaxed_users = [relax_for_now(user, now) for user in users]
+    avoided = avoided or set()
+
+    waiting = {}
+    for index, user in enumerate(users):
+        waiting.setdefault(bucket_of(user), deque()).append(index)
+
+    # Users accepting anybody look at the whole batch in waiting order
+    everybody = [deque(range(len(users)))]
+
+    paired = set()
+    pairs = []
+    for index, user in enumerate(relaxed_users):
+        if index in paired:
+            continue
+
+        buckets = candidate_buckets(user)
+        if buckets is None:
+            candidate_indexes = everybody
+        else:
+            candidate_indexes = [waiting[bucket] for bucket in buckets if bucket in waiting]
+
+        partner = None
+        for indexes in candidate_indexes:
+            if not indexes:
+                continue
+
+            # Users paired already are dropped from the head of the bucket lazily
+            while indexes and indexes[0] in paired:
+                indexes.popleft()
+
+            looked_at = 0
+            for other in indexes:
+                if looked_at == BUCKET_PEEK_SIZE:
+                    break
+                if other == index or other in paired:
+                    continue
+                looked_at += 1
+                if is_compatible(user, relaxed_users[other]) and not is_avoided(avoided, user, users[other]):
+                    if partner is None or other < partner:
+                        partner = other
+                    break
+
+        if partner is not None:
+            paired.update((index, partner))
+            pairs.append((users[index], users[partner]) if index < partner else (users[partner], users[index]))
+
+    return pairs
+
+
+async def notify_match(channel_layer, session, user1, user2):
+    """
+    Sends the match notification with the session to both users and records how long they waited.
+
+    user2 is notified first, so it already knows the session when the offer of user1 arrives.
+    """
+    now = time.time()
+    for user in (user1, user2):
+        bucket, waited = bucket_of(user), (now - user["enqueued_at"]) * 1000
+        MATCH_LATENCY_BY_BUCKET.observe(bucket, waited)
+        MATCH_LATENCY_WINDOW.observe(bucket, waited)
+
+    for role, user, peer in (("user2", user2, user1), ("user1", user1, user2)):
+        await channel_layer.send(user["channel_name"], {
+            "type": "match.notification",   # Type of event to trigger the corresponding handler
+            "session": session,
+            "role": role,
+            "peer_channel_name": peer["channel_name"],
+            "peer_username": peer["username"],
+        })
+
+
+async def find_pairs(lobby, users):
+    """
+    Pairs the compatible users of a batch taken from the lobby, skipping recent partners and blocked users.
+
+    Only the pairs pair_batch() proposes are looked up in the lobby. When some
+    of them are avoided the batch is paired again without them, which is rare
+    since users seldom meet the same partner again within the window.
+
+    Returns:
+        list: (user1, user2) tuples, user1 being the one who waited longer.
+    """
+    avoided = set()
+    checked = set()
+    for _ in range(FIND_PAIRS_ROUNDS):
+        pairs = pair_batch(users, avoided)
+        unchecked = [
+            (user1["username"], user2["username"])
+            for user1, user2 in pairs
+            if (user1["username"], user2["username"]) not in checked
+        ]
+        if not unchecked:
+            return pairs
+
+        checked.update(unchecked)
+        newly_avoided = await lobby.get_avoided_pairs(unchecked)
+        if not newly_avoided:
+            return pairs
+        avoided |= newly_avoided
+
+    # Still proposing avoided pairs after the last round, they wait for the next tick
+    return [(user1, user2) for user1, user2 in pairs if not is_avoided(avoided, user1, user2)]
@@ -0,0 +1,231 @@
+"""
+In-process waiting lobby of the realtime app.
+
+Same operations as realtime.lobby.RedisLobby, kept in plain python
+dictionaries of the process instead of Redis. None of the methods awaits
+anything in the middle, so every operation is atomic on the event loop just
+like the Lua scripts of the Redis lobby.
+
+The lobby is only seen by the process holding it, it is meant for a single
+Daphne process (together with channels.layers.InMemoryChannelLayer) and for
+tests. `python manage.py run_matcher` runs in its own process, so the
+matcher has to stay in "inline" mode with this lobby.
+
+How to use:
+    - REALTIME_LOBBY = {"BACKEND": "realtime.memory_lobby.InMemoryLobby"} in the settings
+    - get_lobby() returns it like any other lobby backend
+"""
+
+import time
+from itertools import islice
+
+from .lobby import BaseLobby, MATCH_SESSION_TTL
+
+# Seconds between two sweeps of the ended recent partners
+RECENT_PARTNERS_SWEEP_INTERVAL = 60
+
+
+class InMemoryLobby(BaseLobby):
+    """
+    Keeps the waiting users in dictionaries ordered by the time they joined.
+
+    Python dictionaries keep their insertion order, so the first user of the
+    lobby (or of a bucket) is always the one who waited the longest and a
+    user can still be removed in O(1).
+    """
+
+    def __init__(self):
+        self.users = {}  # channel_name -> user data, oldest first
+        self.buckets = {}  # bucket -> {channel_name: None}, oldest first
+        self.presence = {}  # channel_name -> time its presence expires
+        self.sessions = {}  # session -> ({"user1": channel_name, "user2": channel_name}, expires at)
+        self.recent_partners = {}  # username -> {partner username: time the exclusion ends}
+        self.resume_used = {}  # nonce of a used resume token -> time it is forgotten
+        self.matched = 0
+        self.swept_at = time.monotonic()
+
+    async def add(self, channel_name, user, bucket, presence_ttl, end_sessions=(), max_size=0, enqueued_at=None):
+        # The order of the dictionaries is the waiting order, so a user always
+        # joins at the end, an `enqueued_at` given back by a drained worker is ignored
+        # (the lobby of a drained process is gone with it anyway)
+        for session in end_sessions:
+            self.sessions.pop(session, None)
+
+        if max_size and len(self.users) >= max_size:
+            return None
+
+        enqueued_at = time.time()
+        self._remove(channel_name, bucket)
+        self.users[channel_name] = {**user, "enqueued_at": enqueued_at, "bucket": bucket}
+        self.buckets.setdefault(bucket, {})[channel_name] = None
+        self.presence[channel_name] = enqueued_at + presence_ttl
+        return enqueued_at
+
+    def _remove(self, channel_name, bucket=None):
+        user = self.users.pop(channel_name, None)
+        self.presence.pop(channel_name, None)
+
+        # The bucket saved with the user is the one it is indexed under
+        bucket = (user and user["bucket"]) or bucket
+        channels = self.buckets.get(bucket)
+        if channels is not None:
+            channels.pop(channel_name, None)
+            if not channels:
+                del self.buckets[bucket]
+
+    async def remove(self, channel_name, bucket):
+        self._remove(channel_name, bucket)
+
+    async def remove_many(self, entries):
+        for channel_name, bucket in entries:
+            self._remove(channel_name, bucket)
+
+    async def oldest(self, count, offset=0):
+        return list(islice(self.users, offset, offset + count))
+
+    async def peek_buckets(self, buckets, count):
+        entries = [
+            (self.users[channel_name]["enqueued_at"], channel_name, bucket)
+            for bucket in buckets
+            for channel_name in islice(self.buckets.get(bucket, ()), count)
+        ]
+        entries.sort()
+        return [(channel_name, bucket) for _, channel_name, bucket in entries]
+
+    def _alive(self, channel_name, now):
+        return self.presence.get(channel_name, 0) >= now
+
+    async def get_users(self, channel_names, buckets=None):
+        now = time.time()
+        return [
+            dict(self.users[channel_name]) if self._alive(channel_name, now) else None
+            for channel_name in channel_names
+        ]
+
+    async def refresh_presence(self, channel_names, presence_ttl):
+        expires_at = time.time() + presence_ttl
+        for channel_name in channel_names:
+            if channel_name in self.presence:
+                self.presence[channel_name] = expires_at
+
+    async def reap_expired(self, limit):
+        now = time.time()
+        expired = list(islice(
+            (channel_name for channel_name, expires_at in self.presence.items() if expires_at < now),
+            limit,
+        ))
+        for channel_name in expired:
+            self._remove(channel_name)
+
+        # Users who do not come back would keep their recent partners forever,
+        # Redis expires them with the key instead
+        if time.monotonic() - self.swept_at >= RECENT_PARTNERS_SWEEP_INTERVAL:
+            self.swept_at = time.monotonic()
+            for username, partners in list(self.recent_partners.items()):
+                if max(partners.values(), default=0) <= now:
+                    del self.recent_partners[username]
+            for nonce, expires_at in list(self.resume_used.items()):
+                if expires_at <= now:
+                    del self.resume_used[nonce]
+
+        return len(expired)
+
+    def _claim_pair(self, channel1, bucket1, channel2, bucket2, session, now):
+        if not (self._alive(channel1, now) and self._alive(channel2, now)):
+            return None
+
+        user1 = self.users[channel1]
+        user2 = self.users[channel2]
+        self._remove(channel1, bucket1)
+        self._remove(channel2, bucket2)
+
+        channels = {
+            "user1": channel1, "user2": channel2,
+            "user1_username": user1["username"], "user2_username": user2["username"],
+        }
+        self.sessions[session] = (channels, now + MATCH_SESSION_TTL)
+        self.matched += 2
+        return user1, user2
+
+    async def claim_pair(self, channel1, bucket1, channel2, bucket2, session):
+        return self._claim_pair(channel1, bucket1, channel2, bucket2, session, time.time())
+
+    async def claim_pairs(self, pairs):
+        now = time.time()
+        matched = []
+        for channel1, bucket1, channel2, bucket2, session in pairs:
+            pair = self._claim_pair(channel1, bucket1, channel2, bucket2, session, now)
+            if pair:
+                matched.append((session, *pair))
+        return matched
+
+    async def size(self):
+        return len(self.users)
+
+    async def status(self, marks):
+        size = len(self.users)
+        ranks = sorted({round(mark * (size - 1) / max(marks - 1, 1)) for mark in range(marks)}) if size else []
+
+        # One walk over the lobby for all the marks
+        marked = []
+        ranks_left = iter(ranks)
+        next_rank = next(ranks_left, None)
+        for rank, user in enumerate(self.users.values()):
+            if rank == next_rank:
+                marked.append([user["enqueued_at"], rank])
+                next_rank = next(ranks_left, None)
+                if next_rank is None:
+                    break
+
+        return {"size": size, "marks": marked, "matched": self.matched}
+
+    def _remember(self, username, partner, ends_at, now, max_partners):
+        partners = self.recent_partners.setdefault(username, {})
+        # A block outlives a recent match, an exclusion is never shortened
+        partners[partner] = max(ends_at, partners.get(partner, 0))
+
+        for other, other_ends_at in list(partners.items()):
+            if other_ends_at <= now:
+                del partners[other]
+        if len(partners) > max_partners:
+            for other in sorted(partners, key=partners.get)[:len(partners) - max_partners]:
+                del partners[other]
+
+    async def remember_partners(self, pairs, ttl, max_partners):
+        now = time.time()
+        for username1, username2 in pairs:
+            self._remember(username1, username2, now + ttl, now, max_partners)
+            self._remember(username2, username1, now + ttl, now, max_partners)
+
+    async def block(self, username, blocked_username, ttl, max_partners):
+        now = time.time()
+        self._remember(username, blocked_username, now + ttl, now, max_partners)
+
+    async def get_avoided_pairs(self, pairs):
+        now = time.time()
+        avoided = set()
+        for username1, username2 in pairs:
+            if (
+                self.recent_partners.get(username1, {}).get(username2, 0) > now
+                or self.recent_partners.get(username2, {}).get(username1, 0) > now
+            ):
+                avoided.update(((username1, username2), (username2, username1)))
+        return avoided
+
+    async def get_session(self, session):
+        channels, expires_at = self.sessions.get(session, (None, 0))
+        if expires_at < time.time():
+            self.sessions.pop(session, None)
+            return {}
+        return dict(channels)
+
+    async def end_sessions(self, sessions):
+        for session in sessions:
+            self.sessions.pop(session, None)
+
+    async def use_resume_nonce(self, nonce, ttl):
+        now = time.time()
+        if self.resume_used.get(nonce, 0) > now:
+            return False
+        self.resume_used[nonce] = now + ttl
+        return True
@@ -0,0 +1,281 @@
+"""
+Small in-process metrics used by the realtime app.
+
+Everything here is plain python kept in the memory of the process, recording
+a value never does any I/O.
+
+How to use:
+    - MATCH_LATENCY.observe(milliseconds) when two users get matched
+    - MATCH_LATENCY.percentile(95) to read the p95 of everything observed
+    - MATCH_LATENCY_BY_BUCKET.observe(bucket, milliseconds) to keep it per matchmaking bucket
+      (and MATCH_LATENCY_WINDOW for the periodic report of realtime.matcher)
+    - SIGNALS_DROPPED.inc(reason) to count things
+    - render_metrics() returns every registered metric in the Prometheus text
+      format, realtime.exposition serves it over HTTP
+"""
+
+import bisect
+
+# Upper bounds (milliseconds) of the latency histogram buckets
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 300000)
+
+# Upper bounds (milliseconds) for the short operations like a channel layer send
+FAST_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000)
+
+# (name, help, metric, label name) of every metric rendered by render_metrics()
+REGISTRY = []
+
+
+def register(name, help_text, metric, label=None):
+    """
+    Adds the metric to the ones rendered by render_metrics() and returns it.
+    """
+    REGISTRY.append((name, help_text, metric, label))
+    return metric
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class Histogram:
+    """
+    Fixed bucket histogram.
+
+    Percentiles are estimated from the buckets, which is good enough for
+    reporting and costs the same no matter how many values were observed.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = tuple(bounds)
+        self.reset()
+
+    def reset(self):
+        # Last bucket is for the values bigger than every bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percent):
+        """
+        Returns the upper bound of the bucket holding the given percentile, None when empty.
+        """
+        if not self.count:
+            return None
+
+        rank = self.count * percent / 100
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                if index < len(self.bounds):
+                    return self.bounds[index]
+                return float("inf")
+        return float("inf")
+
+    def render(self, name, **labels):
+        """
+        Returns the Prometheus sample lines of the histogram (cumulative buckets, sum and count).
+        """
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip((*self.bounds, float("inf")), self.counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{_labels(**labels, le=_format_value(bound))} {cumulative}")
+        lines.append(f"{name}_sum{_labels(**labels)} {_format_value(self.sum)}")
+        lines.append(f"{name}_count{_labels(**labels)} {self.count}")
+        return lines
+
+    def summary(self):
+        """
+        Returns count, mean and p50/p95/p99 as a dictionary.
+        """
+        return {
+            "count": self.count,
+            "mean": round(self.sum / self.count, 2) if self.count else None,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+class Gauge:
+    """
+    A value going up and down.
+    """
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def render(self, name, label=None):
+        return [f"{name} {_format_value(self.value)}"]
+
+
+class Counter:
+    """
+    Counts per label.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def inc(self, label, amount=1):
+        self.values[label] = self.values.get(label, 0) + amount
+
+    def render(self, name, label):
+        return [
+            f"{name}{_labels(**{label: value})} {count}"
+            for value, count in sorted(self.values.items())
+        ]
+
+
+class HistogramFamily:
+    """
+    One histogram per label (e.g. per matchmaking bucket) plus a total of all of them.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = tuple(bounds)
+        self.total = Histogram(self.bounds)
+        self.histograms = {}
+
+    def observe(self, label, value):
+        histogram = self.histograms.get(label)
+        if histogram is None:
+            histogram = self.histograms[label] = Histogram(self.bounds)
+
+        histogram.observe(value)
+        self.total.observe(value)
+
+    def reset(self):
+        self.total.reset()
+        self.histograms = {}
+
+    def render(self, name, label):
+        lines = []
+        for value in sorted(self.histograms):
+            lines.extend(self.histograms[value].render(name, **{label: value}))
+        return lines
+
+    def summary(self):
+        """
+        Returns the summary of every label, sorted by label.
+        """
+        return {
+            label: self.histograms[label].summary()
+            for label in sorted(self.histograms)
+        }
+
+
+# Time from joining the waiting lobby to getting matched, per matchmaking bucket
+# (observed where the match is made: the consumer in "inline" mode, the matcher in "tick" mode)
+MATCH_LATENCY_BY_BUCKET = register(
+    "realtime_match_latency_milliseconds",
+    "Time from joining the waiting lobby to getting matched, per matchmaking bucket.",
+    HistogramFamily(),
+    label="bucket",
+)
+MATCH_LATENCY = MATCH_LATENCY_BY_BUCKET.total
+
+# The same over the current report interval only, reset by every report
+# (not rendered, the Prometheus histograms only ever go up)
+MATCH_LATENCY_WINDOW = HistogramFamily()
+
+# Time from joining the waiting lobby to the match notification, seen by the consumer
+MATCH_WAIT = register(
+    "realtime_match_wait_milliseconds",
+    "Time from joining the waiting lobby to the match notification of the websocket.",
+    Histogram(),
+)
+
+# Websockets connected to this process
+ACTIVE_CONNECTIONS = register(
+    "realtime_active_connections",
+    "Websockets connected to this process.",
+    Gauge(),
+)
+
+# Users waiting in the whole lobby, refreshed when the metrics are scraped
+LOBBY_DEPTH = register(
+    "realtime_lobby_depth",
+    "Users waiting in the lobby.",
+    Gauge(),
+)
+
+# Signals relayed to the peer, per signal type
+SIGNALS_RELAYED = register(
+    "realtime_signals_relayed_total",
+    "Signals relayed to the peer, per signal type.",
+    Counter(),
+    label="signal_type",
+)
+
+# Time taken by one channel layer send
+CHANNEL_SEND_LATENCY = register(
+    "realtime_channel_send_milliseconds",
+    "Time taken by one channel layer send.",
+    Histogram(FAST_BUCKETS_MS),
+)
+
+# Signals dropped by the rate limiter, per reason ("unknown" / "rate_limited")
+SIGNALS_DROPPED = register(
+    "realtime_signals_dropped_total",
+    "Signals dropped (unknown, rate limited, invalid session), per reason.",
+    Counter(),
+    label="reason",
+)
+
+# Connections closed by the server, per reason
+CONNECTIONS_CLOSED = register(
+    "realtime_connections_closed_total",
+    "Connections closed by the server, per reason.",
+    Counter(),
+    label="reason",
+)
+
+# Disconnected websockets, per close code
+DISCONNECTS = register(
+    "realtime_disconnects_total",
+    "Disconnected websockets, per close code.",
+    Counter(),
+    label="code",
+)
+
+
+def render_metrics():
+    """
+    Returns every registered metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, help_text, metric, label in REGISTRY:
+        metric_type = {Histogram: "histogram", HistogramFamily: "histogram", Gauge: "gauge"}.get(type(metric), "counter")
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(metric.render(name, label) if label else metric.render(name))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,118 @@
+"""
+Stateless JWT authentication for the websocket connections.
+
+The REST API authenticates with simplejwt access tokens, the same tokens
+are accepted here so the websocket does not need the Django session table
+or a query on the user table. The user is built from the token claims
+(see accounts.views.LoginView for the claims put in the token).
+
+The token can be sent in two ways:
+    - Query string: /connection-request/?token=<access_token>
+    - Subprotocol: Sec-WebSocket-Protocol: bearer.<access_token>, guffmandu.json
+      (a real subprotocol has to be offered next to it, the token is never echoed back)
+
+How to use:
+    application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+"""
+
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.tokens import AccessToken
+
+JWT_SUBPROTOCOL_PREFIX = "bearer."
+
+# Verified tokens kept in memory, so reconnects with the same token skip the signature check
+TOKEN_CACHE_SIZE = 10000
+
+
+class VerifiedTokenCache:
+    """
+    Small LRU cache of verified tokens: token -> (user, expiry timestamp).
+    """
+
+    def __init__(self, max_size=TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        self.tokens = OrderedDict()
+
+    def get(self, raw_token):
+        cached = self.tokens.get(raw_token)
+        if cached is None:
+            return None
+
+        user, expires_at = cached
+        if expires_at <= time.time():
+            del self.tokens[raw_token]
+            return None
+
+        self.tokens.move_to_end(raw_token)
+        return user
+
+    def set(self, raw_token, user, expires_at):
+        self.tokens[raw_token] = (user, expires_at)
+        self.tokens.move_to_end(raw_token)
+        if len(self.tokens) > self.max_size:
+            self.tokens.popitem(last=False)
+
+
+verified_tokens = VerifiedTokenCache()
+
+
+def get_user_from_token(raw_token):
+    """
+    Validates the access token and returns the user built from its claims.
+
+    AnonymousUser is returned for missing, invalid or expired tokens, and for
+    tokens without the username claim.
+    """
+    if not raw_token:
+        return AnonymousUser()
+
+    user = verified_tokens.get(raw_token)
+    if user is not None:
+        return user
+
+    try:
+        # Checks the signature, the expiry and the token type
+        token = AccessToken(raw_token)
+    except TokenError:
+        return AnonymousUser()
+
+    if not token.get("username"):
+        return AnonymousUser()
+
+    user = TokenUser(token)
+    verified_tokens.set(raw_token, user, token["exp"])
+    return user
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Sets scope["user"] from the JWT access token of the connection.
+    """
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+
+        raw_token = None
+        subprotocols = []
+        for subprotocol in scope.get("subprotocols", []):
+            if subprotocol.startswith(JWT_SUBPROTOCOL_PREFIX):
+                raw_token = subprotocol[len(JWT_SUBPROTOCOL_PREFIX):]
+            else:
+                subprotocols.append(subprotocol)
+        # The token is not a real subprotocol, the consumer must not pick it
+        scope["subprotocols"] = subprotocols
+
+        if raw_token is None:
+            query_params = parse_qs(scope.get("query_string", b"").decode())
+            raw_token = query_params.get("token", [None])[0]
+
+        scope["user"] = get_user_from_token(raw_token)
+
+        return await super().__call__(scope, receive, send)
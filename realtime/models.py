@@ -1 +1,18 @@
 from django.db import models
+
+
+class ChatMessage(models.Model):
+    """
+    Text message sent by a user to its partner within a match session.
+
+    Messages are written in batches by realtime.chat.ChatWriter, never one by one from the consumer.
+    """
+
+    session = models.CharField(max_length=32, db_index=True)
+    sender = models.CharField(max_length=150)
+    text = models.TextField()
+
+    sent_date = models.DateTimeField()
+
+    def __str__(self):
+        return self.text[0:11]
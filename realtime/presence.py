@@ -0,0 +1,103 @@
+"""
+Presence of the users waiting in the lobby.
+
+A user is only matched while its presence in the lobby has not expired.
+Every process refreshes the presence of all its waiting users in one Redis
+command every REFRESH_INTERVAL seconds. When a Daphne worker crashes its
+users are not refreshed anymore, they expire after PRESENCE_TTL seconds and
+get reaped from the lobby instead of being matched with dead channels.
+
+Clients can also send {"signal_type": "heartbeat"} over the socket. Once a
+client has sent one it has to keep sending them, a client silent for more
+than CLIENT_TIMEOUT seconds is not tracked anymore and its consumer gets a
+"presence.timeout" message: the user leaves the lobby and the client is
+told, it sends "next" to get back in. Clients which never send heartbeats
+are kept alive for as long as their socket is open.
+
+How to use:
+    - presence.track(channel_name) after adding the user to the lobby
+    - presence.heartbeat(channel_name) for every heartbeat of the client
+    - presence.untrack(channel_name) once the user is matched or gone
+"""
+
+import asyncio
+import time
+
+from channels.layers import get_channel_layer
+
+from .lobby import get_lobby
+
+PRESENCE_TTL = 30  # Seconds a waiting user stays alive without being refreshed
+REFRESH_INTERVAL = 10  # Seconds between two refreshes of the process' waiting users
+CLIENT_TIMEOUT = 30  # Seconds a client which sends heartbeats can stay silent
+REAP_BATCH_SIZE = 500  # Expired users removed from the lobby at most in one go
+
+
+class PresenceTracker:
+    """
+    Keeps track of the waiting users of this process and refreshes their presence in bulk.
+    """
+
+    def __init__(self):
+        # channel_name -> time of the last client heartbeat, None when the client never sent one
+        self.channels = {}
+        self.task = None
+
+    def track(self, channel_name):
+        self.channels[channel_name] = None
+        self.start()
+
+    def untrack(self, channel_name):
+        self.channels.pop(channel_name, None)
+
+    def heartbeat(self, channel_name):
+        # Heartbeats only matter while the user is waiting in the lobby
+        if channel_name in self.channels:
+            self.channels[channel_name] = time.monotonic()
+
+    def pop_silent_channels(self):
+        """
+        Stops tracking the waiting users whose client stopped sending heartbeats and returns them.
+        """
+        silent_since = time.monotonic() - CLIENT_TIMEOUT
+        silent = [
+            channel_name
+            for channel_name, last_heartbeat in self.channels.items()
+            if last_heartbeat is not None and last_heartbeat < silent_since
+        ]
+        for channel_name in silent:
+            del self.channels[channel_name]
+        return silent
+
+    def start(self):
+        """
+        Starts the refreshing task in the running event loop if it is not running yet.
+        """
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        """
+        Refreshes the presence of the waiting users and reaps the expired ones
+        until this process has nobody waiting anymore.
+        """
+        lobby = get_lobby()
+        channel_layer = get_channel_layer()
+
+        while self.channels:
+            await asyncio.sleep(REFRESH_INTERVAL)
+
+            try:
+                # Their consumers take them out of the lobby, they would wait there forever otherwise
+                for channel_name in self.pop_silent_channels():
+                    await channel_layer.send(channel_name, {"type": "presence.timeout"})
+
+                await lobby.refresh_presence(list(self.channels), PRESENCE_TTL)
+                await lobby.reap_expired(REAP_BATCH_SIZE)
+            except Exception as e:
+                # Redis being unavailable for a moment must not stop the refreshing
+                print("!!! Got Error when refreshing the presence !!!", e)
+
+
+# Presence tracker of the process
+presence = PresenceTracker()
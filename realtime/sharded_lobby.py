@@ -0,0 +1,340 @@
+"""
+Waiting lobby spread over many Redis hosts.
+
+Every user lives on one shard (one RedisLobby per Redis host) picked from
+the hash of the group of its matchmaking bucket (its language, see
+realtime.matchmaking.bucket_group). A user's candidate buckets are all in
+its own group until its language filter is relaxed, so finding a partner
+and claiming the pair run on one shard with the same atomic script as the
+single Redis lobby. Adding Redis hosts spreads the lobby keys and the
+matching passes over them instead of having every Daphne node hit the same
+`waiting_lobby` key.
+
+Pairs of users from two different shards (users accepting any language)
+are only made by the slower cross-shard pass of the matcher: both users are
+taken out of their own shard one after the other, and the first one is put
+back in its place when the second one is gone already.
+
+REALTIME_ADMISSION["MAX_LOBBY_SIZE"] holds for the whole lobby: a shard
+takes a user while its own users and the other shards' users, as counted
+at most `size_refresh_seconds` ago, are fewer than the limit.
+
+Recent partners are kept on the shard of the username, match sessions on
+the shard of the session id, used resume tokens on the shard of their nonce.
+
+How to use:
+    - REALTIME_LOBBY = {
+          "BACKEND": "realtime.sharded_lobby.ShardedLobby",
+          "OPTIONS": {"urls": ["redis://host1:6379/0", "redis://host2:6379/0"]},
+      }
+    - `python manage.py run_matcher` runs one matcher per shard (see LobbyShard)
+      and a slower cross-shard pass over the whole lobby
+"""
+
+import asyncio
+import bisect
+import time
+import zlib
+from collections import defaultdict
+
+from .lobby import BaseLobby, RedisLobby, partners_to_check
+from .matchmaking import bucket_group
+
+
+def shard_index(key, shards):
+    """
+    Returns the shard of a bucket group, username or session, the same on every process.
+    """
+    return zlib.crc32(key.encode()) % shards
+
+
+class ShardedLobby(BaseLobby):
+    """
+    Routes every lobby operation to the RedisLobby shard holding the bucket (or username, or session).
+
+    Operations which only know channel names (presence, reaping) are sent to every shard concurrently.
+    """
+
+    def __init__(self, urls, max_connections=50, size_refresh_seconds=1):
+        self.shards = [RedisLobby(url, max_connections=max_connections) for url in urls]
+        # The matcher of every shard, see run_matcher
+        self.shard_lobbies = [LobbyShard(self, shard) for shard in self.shards]
+
+        # Users of every shard when last counted, for MAX_LOBBY_SIZE
+        self.size_refresh_seconds = size_refresh_seconds
+        self.sizes = [0] * len(self.shards)
+        self.sizes_counted_at = None
+
+    def shard_of(self, key):
+        return self.shards[shard_index(key, len(self.shards))]
+
+    def shard_of_bucket(self, bucket):
+        return self.shard_of(bucket_group(bucket))
+
+    async def _on_every_shard(self, method, *args):
+        return await asyncio.gather(*(getattr(shard, method)(*args) for shard in self.shards))
+
+    async def add(self, channel_name, user, bucket, presence_ttl, end_sessions=(), max_size=0, enqueued_at=None):
+        # The sessions to end are on the shards of the sessions
+        if end_sessions:
+            await self.end_sessions(end_sessions)
+
+        shard = self.shard_of_bucket(bucket)
+
+        # The shard takes what the other shards left of the lobby size when last counted
+        shard_max_size = 0
+        if max_size:
+            now = time.monotonic()
+            if self.sizes_counted_at is None or now - self.sizes_counted_at >= self.size_refresh_seconds:
+                # Concurrent connects keep using the last count meanwhile
+                self.sizes_counted_at = now
+                await self.size()
+
+            others = sum(self.sizes) - self.sizes[self.shards.index(shard)]
+            shard_max_size = max_size - others
+            if shard_max_size <= 0:
+                return None
+
+        return await shard.add(
+            channel_name, user, bucket, presence_ttl, max_size=shard_max_size, enqueued_at=enqueued_at,
+        )
+
+    async def remove(self, channel_name, bucket):
+        await self.remove_many([(channel_name, bucket)])
+
+    async def remove_many(self, entries):
+        by_shard = defaultdict(list)
+        for channel_name, bucket in entries:
+            if bucket:
+                by_shard[self.shard_of_bucket(bucket)].append((channel_name, bucket))
+            else:
+                for shard in self.shards:
+                    by_shard[shard].append((channel_name, None))
+
+        await asyncio.gather(*(shard.remove_many(shard_entries) for shard, shard_entries in by_shard.items()))
+
+    async def oldest(self, count, offset=0):
+        # The oldest of the whole lobby are among the oldest of every shard
+        oldest = await self._on_every_shard("oldest_with_times", offset + count)
+        entries = sorted(entry for shard_entries in oldest for entry in shard_entries)
+        return [channel_name for _, channel_name in entries[offset:offset + count]]
+
+    async def peek_buckets(self, buckets, count):
+        by_shard = defaultdict(list)
+        for bucket in buckets:
+            by_shard[self.shard_of_bucket(bucket)].append(bucket)
+
+        peeked = await asyncio.gather(*(
+            shard.peek_buckets_with_times(shard_buckets, count)
+            for shard, shard_buckets in by_shard.items()
+        ))
+        entries = sorted(entry for shard_entries in peeked for entry in shard_entries)
+        return [(channel_name, bucket) for _, channel_name, bucket in entries]
+
+    async def get_users(self, channel_names, buckets=None):
+        # Users whose bucket is not known are looked for on every shard, they are on one of them
+        buckets = buckets or [None] * len(channel_names)
+        by_shard = defaultdict(list)
+        for index, (channel_name, bucket) in enumerate(zip(channel_names, buckets)):
+            for shard in [self.shard_of_bucket(bucket)] if bucket else self.shards:
+                by_shard[shard].append((index, channel_name))
+
+        results = await asyncio.gather(*(
+            shard.get_users([channel_name for _, channel_name in shard_entries])
+            for shard, shard_entries in by_shard.items()
+        ))
+
+        users = [None] * len(channel_names)
+        for shard_entries, shard_users in zip(by_shard.values(), results):
+            for (index, _), user in zip(shard_entries, shard_users):
+                users[index] = users[index] or user
+        return users
+
+    async def refresh_presence(self, channel_names, presence_ttl):
+        # ZADD XX only touches the shard which has the user
+        await self._on_every_shard("refresh_presence", channel_names, presence_ttl)
+
+    async def reap_expired(self, limit):
+        return sum(await self._on_every_shard("reap_expired", limit))
+
+    async def claim_pair(self, channel1, bucket1, channel2, bucket2, session):
+        # Pairs across shards are left to the cross-shard pass of the matcher
+        shard = self.shard_of_bucket(bucket1)
+        if shard is not self.shard_of_bucket(bucket2):
+            return None
+
+        pair = await shard.claim_pair(channel1, bucket1, channel2, bucket2, session, create_session=False)
+        if pair:
+            await self.shard_of(session).create_sessions([(session, *pair)], count_matched=False)
+        return pair
+
+    async def claim_shard_pairs(self, shard, pairs):
+        """
+        Claims pairs of users of the same shard, their sessions are created on the shards of the sessions.
+        """
+        matched = await shard.claim_pairs(pairs, create_sessions=False)
+        await self.create_sessions(matched, count_matched=False)
+        return matched
+
+    async def claim_pairs(self, pairs):
+        by_shard = defaultdict(list)
+        cross_shard = []
+        for pair in pairs:
+            channel1, bucket1, channel2, bucket2, session = pair
+            shard1 = self.shard_of_bucket(bucket1)
+            if shard1 is self.shard_of_bucket(bucket2):
+                by_shard[shard1].append(pair)
+            else:
+                cross_shard.append(pair)
+
+        results = await asyncio.gather(
+            *(self.claim_shard_pairs(shard, shard_pairs) for shard, shard_pairs in by_shard.items()),
+            *(self.steal_pair(*pair) for pair in cross_shard),
+        )
+
+        shard_results = results[:len(by_shard)]
+        stolen = results[len(by_shard):]
+        matched = [match for shard_matched in shard_results for match in shard_matched]
+        matched += [match for match in stolen if match]
+        return matched
+
+    async def steal_pair(self, channel1, bucket1, channel2, bucket2, session):
+        """
+        Takes a pair of users of two different shards, the older user first.
+
+        Returns:
+            tuple or None: (session, user1, user2), None when one of them is gone.
+        """
+        shard1 = self.shard_of_bucket(bucket1)
+        taken1 = await shard1.take(channel1, bucket1)
+        if not taken1:
+            return None
+
+        taken2 = await self.shard_of_bucket(bucket2).take(channel2, bucket2)
+        if not taken2:
+            await shard1.put_back(*taken1)
+            return None
+
+        match = (session, taken1[0], taken2[0])
+        await self.shard_of(session).create_sessions([match])
+        return match
+
+    async def create_sessions(self, matches, count_matched=True):
+        by_shard = defaultdict(list)
+        for match in matches:
+            by_shard[self.shard_of(match[0])].append(match)
+
+        await asyncio.gather(*(
+            shard.create_sessions(shard_matches, count_matched=count_matched)
+            for shard, shard_matches in by_shard.items()
+        ))
+
+    async def size(self):
+        self.sizes = await self._on_every_shard("size")
+        return sum(self.sizes)
+
+    async def status(self, marks):
+        statuses = await self._on_every_shard("status", marks)
+        self.sizes = [status["size"] for status in statuses]
+
+        # A mark's position in the whole lobby is the sum of its estimated rank in every shard
+        marked = []
+        for enqueued_at in sorted(mark[0] for status in statuses for mark in status["marks"]):
+            marked.append([enqueued_at, round(sum(_estimate_rank(status, enqueued_at) for status in statuses))])
+
+        return {
+            "size": sum(self.sizes),
+            "marks": marked,
+            "matched": sum(status["matched"] for status in statuses),
+        }
+
+    async def remember_partners(self, pairs, ttl, max_partners):
+        by_shard = defaultdict(list)
+        for username1, username2 in pairs:
+            # Both users remember each other, every pair goes to the shards of both usernames
+            by_shard[self.shard_of(username1)].append((username1, username2))
+            by_shard[self.shard_of(username2)].append((username2, username1))
+
+        await asyncio.gather(*(
+            shard.remember_partners_of(shard_pairs, ttl, max_partners)
+            for shard, shard_pairs in by_shard.items()
+        ))
+
+    async def block(self, username, blocked_username, ttl, max_partners):
+        await self.shard_of(username).block(username, blocked_username, ttl, max_partners)
+
+    async def get_avoided_pairs(self, pairs):
+        # Every user's exclusions are looked up on the shard of its username
+        by_shard = defaultdict(dict)
+        for username, partners in partners_to_check(pairs).items():
+            by_shard[self.shard_of(username)][username] = partners
+
+        avoided = set()
+        for shard_avoided in await asyncio.gather(*(
+            shard.get_avoided_partners(checks)
+            for shard, checks in by_shard.items()
+        )):
+            avoided |= shard_avoided
+        return avoided | {(partner, username) for username, partner in avoided}
+
+    async def get_session(self, session):
+        return await self.shard_of(session).get_session(session)
+
+    async def end_sessions(self, sessions):
+        by_shard = defaultdict(list)
+        for session in sessions:
+            by_shard[self.shard_of(session)].append(session)
+
+        await asyncio.gather(*(shard.end_sessions(shard_sessions) for shard, shard_sessions in by_shard.items()))
+
+    async def use_resume_nonce(self, nonce, ttl):
+        return await self.shard_of(nonce).use_resume_nonce(nonce, ttl)
+
+
+class LobbyShard(BaseLobby):
+    """
+    The users of one shard of a ShardedLobby, for the matcher of that shard.
+
+    Users are taken from the shard only, match sessions and recent partners
+    go through the sharded lobby which knows where they are kept.
+    """
+
+    def __init__(self, lobby, shard):
+        self.lobby = lobby
+        self.shard = shard
+
+    async def oldest(self, count, offset=0):
+        return await self.shard.oldest(count, offset)
+
+    async def get_users(self, channel_names, buckets=None):
+        return await self.shard.get_users(channel_names)
+
+    async def reap_expired(self, limit):
+        return await self.shard.reap_expired(limit)
+
+    async def claim_pairs(self, pairs):
+        return await self.lobby.claim_shard_pairs(self.shard, pairs)
+
+    async def remember_partners(self, pairs, ttl, max_partners):
+        await self.lobby.remember_partners(pairs, ttl, max_partners)
+
+    async def get_avoided_pairs(self, pairs):
+        return await self.lobby.get_avoided_pairs(pairs)
+
+
+def _estimate_rank(status, enqueued_at):
+    """
+    Returns how many users of a shard joined before `enqueued_at`, estimated from the shard's marks.
+    """
+    marks = status["marks"]
+    if not marks:
+        return 0
+
+    index = bisect.bisect_left([mark[0] for mark in marks], enqueued_at)
+    if index == 0:
+        return 0
+    if index == len(marks):
+        return status["size"]
+
+    (time1, rank1), (time2, rank2) = marks[index - 1], marks[index]
+    return rank1 + (rank2 - rank1) * (enqueued_at - time1) / (time2 - time1)
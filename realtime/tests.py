@@ -0,0 +1,1076 @@
+import asyncio
+import json
+import time
+from collections import defaultdict
+from datetime import timedelta
+from unittest import mock, skipUnless
+
+import msgpack
+
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .admission import LobbyStatusBroadcaster, estimate_position
+from .chat import ChatWriter, _save_messages, build_message, chat_writer
+from .codecs import (
+    JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL, JSONCodec, JSONSubprotocolCodec, MessagePackCodec, select_codec,
+)
+from .consumers import ConnectionConsumer
+from .drain import drain, make_resume_token, use_resume_token
+from .lobby import RedisLobby, get_lobby
+from .matcher import BatchMatcher
+from .matchmaking import (
+    RELAX_STEP_SECONDS, bucket_of, candidate_buckets, find_pairs, find_partner, is_compatible, pair_batch, relax,
+)
+from .memory_lobby import InMemoryLobby
+from .metrics import ACTIVE_CONNECTIONS, SIGNALS_DROPPED
+from .models import ChatMessage
+from .middleware import JWTAuthMiddleware, VerifiedTokenCache, get_user_from_token, verified_tokens
+from .routers import websocket_urlpatterns
+from .sharded_lobby import ShardedLobby
+from .throttling import TokenBucket
+
+try:
+    import fakeredis
+except ImportError:
+    # The Redis tests need fakeredis with Lua (pip install fakeredis lupa)
+    fakeredis = None
+
+# The memory backends, no Redis needed
+MEMORY_BACKENDS = {
+    "REALTIME_LOBBY": {"BACKEND": "realtime.memory_lobby.InMemoryLobby"},
+    "CHANNEL_LAYERS": {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    "REALTIME_MATCHER": {"MODE": "inline"},
+}
+
+
+def make_user(username, gender="u", age=None, language="en", genders=(), min_age=None, max_age=None, enqueued_at=None):
+    """
+    Returns a user dictionary as the lobby keeps it.
+    """
+    user = {
+        "username": username,
+        "channel_name": username,
+        "gender": gender,
+        "age": age,
+        "language": language,
+        "preferences": {"genders": list(genders), "min_age": min_age, "max_age": max_age},
+    }
+    if enqueued_at is not None:
+        user["enqueued_at"] = enqueued_at
+    return user
+
+
+def make_redis_lobby(lobby_class=RedisLobby, **kwargs):
+    """
+    Returns a Redis lobby on fake Redis servers (fakeredis), one per host, its scripts run with Lua.
+    """
+    servers = defaultdict(fakeredis.FakeServer)
+    with mock.patch(
+        "realtime.lobby.aioredis.Redis",
+        side_effect=lambda connection_pool, **_: fakeredis.FakeAsyncRedis(
+            server=servers[connection_pool.connection_kwargs["host"]], decode_responses=True,
+        ),
+    ):
+        return lobby_class(**kwargs)
+
+
+class LobbyTestsMixin:
+    """
+    Behaviour every lobby backend has, the test cases set self.lobby up.
+    """
+
+    async def add(self, user, presence_ttl=60, **kwargs):
+        return await self.lobby.add(user["channel_name"], user, bucket_of(user), presence_ttl, **kwargs)
+
+    async def test_oldest_first(self):
+        for username in ("a", "b", "c"):
+            await self.add(make_user(username))
+
+        self.assertEqual(await self.lobby.oldest(2), ["a", "b"])
+        self.assertEqual(await self.lobby.oldest(2, offset=1), ["b", "c"])
+        self.assertEqual(await self.lobby.size(), 3)
+
+    async def test_peek_buckets(self):
+        await self.add(make_user("m1", gender="m"))
+        await self.add(make_user("f1", gender="f"))
+        await self.add(make_user("f2", gender="f"))
+
+        self.assertEqual(await self.lobby.peek_buckets(["f:u:en"], 1), [("f1", "f:u:en")])
+        self.assertEqual(
+            await self.lobby.peek_buckets(["f:u:en", "m:u:en"], 5),
+            [("m1", "m:u:en"), ("f1", "f:u:en"), ("f2", "f:u:en")],
+        )
+
+    async def test_remove(self):
+        await self.add(make_user("a"))
+        await self.add(make_user("b"))
+
+        await self.lobby.remove("a", "u:u:en")
+
+        users = await self.lobby.get_users(["a", "b"])
+        self.assertIsNone(users[0])
+        self.assertEqual((users[1]["username"], users[1]["bucket"]), ("b", "u:u:en"))
+        self.assertEqual(await self.lobby.peek_buckets(["u:u:en"], 5), [("b", "u:u:en")])
+
+    async def test_full_lobby(self):
+        self.assertIsNotNone(await self.add(make_user("a"), max_size=1))
+        self.assertIsNone(await self.add(make_user("b"), max_size=1))
+        self.assertEqual(await self.lobby.oldest(5), ["a"])
+
+    async def test_claim_pair(self):
+        await self.add(make_user("a"))
+        await self.add(make_user("b"))
+
+        user1, user2 = await self.lobby.claim_pair("a", "u:u:en", "b", "u:u:en", "session")
+
+        self.assertEqual((user1["username"], user2["username"]), ("a", "b"))
+        self.assertEqual(await self.lobby.size(), 0)
+        self.assertEqual(await self.lobby.get_session("session"), {
+            "user1": "a", "user2": "b", "user1_username": "a", "user2_username": "b",
+        })
+        # Already taken
+        self.assertIsNone(await self.lobby.claim_pair("a", "u:u:en", "b", "u:u:en", "other"))
+
+    async def test_expired_users_are_not_claimed_but_reaped(self):
+        await self.add(make_user("a"))
+        await self.add(make_user("gone"), presence_ttl=-1)
+
+        self.assertIsNone(await self.lobby.claim_pair("a", "u:u:en", "gone", "u:u:en", "session"))
+        self.assertEqual(await self.lobby.get_users(["gone"]), [None])
+
+        self.assertEqual(await self.lobby.reap_expired(10), 1)
+        self.assertEqual(await self.lobby.oldest(5), ["a"])
+
+    async def test_refresh_presence_does_not_add_back(self):
+        await self.add(make_user("a"), presence_ttl=-1)
+        await self.lobby.refresh_presence(["a"], 60)
+        self.assertIsNotNone((await self.lobby.get_users(["a"]))[0])
+
+        await self.lobby.remove("a", "u:u:en")
+        await self.lobby.refresh_presence(["a"], 60)
+        self.assertEqual(await self.lobby.size(), 0)
+
+    async def test_rematch_ends_the_sessions(self):
+        await self.add(make_user("a"))
+        await self.add(make_user("b"))
+        await self.lobby.claim_pair("a", "u:u:en", "b", "u:u:en", "session")
+
+        await self.add(make_user("a"), end_sessions=["session"])
+
+        self.assertEqual(await self.lobby.get_session("session"), {})
+        self.assertEqual(await self.lobby.oldest(5), ["a"])
+
+    async def test_avoided_pairs(self):
+        await self.lobby.remember_partners([("a", "b")], 60, 10)
+        await self.lobby.remember_partners([("a", "c")], -1, 10)
+        # Only the blocking user remembers a block, it is avoided both ways
+        await self.lobby.block("d", "a", 60, 10)
+
+        self.assertEqual(
+            await self.lobby.get_avoided_pairs([("a", "b"), ("a", "c"), ("a", "d"), ("a", "e")]),
+            {("a", "b"), ("b", "a"), ("a", "d"), ("d", "a")},
+        )
+        self.assertEqual(await self.lobby.get_avoided_pairs([]), set())
+
+    async def test_a_resume_nonce_is_used_once(self):
+        self.assertTrue(await self.lobby.use_resume_nonce("nonce", 60))
+        self.assertFalse(await self.lobby.use_resume_nonce("nonce", 60))
+        self.assertTrue(await self.lobby.use_resume_nonce("other", 60))
+
+
+class InMemoryLobbyTests(LobbyTestsMixin, SimpleTestCase):
+
+    def setUp(self):
+        self.lobby = InMemoryLobby()
+
+
+@skipUnless(fakeredis, "fakeredis is not installed")
+class RedisLobbyTests(LobbyTestsMixin, SimpleTestCase):
+
+    def setUp(self):
+        self.lobby = make_redis_lobby(url="redis://test")
+
+    async def test_a_user_is_claimed_once(self):
+        for username in ("a", "b", "c"):
+            await self.add(make_user(username))
+
+        # Two workers racing for "a" with different partners
+        claims = await asyncio.gather(
+            self.lobby.claim_pair("a", "u:u:en", "b", "u:u:en", "session1"),
+            self.lobby.claim_pair("a", "u:u:en", "c", "u:u:en", "session2"),
+        )
+
+        self.assertEqual(len([claim for claim in claims if claim]), 1)
+        self.assertEqual(await self.lobby.size(), 1)
+
+    async def test_claim_pairs(self):
+        for username in ("a", "b", "c", "d"):
+            await self.add(make_user(username))
+        await self.lobby.remove("d", "u:u:en")
+
+        claimed = await self.lobby.claim_pairs([
+            ("a", "u:u:en", "b", "u:u:en", "session1"),
+            ("c", "u:u:en", "d", "u:u:en", "session2"),
+        ])
+
+        self.assertEqual([(session, user1["username"], user2["username"]) for session, user1, user2 in claimed], [
+            ("session1", "a", "b"),
+        ])
+        # The pair with a user gone leaves the other one waiting
+        self.assertEqual(await self.lobby.oldest(5), ["c"])
+        self.assertEqual((await self.lobby.status(2))["matched"], 2)
+
+    async def test_remove_without_the_bucket(self):
+        await self.add(make_user("a"))
+        await self.add(make_user("b"))
+
+        await self.lobby.remove_many([("a", None)])
+
+        self.assertEqual(await self.lobby.oldest(5), ["b"])
+        self.assertEqual(await self.lobby.get_users(["a"]), [None])
+        # The bucket index keeps it until the matchmaking drops it
+        self.assertEqual(await self.lobby.peek_buckets(["u:u:en"], 5), [("a", "u:u:en"), ("b", "u:u:en")])
+
+
+@skipUnless(fakeredis, "fakeredis is not installed")
+class ShardedLobbyTests(LobbyTestsMixin, SimpleTestCase):
+
+    def setUp(self):
+        # "en" buckets are on the first host, "de" buckets on the second one
+        self.lobby = make_redis_lobby(ShardedLobby, urls=["redis://host1", "redis://host2"])
+        self.en_shard, self.de_shard = self.lobby.shards
+
+    async def test_users_are_on_the_shard_of_their_language(self):
+        await self.add(make_user("en1"))
+        await self.add(make_user("en2", gender="f", age=30))
+        await self.add(make_user("de1", language="de"))
+
+        self.assertEqual(await self.en_shard.oldest(5), ["en1", "en2"])
+        self.assertEqual(await self.de_shard.oldest(5), ["de1"])
+        self.assertEqual(await self.lobby.oldest(5), ["en1", "en2", "de1"])
+
+        user = make_user("me", gender="m", genders=["f"])
+        await self.add(user)
+        with mock.patch.object(RedisLobby, "take") as take:
+            session, partner, matched = await find_partner(self.lobby, "me", user)
+
+        # Found and claimed on one shard, with the atomic claim script
+        take.assert_not_called()
+        self.assertEqual((partner["username"], matched["username"]), ("en2", "me"))
+        self.assertEqual(await self.lobby.get_session(session), {
+            "user1": "en2", "user2": "me", "user1_username": "en2", "user2_username": "me",
+        })
+
+    async def test_pairs_across_shards_are_only_stolen_by_the_matcher(self):
+        await self.add(make_user("en1"))
+        await self.add(make_user("de1", language="de"))
+
+        self.assertIsNone(await self.lobby.claim_pair("en1", "u:u:en", "de1", "u:u:de", "session"))
+        self.assertEqual(await self.lobby.size(), 2)
+
+        matched = await self.lobby.claim_pairs([("en1", "u:u:en", "de1", "u:u:de", "session")])
+
+        self.assertEqual([(session, user1["username"], user2["username"]) for session, user1, user2 in matched], [
+            ("session", "en1", "de1"),
+        ])
+        self.assertEqual(await self.lobby.size(), 0)
+        self.assertEqual((await self.lobby.get_session("session"))["user2"], "de1")
+        self.assertEqual((await self.lobby.status(2))["matched"], 2)
+
+    async def test_a_stolen_user_is_put_back_when_its_partner_is_gone(self):
+        await self.add(make_user("en1"))
+        await self.add(make_user("de1", language="de"))
+        await self.lobby.remove("de1", "u:u:de")
+
+        self.assertEqual(await self.lobby.claim_pairs([("en1", "u:u:en", "de1", "u:u:de", "session")]), [])
+        self.assertEqual(await self.lobby.peek_buckets(["u:u:en"], 5), [("en1", "u:u:en")])
+        self.assertEqual(await self.lobby.get_session("session"), {})
+
+    async def test_sessions_are_on_the_shard_of_the_session_id(self):
+        await self.add(make_user("en1"))
+        await self.add(make_user("en2"))
+
+        # "session1" hashes to the second host, the users are on the first one
+        await self.lobby.claim_pair("en1", "u:u:en", "en2", "u:u:en", "session1")
+
+        self.assertEqual(await self.en_shard.get_session("session1"), {})
+        self.assertEqual((await self.de_shard.get_session("session1"))["user1"], "en1")
+
+        await self.lobby.end_sessions(["session1"])
+        self.assertEqual(await self.lobby.get_session("session1"), {})
+
+    async def test_shard_matchers_claim_on_their_shard(self):
+        await self.add(make_user("en1"))
+        await self.add(make_user("en2"))
+        await self.add(make_user("de1", language="de"))
+        channel_layer = mock.AsyncMock()
+
+        matchers = [
+            BatchMatcher(lobby=shard, channel_layer=channel_layer, tick_ms=100, batch_size=10, report_interval=None)
+            for shard in self.lobby.shard_lobbies
+        ]
+        self.assertEqual([await matcher.tick() for matcher in matchers], [1, 0])
+
+        self.assertEqual(await self.lobby.oldest(5), ["de1"])
+        session = channel_layer.send.call_args.args[1]["session"]
+        self.assertEqual((await self.lobby.get_session(session))["user1"], "en1")
+        self.assertTrue(await self.lobby.get_avoided_pairs([("en1", "en2")]))
+
+    async def test_the_lobby_size_is_counted_over_every_shard(self):
+        self.lobby.size_refresh_seconds = 0
+        self.assertIsNotNone(await self.add(make_user("en1"), max_size=2))
+        self.assertIsNotNone(await self.add(make_user("de1", language="de"), max_size=2))
+        self.assertIsNone(await self.add(make_user("de2", language="de"), max_size=2))
+        self.assertIsNone(await self.add(make_user("en2"), max_size=2))
+
+    async def test_the_lobby_size_is_counted_once_per_refresh(self):
+        with mock.patch.object(RedisLobby, "size", return_value=0) as size:
+            for username in ("en1", "en2", "en3"):
+                await self.add(make_user(username), max_size=10)
+
+        self.assertEqual(size.call_count, 2)
+
+
+class MatchmakingTests(SimpleTestCase):
+
+    def test_candidate_buckets_of_the_filters(self):
+        user = make_user("a", genders=["f"], min_age=20, max_age=35)
+
+        self.assertEqual(candidate_buckets(user), ["f:20:en", "f:30:en"])
+
+    def test_candidate_buckets_without_age_filter_include_unknown_age(self):
+        buckets = candidate_buckets(make_user("a", genders=["m"]))
+
+        self.assertIn("m:u:en", buckets)
+        self.assertIn("m:90:en", buckets)
+        self.assertTrue(all(bucket.startswith("m:") for bucket in buckets))
+
+    def test_both_users_have_to_accept_each_other(self):
+        man = make_user("m", gender="m", age=30, genders=["f"])
+        woman = make_user("f", gender="f", age=25, min_age=35)
+
+        self.assertFalse(is_compatible(man, woman))
+        self.assertTrue(is_compatible(man, {**woman, "preferences": {**woman["preferences"], "min_age": 30}}))
+        self.assertFalse(is_compatible(man, {**woman, "language": "fr"}))
+
+    async def test_find_partner_looks_in_the_candidate_buckets(self):
+        lobby = InMemoryLobby()
+        for user in (make_user("m1", gender="m"), make_user("f1", gender="f", age=50), make_user("f2", gender="f", age=25)):
+            await lobby.add(user["channel_name"], user, bucket_of(user), 60)
+
+        user = make_user("me", gender="m", genders=["f"], max_age=30)
+        await lobby.add("me", user, bucket_of(user), 60)
+        session, partner, matched = await find_partner(lobby, "me", user)
+
+        self.assertEqual((partner["username"], matched["username"]), ("f2", "me"))
+        self.assertEqual(await lobby.oldest(5), ["m1", "f1"])
+
+    async def test_find_partner_skips_the_recent_partners(self):
+        lobby = InMemoryLobby()
+        for user in (make_user("a"), make_user("b"), make_user("me")):
+            await lobby.add(user["channel_name"], user, bucket_of(user), 60)
+        await lobby.remember_partners([("me", "a")], 60, 10)
+
+        _, partner, _ = await find_partner(lobby, "me", make_user("me"))
+
+        self.assertEqual(partner["username"], "b")
+        self.assertEqual(await lobby.get_avoided_pairs([("me", "b")]), {("me", "b"), ("b", "me")})
+
+    def test_pair_batch_skips_the_avoided_users(self):
+        now = 1000
+        with mock.patch("realtime.matchmaking.time.time", return_value=now):
+            users = [make_user(name, enqueued_at=now) for name in ("a", "b", "c")]
+            pairs = pair_batch(users, avoided={("a", "b"), ("b", "a")})
+
+        self.assertEqual([(user1["username"], user2["username"]) for user1, user2 in pairs], [("a", "c")])
+
+    async def test_find_pairs_pairs_again_without_the_avoided_pairs(self):
+        lobby = InMemoryLobby()
+        await lobby.remember_partners([("a", "b")], 60, 10)
+        users = [make_user(name, enqueued_at=time.time()) for name in ("a", "b", "c", "d")]
+
+        with mock.patch.object(lobby, "get_avoided_pairs", wraps=lobby.get_avoided_pairs) as get_avoided_pairs:
+            pairs = await find_pairs(lobby, users)
+
+        self.assertEqual([(user1["username"], user2["username"]) for user1, user2 in pairs], [("a", "c"), ("b", "d")])
+        # Only the proposed pairs are looked up, never the whole recent partners
+        self.assertEqual([call.args[0] for call in get_avoided_pairs.call_args_list], [
+            [("a", "b"), ("c", "d")],
+            [("a", "c"), ("b", "d")],
+        ])
+
+
+class RelaxTests(SimpleTestCase):
+
+    def test_relax_widens_the_filters_with_the_wait(self):
+        user = make_user("a", genders=["f"], min_age=20, max_age=30)
+
+        self.assertIs(relax(user, RELAX_STEP_SECONDS - 1), user)
+
+        level_1 = relax(user, RELAX_STEP_SECONDS)["preferences"]
+        self.assertEqual((level_1["min_age"], level_1["max_age"]), (15, 35))
+        self.assertEqual(level_1["genders"], ["f"])
+
+        level_3 = relax(user, RELAX_STEP_SECONDS * 3)["preferences"]
+        self.assertEqual((level_3["min_age"], level_3["max_age"], level_3["genders"]), (None, None, []))
+        self.assertFalse(level_3.get("any_language"))
+
+        self.assertTrue(relax(user, RELAX_STEP_SECONDS * 10)["preferences"]["any_language"])
+        # The user's own attributes never change
+        self.assertEqual(user["preferences"]["min_age"], 20)
+
+    def test_a_user_accepting_anybody_looks_at_the_whole_lobby(self):
+        user = relax(make_user("a", genders=["f"]), RELAX_STEP_SECONDS * 4)
+
+        self.assertIsNone(candidate_buckets(user))
+
+    def test_pair_batch_serves_the_long_waiting_users_first(self):
+        now = 1000
+        with mock.patch("realtime.matchmaking.time.time", return_value=now):
+            users = [
+                # Waited long enough to accept any gender
+                make_user("picky", gender="m", genders=["f"], enqueued_at=now - RELAX_STEP_SECONDS * 3),
+                make_user("m1", gender="m", enqueued_at=now),
+                make_user("m2", gender="m", enqueued_at=now),
+            ]
+            pairs = pair_batch(users)
+
+        self.assertEqual([(user1["username"], user2["username"]) for user1, user2 in pairs], [("picky", "m1")])
+
+    async def test_find_partner_relaxes_the_waiting_candidates(self):
+        lobby = InMemoryLobby()
+        picky = make_user("picky", gender="m", genders=["f"])
+        await lobby.add("picky", picky, bucket_of(picky), 60)
+        lobby.users["picky"]["enqueued_at"] -= RELAX_STEP_SECONDS * 3
+
+        user = make_user("me", gender="m")
+        await lobby.add("me", user, bucket_of(user), 60)
+
+        _, partner, _ = await find_partner(lobby, "me", user)
+        self.assertEqual(partner["username"], "picky")
+
+
+class BatchMatcherTests(SimpleTestCase):
+
+    def test_pair_batch_pairs_the_compatible_users_oldest_first(self):
+        now = 1000
+        with mock.patch("realtime.matchmaking.time.time", return_value=now):
+            users = [
+                make_user("m1", gender="m", genders=["f"], enqueued_at=now),
+                make_user("m2", gender="m", genders=["f"], enqueued_at=now),
+                make_user("f1", gender="f", genders=["m"], enqueued_at=now),
+                make_user("fr", gender="f", language="fr", enqueued_at=now),
+            ]
+            pairs = pair_batch(users)
+
+        self.assertEqual([(user1["username"], user2["username"]) for user1, user2 in pairs], [("m1", "f1")])
+
+    async def test_tick_claims_and_notifies_the_pairs(self):
+        lobby = InMemoryLobby()
+        for username in ("a", "b", "c"):
+            user = make_user(username)
+            await lobby.add(username, user, bucket_of(user), 60)
+        channel_layer = mock.AsyncMock()
+
+        matcher = BatchMatcher(lobby, channel_layer, tick_ms=100, batch_size=10, report_interval=None)
+
+        self.assertEqual(await matcher.tick(), 1)
+        self.assertEqual(await lobby.oldest(5), ["c"])
+        notified = {call.args[0] for call in channel_layer.send.await_args_list}
+        self.assertEqual(notified, {"a", "b"})
+
+    async def test_incompatible_users_at_the_head_do_not_stall_the_lobby(self):
+        lobby = InMemoryLobby()
+        # A full batch of users nobody can take waits in front of the compatible ones
+        for index in range(10):
+            user = make_user(f"stuck{index}", gender="m", genders=["f"], language="xx")
+            await lobby.add(user["channel_name"], user, bucket_of(user), 60)
+        for index in range(100):
+            user = make_user(f"user{index}", gender="f")
+            await lobby.add(user["channel_name"], user, bucket_of(user), 60)
+
+        matcher = BatchMatcher(lobby, mock.AsyncMock(), tick_ms=100, batch_size=10, report_interval=None)
+        pairs = 0
+        for _ in range(40):
+            pairs += await matcher.tick()
+
+        self.assertEqual(pairs, 50)
+        self.assertEqual(await lobby.size(), 10)
+
+
+@override_settings(**MEMORY_BACKENDS)
+class ConsumerTestCase(SimpleTestCase):
+    """
+    Runs the websocket consumer on the memory backends, a new lobby for every test.
+    """
+
+    def setUp(self):
+        get_lobby.cache_clear()
+        self.addCleanup(get_lobby.cache_clear)
+        self.application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+    async def connect(self, username, query="", subprotocols=None):
+        communicator = WebsocketCommunicator(
+            self.application, f"/connection-request/?username={username}{query}", subprotocols=subprotocols,
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive(self, communicator, signal_type):
+        # Skips the other messages (queue position...)
+        while True:
+            message = await communicator.receive_json_from()
+            if message["signal_type"] == signal_type:
+                return message
+
+
+class InMemoryConsumerTests(ConsumerTestCase):
+
+    async def test_users_are_matched_in_the_process(self):
+        first = await self.connect("first")
+        second = await self.connect("second")
+
+        first_match = await self.receive(first, "match")
+        second_match = await self.receive(second, "match")
+        self.assertEqual(first_match["session"], second_match["session"])
+        self.assertEqual(first_match["peer"], {"username": "second"})
+        self.assertIsInstance(get_lobby(), InMemoryLobby)
+
+        await first.disconnect()
+        await second.disconnect()
+
+
+class DisconnectTests(ConsumerTestCase):
+
+    async def test_disconnect_leaves_the_lobby(self):
+        waiting = await self.connect("waiting")
+        self.assertEqual(await get_lobby().size(), 1)
+
+        await waiting.disconnect()
+        self.assertEqual(await get_lobby().size(), 0)
+        self.assertEqual(await get_lobby().peek_buckets(["u:u:en"], 5), [])
+
+    async def test_disconnect_tells_the_peer(self):
+        first = await self.connect("first")
+        second = await self.connect("second")
+        match = await self.receive(first, "match")
+
+        await second.disconnect()
+
+        peer_left = await self.receive(first, "peer_left")
+        self.assertEqual((peer_left["session"], peer_left["reason"]), (match["session"], "disconnect"))
+        self.assertEqual(await get_lobby().get_session(match["session"]), {})
+        await first.disconnect()
+
+
+class SignalingTests(ConsumerTestCase):
+
+    async def match(self):
+        first = await self.connect("first")
+        second = await self.connect("second")
+        match = await self.receive(first, "match")
+        await self.receive(second, "match")
+        return first, second, match["session"]
+
+    async def test_signals_are_relayed_by_session(self):
+        first, second, session = await self.match()
+
+        await first.send_json_to({"session": session, "signal_type": "offer", "sdp": "offer"})
+        self.assertEqual(await self.receive(second, "offer"), {"session": session, "signal_type": "offer", "sdp": "offer"})
+
+        await second.send_json_to({"session": session, "signal_type": "answer", "sdp": "answer"})
+        self.assertEqual((await self.receive(first, "answer"))["sdp"], "answer")
+
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_signals_of_other_sessions_are_not_relayed(self):
+        first, second, session = await self.match()
+
+        # Not in that session, and user2 can not send itself the offer
+        await first.send_json_to({"session": "unknown", "signal_type": "offer", "sdp": "offer"})
+        await second.send_json_to({"session": session, "signal_type": "offer", "sdp": "offer"})
+
+        self.assertTrue(await second.receive_nothing())
+        self.assertTrue(await first.receive_nothing())
+
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_invalid_sessions_are_dropped(self):
+        first, second, session = await self.match()
+        dropped = SIGNALS_DROPPED.values.get("invalid_session", 0)
+
+        for invalid in (["x"], {"id": "x"}, 1, "x" * 65, ""):
+            await first.send_json_to({"session": invalid, "signal_type": "ice_candidate_user1", "sdp": "candidate"})
+
+        # The connection is still there
+        await first.send_json_to({"session": session, "signal_type": "offer", "sdp": "offer"})
+        self.assertEqual((await self.receive(second, "offer"))["sdp"], "offer")
+        self.assertEqual(SIGNALS_DROPPED.values["invalid_session"], dropped + 5)
+
+        await first.disconnect()
+        await second.disconnect()
+
+
+@mock.patch.object(ConnectionConsumer, "ice_batch_seconds", 0.05)
+class IceBatchingTests(ConsumerTestCase):
+
+    async def match(self, second_query=""):
+        first = await self.connect("first")
+        second = await self.connect("second", second_query)
+        session = (await self.receive(first, "match"))["session"]
+        await self.receive(second, "match")
+        return first, second, session
+
+    async def send_candidates(self, communicator, session, candidates):
+        for candidate in candidates:
+            await communicator.send_json_to({"session": session, "signal_type": "ice_candidate_user1", "sdp": candidate})
+
+    async def test_candidates_after_the_first_are_sent_in_one_batch(self):
+        first, second, session = await self.match("&ice_batch=1")
+
+        await self.send_candidates(first, session, ["c1", "c2", "c3"])
+
+        self.assertEqual((await second.receive_json_from())["sdp"], "c1")
+        self.assertEqual(await second.receive_json_from(timeout=1), {
+            "session": session, "signal_type": "ice_candidate_user1", "sdps": ["c2", "c3"],
+        })
+
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_clients_without_batches_get_one_frame_per_candidate(self):
+        first, second, session = await self.match()
+
+        await self.send_candidates(first, session, ["c1", "c2", "c3"])
+
+        sdps = [(await second.receive_json_from(timeout=1))["sdp"] for _ in range(3)]
+        self.assertEqual(sdps, ["c1", "c2", "c3"])
+
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_buffered_candidates_are_not_overtaken(self):
+        first, second, session = await self.match()
+
+        await self.send_candidates(first, session, ["c1", "c2"])
+        await first.send_json_to({"session": session, "signal_type": "offer", "sdp": "offer"})
+
+        received = [(await second.receive_json_from(timeout=1))["sdp"] for _ in range(3)]
+        self.assertEqual(received, ["c1", "c2", "offer"])
+
+        await first.disconnect()
+        await second.disconnect()
+
+
+class CodecTests(ConsumerTestCase):
+
+    def test_select_codec(self):
+        self.assertIs(select_codec(None), JSONCodec)
+        self.assertIs(select_codec(["other"]), JSONCodec)
+        self.assertIs(select_codec([JSON_SUBPROTOCOL]), JSONSubprotocolCodec)
+        self.assertIs(select_codec([JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL]), MessagePackCodec)
+
+    async def test_msgpack_clients_exchange_binary_frames_with_json_clients(self):
+        binary = WebsocketCommunicator(
+            self.application, "/connection-request/?username=binary", subprotocols=["other", MSGPACK_SUBPROTOCOL],
+        )
+        self.assertEqual(await binary.connect(), (True, MSGPACK_SUBPROTOCOL))
+        text = await self.connect("text")
+
+        match = msgpack.unpackb(await binary.receive_from())
+        self.assertEqual(match["signal_type"], "match")
+        session = match["session"]
+        await self.receive(text, "match")
+
+        await binary.send_to(bytes_data=msgpack.packb({"session": session, "signal_type": "offer", "sdp": "offer"}))
+        self.assertEqual((await self.receive(text, "offer"))["sdp"], "offer")
+
+        # JSON text frames are still understood on a MessagePack connection
+        await text.send_json_to({"session": session, "signal_type": "answer", "sdp": "answer"})
+        await binary.send_to(text_data=json.dumps({"session": session, "signal_type": "ice_candidate_user1", "sdp": "c1"}))
+        self.assertEqual(msgpack.unpackb(await binary.receive_from())["sdp"], "answer")
+        self.assertEqual((await self.receive(text, "ice_candidate_user1"))["sdp"], "c1")
+
+        await binary.disconnect()
+        await text.disconnect()
+
+
+@mock.patch("realtime.presence.REFRESH_INTERVAL", 0.01)
+@mock.patch("realtime.presence.CLIENT_TIMEOUT", 0.05)
+class PresenceTests(ConsumerTestCase):
+
+    async def test_silent_clients_leave_the_lobby_and_come_back_with_next(self):
+        quiet = await self.connect("quiet")
+        await quiet.send_json_to({"signal_type": "heartbeat"})
+
+        timeout = await quiet.receive_json_from(timeout=1)
+        self.assertEqual((timeout["signal_type"], timeout["reason"]), ("busy", "presence_timeout"))
+        self.assertEqual(await get_lobby().size(), 0)
+
+        await quiet.send_json_to({"signal_type": "next"})
+        self.assertTrue(await quiet.receive_nothing())
+        users = await get_lobby().get_users(await get_lobby().oldest(5))
+        self.assertEqual([user["username"] for user in users], ["quiet"])
+
+        await quiet.disconnect()
+
+    async def test_waiting_users_are_refreshed_and_the_expired_ones_reaped(self):
+        ghost = make_user("ghost", language="xx")
+        await get_lobby().add("ghost", ghost, bucket_of(ghost), -1)
+
+        waiting = await self.connect("waiting")
+        await asyncio.sleep(0.1)
+
+        users = await get_lobby().get_users(await get_lobby().oldest(5))
+        self.assertEqual([user["username"] for user in users], ["waiting"])
+
+        await waiting.disconnect()
+
+
+class RematchTests(ConsumerTestCase):
+
+    async def test_leave_tells_the_peer(self):
+        first = await self.connect("first")
+        second = await self.connect("second")
+        match = await self.receive(first, "match")
+
+        await second.send_json_to({"signal_type": "leave"})
+
+        peer_left = await self.receive(first, "peer_left")
+        self.assertEqual((peer_left["session"], peer_left["reason"]), (match["session"], "leave"))
+        self.assertEqual(await get_lobby().get_session(match["session"]), {})
+        self.assertEqual(await get_lobby().size(), 0)
+
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_next_matches_again_on_the_same_connection(self):
+        first = await self.connect("first")
+        second = await self.connect("second")
+        old_session = (await self.receive(first, "match"))["session"]
+        await self.receive(second, "match")
+
+        await first.send_json_to({"signal_type": "next"})
+        self.assertEqual((await self.receive(second, "peer_left"))["reason"], "next")
+        self.assertEqual(await get_lobby().size(), 1)
+
+        third = await self.connect("third")
+        match = await self.receive(first, "match")
+        self.assertNotEqual(match["session"], old_session)
+        self.assertEqual(match["peer"], {"username": "third"})
+
+        for communicator in (first, second, third):
+            await communicator.disconnect()
+
+
+def make_access_token(username, lifetime=None):
+    token = AccessToken()
+    token["user_id"] = 1
+    token["username"] = username
+    if lifetime is not None:
+        token.set_exp(lifetime=lifetime)
+    return str(token)
+
+
+class JWTAuthTests(ConsumerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        verified_tokens.tokens.clear()
+
+    def test_tokens(self):
+        self.assertEqual(get_user_from_token(make_access_token("alice")).username, "alice")
+
+        for raw_token in (None, "", "not-a-token", make_access_token(""), make_access_token("alice", timedelta(seconds=-1))):
+            self.assertFalse(get_user_from_token(raw_token).is_authenticated)
+
+    def test_verified_token_cache(self):
+        cache = VerifiedTokenCache(max_size=2)
+        cache.set("a", "alice", time.time() + 60)
+        cache.set("b", "bob", time.time() + 60)
+        cache.get("a")
+        cache.set("c", "carol", time.time() + 60)
+        cache.set("expired", "dave", time.time() - 1)
+
+        # "b" was the least recently used one
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("expired")), (None, None, None))
+        self.assertEqual(cache.get("c"), "carol")
+
+    async def test_token_in_the_subprotocols(self):
+        token = make_access_token("alice")
+        alice = WebsocketCommunicator(
+            self.application, "/connection-request/?username=forged", subprotocols=[f"bearer.{token}", JSON_SUBPROTOCOL],
+        )
+        # The token is never echoed back as the subprotocol
+        self.assertEqual(await alice.connect(), (True, JSON_SUBPROTOCOL))
+        bob = await self.connect("bob")
+
+        self.assertEqual((await self.receive(bob, "match"))["peer"], {"username": "alice"})
+        self.assertEqual(verified_tokens.get(token).username, "alice")
+
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_token_in_the_query_string(self):
+        alice = await self.connect("forged", f"&token={make_access_token('alice')}")
+        bob = await self.connect("bob")
+
+        self.assertEqual((await self.receive(bob, "match"))["peer"], {"username": "alice"})
+
+        await alice.disconnect()
+        await bob.disconnect()
+
+
+class SignalRateLimitTests(ConsumerTestCase):
+
+    @mock.patch("realtime.throttling.time.monotonic")
+    def test_token_bucket(self, monotonic):
+        monotonic.return_value = 100
+        bucket = TokenBucket(rate=2, capacity=3)
+
+        self.assertEqual([bucket.consume() for _ in range(4)], [True, True, True, False])
+
+        monotonic.return_value = 100.5
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+
+        # Never refilled over its capacity
+        monotonic.return_value = 200
+        self.assertEqual([bucket.consume() for _ in range(4)], [True, True, True, False])
+
+    @mock.patch.object(ConnectionConsumer, "max_dropped_signals", 3)
+    async def test_flooding_clients_are_closed(self):
+        flooding = await self.connect("flooding")
+
+        for _ in range(4):
+            await flooding.send_json_to({"signal_type": "unknown"})
+
+        self.assertEqual(await flooding.receive_output(), {"type": "websocket.close", "code": 4008})
+
+    @mock.patch.object(ConnectionConsumer, "max_dropped_signals", 3)
+    @mock.patch.object(ConnectionConsumer, "dropped_signals_window", 0.2)
+    async def test_drops_spread_over_time_are_forgotten(self):
+        client = await self.connect("client")
+
+        for _ in range(3):
+            for _ in range(3):
+                await client.send_json_to({"signal_type": "unknown"})
+            self.assertTrue(await client.receive_nothing())
+            await asyncio.sleep(0.2)
+
+        await client.disconnect()
+
+
+class AdmissionTests(ConsumerTestCase):
+
+    def test_estimate_position(self):
+        marks = [[100, 0], [200, 10], [300, 20]]
+
+        self.assertEqual(estimate_position([], 150), 1)
+        self.assertEqual(estimate_position(marks, 50), 1)
+        self.assertEqual(estimate_position(marks, 150), 6)
+        self.assertEqual(estimate_position(marks, 250), 16)
+        self.assertEqual(estimate_position(marks, 400), 21)
+
+    async def test_connections_over_the_limit_are_shed(self):
+        active = ACTIVE_CONNECTIONS.value
+        admission = {**ConnectionConsumer.admission, "MAX_CONNECTIONS": active}
+
+        with mock.patch.object(ConnectionConsumer, "admission", admission):
+            shed = await self.connect("shed")
+            busy = await shed.receive_json_from()
+            self.assertEqual((busy["signal_type"], busy["reason"]), ("busy", "server_full"))
+            self.assertGreaterEqual(busy["retry_after"], admission["RETRY_AFTER"])
+            self.assertEqual(await shed.receive_output(), {"type": "websocket.close", "code": 4029})
+            await shed.disconnect()
+
+        # The shed connection is not counted anymore and never joined the lobby
+        self.assertEqual(ACTIVE_CONNECTIONS.value, active)
+        self.assertEqual(await get_lobby().size(), 0)
+
+    async def test_users_over_the_lobby_size_are_shed(self):
+        admission = {**ConnectionConsumer.admission, "MAX_LOBBY_SIZE": 1}
+
+        with mock.patch.object(ConnectionConsumer, "admission", admission):
+            waiting = await self.connect("waiting", query="&language=en")
+            shed = await self.connect("shed", query="&language=fr")
+            self.assertEqual((await self.receive(shed, "busy"))["reason"], "lobby_full")
+
+        self.assertEqual(await get_lobby().size(), 1)
+        await shed.disconnect()
+        await waiting.disconnect()
+
+    async def test_waiting_users_get_their_queue_position(self):
+        first = await self.connect("first", query="&language=en")
+        second = await self.connect("second", query="&language=fr")
+
+        broadcaster = LobbyStatusBroadcaster(get_lobby(), get_channel_layer(), marks=2)
+        await broadcaster.broadcast()
+
+        first_position = await self.receive(first, "queue_position")
+        second_position = await self.receive(second, "queue_position")
+        self.assertEqual((first_position["position"], first_position["lobby_size"]), (1, 2))
+        self.assertEqual((second_position["position"], second_position["lobby_size"]), (2, 2))
+        # No match rate yet, so no wait estimate
+        self.assertIsNone(first_position["estimated_wait"])
+
+        await first.disconnect()
+        await second.disconnect()
+
+
+class DrainTests(ConsumerTestCase):
+
+    async def test_draining_workers_shed_new_connections(self):
+        active = ACTIVE_CONNECTIONS.value
+
+        with mock.patch.object(drain, "draining", True):
+            shed = await self.connect("shed")
+            busy = await shed.receive_json_from()
+            self.assertEqual((busy["signal_type"], busy["reason"]), ("busy", "draining"))
+            await shed.disconnect()
+
+        self.assertEqual(ACTIVE_CONNECTIONS.value, active)
+        self.assertEqual(await get_lobby().size(), 0)
+
+    async def test_drained_users_get_their_place_back_once(self):
+        waiting = await self.connect("waiting")
+        channel_name, = await get_lobby().oldest(1)
+        enqueued_at = (await get_lobby().get_users([channel_name]))[0]["enqueued_at"]
+
+        await get_channel_layer().send(channel_name, {"type": "worker.drain", "retry_after": 1})
+        reconnect = await self.receive(waiting, "reconnect")
+        self.assertEqual(await waiting.receive_output(), {"type": "websocket.close", "code": 1012})
+        self.assertEqual(await get_lobby().size(), 0)
+
+        lobby = get_lobby()
+        with mock.patch.object(lobby, "add", wraps=lobby.add) as add:
+            for _ in range(2):
+                resumed = await self.connect("waiting", query=f"&resume={reconnect['resume']}")
+                await resumed.disconnect()
+
+        # A replayed token does not give the place in the queue again
+        self.assertEqual([call.kwargs["enqueued_at"] for call in add.call_args_list], [enqueued_at, None])
+
+    async def test_resume_tokens_of_other_users_are_refused(self):
+        token = make_resume_token("first", 1000)
+
+        self.assertIsNone(await use_resume_token(token, "second"))
+        self.assertIsNone(await use_resume_token(token + "x", "first"))
+        self.assertEqual(await use_resume_token(token, "first"), 1000)
+        self.assertIsNone(await use_resume_token(token, "first"))
+
+
+@override_settings(REALTIME_CHAT={"BATCH_SIZE": 3, "FLUSH_MS": 50})
+class ChatWriterTests(TransactionTestCase):
+    """
+    The writer inserts from the database thread of database_sync_to_async, so the test data is committed.
+    """
+
+    async def test_messages_are_written_in_one_batch_after_the_flush_delay(self):
+        writer = ChatWriter()
+
+        with mock.patch("realtime.chat._save_messages", wraps=_save_messages) as save_messages:
+            writer.add(build_message("session", "first", "hello"))
+            writer.add(build_message("session", "second", "hi"))
+            self.assertEqual(await ChatMessage.objects.acount(), 0)
+
+            await writer.task
+
+        save_messages.assert_called_once()
+        self.assertEqual(
+            [message.text async for message in ChatMessage.objects.order_by("sent_date")],
+            ["hello", "hi"],
+        )
+
+    async def test_full_batches_are_written_right_away(self):
+        writer = ChatWriter()
+
+        for text in ("one", "two", "three"):
+            writer.add(build_message("session", "first", text))
+        await asyncio.gather(*writer.writing)
+        self.assertEqual(await ChatMessage.objects.acount(), 3)
+
+        # The next message waits for the flush delay again
+        writer.add(build_message("session", "first", "four"))
+        self.assertEqual(len(writer.buffer), 1)
+        await writer.task
+        self.assertEqual(await ChatMessage.objects.acount(), 4)
+
+    async def test_stale_database_connections_are_closed_before_writing(self):
+        writer = ChatWriter()
+        writer.buffer.append(build_message("session", "first", "hello"))
+
+        with mock.patch("channels.db.close_old_connections") as close_old_connections:
+            await writer.flush()
+
+        close_old_connections.assert_called()
+        self.assertEqual(await ChatMessage.objects.acount(), 1)
+
+    async def test_a_failed_batch_is_dropped(self):
+        writer = ChatWriter()
+        writer.buffer.append(build_message("session", "first", "hello"))
+
+        with mock.patch("realtime.chat._save_messages", side_effect=RuntimeError("database down")):
+            await writer.flush()
+
+        self.assertEqual(writer.buffer, [])
+
+
+@override_settings(REALTIME_CHAT={"HISTORY_SIZE": 2})
+@mock.patch.object(chat_writer, "add")
+class ChatTests(ConsumerTestCase):
+
+    async def match(self):
+        first = await self.connect("first")
+        second = await self.connect("second")
+        match = await self.receive(first, "match")
+        await self.receive(second, "match")
+        return first, second, match["session"]
+
+    async def test_messages_are_relayed_and_saved_once(self, add):
+        first, second, session = await self.match()
+
+        await first.send_json_to({"session": session, "signal_type": "chat", "text": "  hello  "})
+        message = await self.receive(second, "chat")
+
+        self.assertEqual((message["session"], message["sender"], message["text"]), (session, "first", "hello"))
+        add.assert_called_once()
+        self.assertEqual(add.call_args.args[0]["text"], "hello")
+
+        # Empty, too long or of another session
+        await first.send_json_to({"session": session, "signal_type": "chat", "text": " "})
+        await first.send_json_to({"session": session, "signal_type": "chat", "text": "x" * 1001})
+        await first.send_json_to({"session": "other", "signal_type": "chat", "text": "hello"})
+        self.assertTrue(await second.receive_nothing())
+        add.assert_called_once()
+
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_history_keeps_the_latest_messages_of_both_users(self, add):
+        first, second, session = await self.match()
+
+        for client, text in ((first, "one"), (second, "two"), (first, "three")):
+            await client.send_json_to({"session": session, "signal_type": "chat", "text": text})
+            await self.receive(second if client is first else first, "chat")
+
+        for client in (first, second):
+            await client.send_json_to({"session": session, "signal_type": "chat_history", "session": session})
+            history = await self.receive(client, "chat_history")
+            self.assertEqual([message["text"] for message in history["messages"]], ["two", "three"])
+
+        # The history goes with the session
+        await second.send_json_to({"signal_type": "leave"})
+        await self.receive(first, "peer_left")
+        await first.send_json_to({"session": session, "signal_type": "chat_history"})
+        self.assertTrue(await first.receive_nothing())
+
+        await first.disconnect()
+        await second.disconnect()
@@ -0,0 +1,79 @@
+"""
+Rate limiting of the signals sent by the websocket clients.
+
+Every connection has its own token bucket per signal type, kept in the
+memory of the consumer, so checking a frame never needs Redis.
+
+How to use:
+    - limiter = SignalRateLimiter(get_signal_rates())
+    - limiter.allow(signal_type) for every frame, False means the frame has to be dropped
+"""
+
+import time
+
+from django.conf import settings
+
+# signal_type -> (tokens refilled per second, bucket size)
+DEFAULT_SIGNAL_RATES = {
+    "offer": (1, 5),
+    "answer": (1, 5),
+    "ice_candidate_user1": (20, 60),
+    "ice_candidate_user2": (20, 60),
+    "heartbeat": (1, 3),
+    "next": (1, 5),
+    "leave": (1, 5),
+    "block": (1, 5),
+    "chat": (2, 10),
+    "chat_history": (1, 3),
+}
+
+
+def get_signal_rates():
+    """
+    Returns the REALTIME_SIGNAL_RATES settings merged over the defaults.
+    """
+    return {**DEFAULT_SIGNAL_RATES, **getattr(settings, "REALTIME_SIGNAL_RATES", {})}
+
+
+class TokenBucket:
+    """
+    Classic token bucket, refilled lazily when a token is asked for.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def consume(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+
+class SignalRateLimiter:
+    """
+    Token buckets of one connection, one per signal type (created on first use).
+    """
+
+    def __init__(self, rates):
+        self.rates = rates
+        self.buckets = {}
+
+    def is_known(self, signal_type):
+        return signal_type in self.rates
+
+    def allow(self, signal_type):
+        bucket = self.buckets.get(signal_type)
+        if bucket is None:
+            bucket = self.buckets[signal_type] = TokenBucket(*self.rates[signal_type])
+        return bucket.consume()
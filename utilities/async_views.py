@@ -0,0 +1,125 @@
+"""
+Async counterpart of the rest_framework APIView for the endpoints that must not hold a thread.
+
+rest_framework views are sync, under Daphne Django runs each of them in the
+one thread it keeps for sync code. AsyncAPIView is a plain Django async view
+doing the little of APIView those endpoints use:
+    - request.data from the JSON (or form) body
+    - JWT authentication (the same tokens as TimedJWTAuthentication) with the
+      async ORM when authentication_required is True
+    - no CSRF check, the API is authenticated with the Authorization header
+    - the rate limits of throttle_scope (utilities.rate_limit), checked before
+      the authentication and the handler so a rejected request costs no query
+
+How to use:
+    class LoginView(AsyncAPIView, ResponseUtilities):
+        async def post(self, request):
+            ...
+            return await self.get_async_response()
+
+    path("login/", LoginView.as_view())
+"""
+
+import asyncio
+import json
+import math
+
+from django.contrib.auth import get_user_model
+from django.http import JsonResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from .rate_limit import get_rate_limiter
+from .response_utilities import get_response_delay
+from .server_timing import timed
+
+
+class AsyncAPIView(View):
+    """
+    Base of the async API views, every handler (post, get...) of the subclasses must be async.
+    """
+
+    authentication_required = False
+    # Scope of RATE_LIMIT["SCOPES"] limiting the requests, None for no limit
+    throttle_scope = None
+    # The DEBUG response delay is awaited, not slept, see ResponseUtilities
+    blocking_response_delay = False
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            request.data = self.parse_data(request)
+        except ValueError:
+            return JsonResponse({"detail": "JSON parse error"}, status=400)
+
+        if self.throttle_scope:
+            retry_after = await get_rate_limiter().check(self.throttle_scope, request)
+            if retry_after:
+                retry_after = math.ceil(retry_after)
+                response = JsonResponse({"detail": f"Too many attempts, try again in {retry_after} seconds."}, status=429)
+                response["Retry-After"] = str(retry_after)
+                return response
+
+        if self.authentication_required:
+            with timed(request, "auth"):
+                user = await self.authenticate(request)
+            if user is None:
+                response = JsonResponse({"detail": "Authentication credentials were not provided or are invalid."}, status=401)
+                response["WWW-Authenticate"] = 'Bearer realm="api"'
+                return response
+            request.user = user
+
+        return await super().dispatch(request, *args, **kwargs)
+
+    def parse_data(self, request):
+        """
+        Returns the body of the request as a dictionary, raises ValueError when the JSON is invalid.
+        """
+        if request.content_type == "application/json":
+            if not request.body:
+                return {}
+            data = json.loads(request.body)
+            if not isinstance(data, dict):
+                raise ValueError("The JSON body must be an object")
+            return data
+        return request.POST
+
+    async def authenticate(self, request):
+        """
+        Returns the active user of the access token of the request, None when there is none or it is invalid.
+        """
+        authentication = JWTAuthentication()
+        header = authentication.get_header(request)
+        if header is None:
+            return None
+
+        raw_token = authentication.get_raw_token(header)
+        if raw_token is None:
+            return None
+
+        try:
+            validated_token = authentication.get_validated_token(raw_token)
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except (InvalidToken, AuthenticationFailed, KeyError):
+            return None
+
+        User = get_user_model()
+        user = await User._default_manager.filter(**{api_settings.USER_ID_FIELD: user_id}).afirst()
+        if user is None or not user.is_active:
+            return None
+        return user
+
+    async def get_async_response(self, status=200):
+        """
+        Returns the JSON response of get_generated_response() (ResponseUtilities).
+        """
+        delay = get_response_delay()
+        if delay:
+            await asyncio.sleep(delay)
+        return JsonResponse(self.get_generated_response(), status=status)
@@ -0,0 +1,282 @@
+"""
+Sliding window rate limits of the API endpoints (login, sign-up, availability).
+
+Every limited endpoint has a scope, and every scope a set of limits: at most
+`requests` per `window` seconds for the same client IP ("ip") or for the same
+value of a field of the request body (e.g. "username"). A request is only
+counted when every limit of its scope lets it through, the rejected ones do
+not push the window further.
+
+The check runs before the view does anything (utilities.async_views), so a
+rejected request costs one Redis round trip, no password hashing nor query.
+
+Behind a reverse proxy REMOTE_ADDR is the proxy, every client would share
+its limits. RATE_LIMIT["TRUSTED_PROXY_HEADER"] (e.g. "HTTP_X_FORWARDED_FOR")
+and ["TRUSTED_PROXY_COUNT"] (the proxies appending to it) make the client IP
+the address added by the farthest trusted proxy, the addresses the client
+put in the header itself are ignored.
+
+The backend is picked with RATE_LIMIT["BACKEND"] in the settings:
+    - utilities.rate_limit.RedisRateLimiter keeps the windows in Redis, shared
+      by every process, all the limits of a request are checked and counted
+      in a single Lua script (one round trip). While Redis cannot be reached
+      it falls back to the in-memory windows of the process.
+    - utilities.rate_limit.InMemoryRateLimiter keeps them in the process, for
+      a single process without Redis and for tests.
+
+How to use:
+    - RATE_LIMIT["SCOPES"] = {"login": {"ip": (20, 60), "username": (5, 60)}} in the settings
+    - RATE_LIMIT["TRUSTED_PROXY_HEADER"] = "HTTP_X_FORWARDED_FOR" behind one reverse proxy
+    - throttle_scope = "login" on an AsyncAPIView
+    - retry_after = await get_rate_limiter().check("login", request), 0 means allowed
+"""
+
+import secrets
+import time
+from collections import deque
+from functools import cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from redis import asyncio as aioredis
+
+from realtime.metrics import Counter, register
+
+RATE_LIMIT_KEY = 'rate_limit:'  # Sorted set per scope, limit and value: request id -> time of the request (ms)
+
+# Longest part of a field value used in the keys, longer values are cut
+MAX_VALUE_LENGTH = 100
+
+# scope -> {"ip" or field of the body: (requests, window in seconds)}
+DEFAULT_RATE_LIMIT_SCOPES = {
+    "login": {"ip": (20, 60), "username": (5, 60)},
+    "sign_up": {"ip": (5, 600)},
+    "availability": {"ip": (120, 60)},
+}
+
+# Requests rejected by the rate limits
+RATE_LIMITED = register(
+    "api_rate_limited_total",
+    "API requests rejected by the rate limits, per scope.",
+    Counter(),
+    label="scope",
+)
+
+# Checks every window of the request and counts the request in all of them
+# only when none is full.
+# KEYS: one sorted set per limit
+# ARGV: now (ms), request id, then the requests and window (ms) of every key
+# Returns the milliseconds before the request would be allowed, 0 when it was counted
+CHECK_SCRIPT = """
+local now = tonumber(ARGV[1])
+local retry_after = 0
+
+for index, key in ipairs(KEYS) do
+    local requests = tonumber(ARGV[index * 2 + 1])
+    local window = tonumber(ARGV[index * 2 + 2])
+
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+    if redis.call('ZCARD', key) >= requests then
+        -- The window frees a slot when its oldest request gets out of it
+        local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+        retry_after = math.max(retry_after, tonumber(oldest[2]) + window - now)
+    end
+end
+
+if retry_after > 0 then
+    return retry_after
+end
+
+for index, key in ipairs(KEYS) do
+    redis.call('ZADD', key, now, ARGV[2])
+    redis.call('PEXPIRE', key, ARGV[index * 2 + 2])
+end
+return 0
+"""
+
+
+def get_rate_limit_settings():
+    """
+    Returns the RATE_LIMIT settings, the Redis backend on REDIS_URL and the default scopes when they are not set.
+    """
+    rate_limit_settings = getattr(settings, "RATE_LIMIT", {})
+    return {
+        "BACKEND": "utilities.rate_limit.RedisRateLimiter",
+        "OPTIONS": {"url": settings.REDIS_URL},
+        "TRUSTED_PROXY_HEADER": None,  # request.META key of the X-Forwarded-For header, None when not behind a proxy
+        "TRUSTED_PROXY_COUNT": 1,  # Trusted proxies appending to the header
+        **rate_limit_settings,
+        "SCOPES": {**DEFAULT_RATE_LIMIT_SCOPES, **rate_limit_settings.get("SCOPES", {})},
+    }
+
+
+def get_client_ip(request, proxy_header=None, proxy_count=1):
+    """
+    Returns the IP of the client, read from the header of the trusted proxies when there is one.
+
+    Every proxy appends the address it got the request from, so with
+    `proxy_count` trusted proxies the client is the `proxy_count`-th address
+    from the end, whatever the client sent at the start of the header.
+    """
+    forwarded = request.META.get(proxy_header) if proxy_header else None
+    if not forwarded:
+        return request.META.get("REMOTE_ADDR")
+
+    addresses = [address.strip() for address in forwarded.split(",") if address.strip()]
+    if not addresses:
+        return request.META.get("REMOTE_ADDR")
+    return addresses[-min(proxy_count, len(addresses))]
+
+
+def get_limits(scope, request, scopes, client_ip=None):
+    """
+    Returns (key, requests, window in seconds) of every limit of the scope applying to the request.
+
+    A limit on a field the request does not have is skipped.
+    """
+    limits = []
+    for name, (requests, window) in scopes[scope].items():
+        if name == "ip":
+            value = client_ip or request.META.get("REMOTE_ADDR")
+        else:
+            value = getattr(request, "data", {}).get(name)
+
+        if not value or not isinstance(value, str):
+            continue
+
+        value = value.strip().lower()[:MAX_VALUE_LENGTH]
+        limits.append((f"{RATE_LIMIT_KEY}{scope}:{name}:{value}", requests, window))
+    return limits
+
+
+class BaseRateLimiter:
+    """
+    Interface of the rate limit backends.
+    """
+
+    def __init__(self, scopes=None):
+        rate_limit_settings = get_rate_limit_settings()
+        self.scopes = scopes or rate_limit_settings["SCOPES"]
+        self.proxy_header = rate_limit_settings["TRUSTED_PROXY_HEADER"]
+        self.proxy_count = rate_limit_settings["TRUSTED_PROXY_COUNT"]
+
+    async def check(self, scope, request):
+        """
+        Counts the request in the windows of its scope.
+
+        Returns:
+            float: Seconds before the request would be allowed, 0 when it is allowed (and counted).
+        """
+        client_ip = get_client_ip(request, self.proxy_header, self.proxy_count)
+        retry_after = await self.check_limits(get_limits(scope, request, self.scopes, client_ip))
+        if retry_after:
+            RATE_LIMITED.inc(scope)
+        return retry_after
+
+    async def check_limits(self, limits):
+        raise NotImplementedError
+
+
+class InMemoryRateLimiter(BaseRateLimiter):
+    """
+    Sliding windows kept in the process, the limits are per process.
+
+    Nothing is awaited while checking, so a check is atomic on the event loop.
+    """
+
+    # Seconds between two sweeps of the windows not used anymore
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, scopes=None):
+        super().__init__(scopes)
+        self.windows = {}  # key -> (deque of request times, window in seconds)
+        self.swept_at = time.monotonic()
+
+    async def check_limits(self, limits):
+        return self.check_limits_now(limits)
+
+    def check_limits_now(self, limits):
+        now = time.monotonic()
+        self.sweep(now)
+
+        retry_after = 0
+        for key, requests, window in limits:
+            times = self.windows.get(key, (deque(),))[0]
+            while times and times[0] <= now - window:
+                times.popleft()
+            if len(times) >= requests:
+                retry_after = max(retry_after, times[0] + window - now)
+
+        if retry_after:
+            return retry_after
+
+        for key, requests, window in limits:
+            self.windows.setdefault(key, (deque(), window))[0].append(now)
+        return 0
+
+    def sweep(self, now):
+        # Drops the windows whose last request is out of them, so one-off IPs and usernames do not pile up
+        if now - self.swept_at < self.SWEEP_INTERVAL:
+            return
+        self.swept_at = now
+
+        for key, (times, window) in list(self.windows.items()):
+            if not times or times[-1] <= now - window:
+                del self.windows[key]
+
+
+class RedisRateLimiter(BaseRateLimiter):
+    """
+    Sliding windows in Redis sorted sets, shared by every process.
+    """
+
+    # Seconds the in-memory windows are used after Redis failed, before trying it again
+    RETRY_INTERVAL = 5
+
+    def __init__(self, url, scopes=None, max_connections=20, socket_timeout=0.25):
+        super().__init__(scopes)
+        self.pool = aioredis.BlockingConnectionPool.from_url(
+            url,
+            max_connections=max_connections,
+            socket_timeout=socket_timeout,
+            socket_connect_timeout=socket_timeout,
+        )
+        self.client = aioredis.Redis(connection_pool=self.pool)
+        self.check_script = self.client.register_script(CHECK_SCRIPT)
+
+        self.fallback = InMemoryRateLimiter(self.scopes)
+        self.failed_at = None
+
+    async def check_limits(self, limits):
+        if not limits:
+            return 0
+
+        if self.failed_at is not None and time.monotonic() - self.failed_at < self.RETRY_INTERVAL:
+            return self.fallback.check_limits_now(limits)
+
+        args = [int(time.time() * 1000), secrets.token_hex(8)]
+        for key, requests, window in limits:
+            args.extend((requests, int(window * 1000)))
+
+        try:
+            retry_after = await self.check_script(keys=[key for key, _, _ in limits], args=args)
+        except (aioredis.ConnectionError, aioredis.TimeoutError) as e:
+            if self.failed_at is None:
+                print("!!! Got Error reaching Redis for the rate limits, limiting in memory !!!", e)
+            self.failed_at = time.monotonic()
+            return self.fallback.check_limits_now(limits)
+
+        self.failed_at = None
+        return int(retry_after) / 1000
+
+
+@cache
+def get_rate_limiter():
+    """
+    Returns the rate limiter shared by the whole process.
+    """
+    rate_limit_settings = get_rate_limit_settings()
+    return import_string(rate_limit_settings["BACKEND"])(
+        scopes=rate_limit_settings["SCOPES"],
+        **rate_limit_settings["OPTIONS"],
+    )
@@ -1,3 +1,18 @@
+import time
+
+from django.conf import settings
+
+from .server_timing import timed
+
+
+def get_response_delay():
+    """
+        Returns the seconds every response is delayed by, RESPONSE_DELAY_SECONDS is ignored when DEBUG is off
+    """
+    delay = getattr(settings, "RESPONSE_DELAY_SECONDS", 0)
+    return delay if settings.DEBUG else 0
+
+
 class ResponseUtilities:
     """
         This provides the global response attributes
@@ -5,6 +20,8 @@ class ResponseUtilities:
         How to use:
             1. Just inherit the class and work with the attributes
             2. use get_generated_response at last to get the generated response
+            3. wrap the slow parts of the view in `with self.timed("validation"):` to see them
+               in the Server-Timing header (settings.SERVER_TIMING, see utilities.server_timing)
 
         Customization:
             If you need to add more attributes or things in the response
@@ -13,10 +30,17 @@ class ResponseUtilities:
     success_status:bool = False # This will be send as the indicator if the reqeust has success end or not
     message_to_client = None # This will have messages like ERROR message or SUCCESS message
     response_data = None # This will be the Response Data
+    blocking_response_delay:bool = True # The async views (utilities.async_views) await the delay instead
+
+    def timed(self, name):
+        """
+            Times the block as `name` in the Server-Timing header of the response
+        """
+        return timed(self.request, name)
 
     def get_generated_response(self):
         """
-            Only adding the attribute that is available and returning     
+            Only adding the attribute that is available and returning
         """
         generated_response = {
             "success_status" : self.success_status
@@ -28,6 +52,9 @@ class ResponseUtilities:
         if self.response_data:
             generated_response["response_data"] = self.response_data
 
-        import time
-        time.sleep(2)
-        return generated_response
\ No newline at end of file
+        # Slow responses for trying the frontend loading states, only ever in development
+        delay = get_response_delay()
+        if delay and self.blocking_response_delay:
+            time.sleep(delay)
+
+        return generated_response
@@ -0,0 +1,151 @@
+"""
+Opt-in Server-Timing header for the REST API.
+
+When settings.SERVER_TIMING is True every response gets a header like:
+    Server-Timing: auth;dur=1.8, validation;dur=0.4, db;dur=3.1;desc="2 queries", total;dur=7.9
+
+    - auth: JWT authentication of the request (TimedJWTAuthentication) and password checks
+    - validation / serialization: the parts of the views timed with ResponseUtilities.timed()
+    - db: every SQL query run while handling the request, also the ones the
+      async views run in the threads of the async ORM
+    - total: the whole request as seen by the middleware
+
+Browsers show the header in the network tab, so a slow view shows where its time goes.
+
+How to use:
+    - SERVER_TIMING = True in the settings (off by default)
+    - "utilities.server_timing.ServerTimingMiddleware" first in the MIDDLEWARE
+    - with self.timed("validation"): ... inside a view inheriting ResponseUtilities
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.db.backends.signals import connection_created
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+# [count, milliseconds] of the SQL queries of the request being timed, None outside of one.
+# sync_to_async runs the async ORM with a copy of the context, so its threads add to the same list.
+request_queries = ContextVar("server_timing_queries", default=None)
+
+
+@contextmanager
+def timed(request, name):
+    """
+    Adds the time spent in the block to the `name` timing of the request.
+
+    Does nothing when the request is not timed (SERVER_TIMING is off).
+    """
+    timings = getattr(request, "server_timing", None)
+    if timings is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + (time.perf_counter() - started) * 1000
+
+
+def time_query(execute, sql, params, many, context):
+    """
+    Execute wrapper adding the query to the queries of the timed request, if any.
+    """
+    queries = request_queries.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries[0] += 1
+        queries[1] += (time.perf_counter() - started) * 1000
+
+
+def install_query_timer(sender=None, connection=None, **kwargs):
+    """
+    Puts time_query on the database connection, connection_created receiver.
+
+    Every thread has its own connection, the ones of the async ORM included.
+    """
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+class TimedJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication of the REST API, timed as "auth" in the Server-Timing header.
+    """
+
+    def authenticate(self, request):
+        with timed(request, "auth"):
+            return super().authenticate(request)
+
+
+class ServerTimingMiddleware:
+    """
+    Times the request, its SQL queries and the phases timed by the view, and adds the Server-Timing header.
+
+    Works in front of the sync and the async views. The queries are timed by
+    time_query, installed on every database connection when it is opened.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, "SERVER_TIMING", False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+        connection_created.connect(install_query_timer, dispatch_uid="server_timing_queries")
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        request.server_timing = {}
+        queries = [0, 0.0]  # count, milliseconds
+        # The connection of this thread may have been opened before the receiver was connected
+        install_query_timer(connection=connection)
+
+        token = request_queries.set(queries)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            request_queries.reset(token)
+        total = (time.perf_counter() - started) * 1000
+
+        response["Server-Timing"] = ", ".join(self.get_metrics(request, queries, total))
+        return response
+
+    async def __acall__(self, request):
+        request.server_timing = {}
+        queries = [0, 0.0]  # count, milliseconds
+
+        token = request_queries.set(queries)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            request_queries.reset(token)
+        total = (time.perf_counter() - started) * 1000
+
+        response["Server-Timing"] = ", ".join(self.get_metrics(request, queries, total))
+        return response
+
+    def get_metrics(self, request, queries, total):
+        metrics = [f"{name};dur={duration:.1f}" for name, duration in request.server_timing.items()]
+        metrics.append(f'db;dur={queries[1]:.1f};desc="{queries[0]} queries"')
+        metrics.append(f"total;dur={total:.1f}")
+        return metrics